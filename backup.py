@@ -3,17 +3,56 @@ import logging
 from argparse import ArgumentParser, FileType
 import ovirtsdk4 as sdk
 import ovirtsdk4.types as types
+import functools
+import multiprocessing
+import os
+import sqlite3
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 from vmtools import VMTools
 from config import Config
-
-VMS_MAX_LIST = 400
+from scheduler import Pipeline, StorageDomainLimiter
+from events import EventTracker, tracked
+from inventory import Inventory
+from retention import DirectoryRetention, RetentionEngine
+from repository import Repository
+from capacity import CapacityLedger
+from incremental import FORMAT_FILES, FORMAT_REPOSITORY, CheckpointStore, EngineBackup
+from planning import MIB, ORDER_CONFIG, ORDER_SIZE, order_longest_first, plan
+from monitor import StatusMonitor
+from journal import DONE, Journal, NullJournal
+from history import History
+from connection import ConnectionPool, TokenCache
+import metrics
+from tracing import CallTracer, TracingConnection
+from waiter import wait_for
 
 """
 Main class to make the backups
 """
 
+# Backups are cloned and exported to the export domain
+BACKUP_MODE_EXPORT = "export"
+# Disks are downloaded with the backup API of the engine into backup_dir,
+# incremental since the checkpoint of the last backup
+BACKUP_MODE_INCREMENTAL = "incremental"
+# Disks are downloaded with the backup API of the engine into backup_dir,
+# always full images
+BACKUP_MODE_FULL = "full"
+
+# Old backups are deleted in the retention stage of each VM
+RETENTION_INTERLEAVED = "interleaved"
+# Old backups are deleted after all backups are done
+RETENTION_END = "end"
+
+# Where the estimates of --plan come from, see planning.plan
+PLAN_SOURCES = {
+    "vm": "history of the VM",
+    "all": "history of all VMs",
+    "throughput": "backup_throughput",
+}
+
 logger = logging.getLogger()
 
 
@@ -51,6 +90,20 @@ def create_argparser():
         action="store_true",
         default=None,  # None because we need to recognize whether it was set.
     )
+    p.add_argument(
+        "--resume",
+        help="Adopt the snapshots, clones and transfers of a crashed run from the journal_file",
+        dest="resume",
+        action="store_true",
+        default=False,
+    )
+    p.add_argument(
+        "--plan",
+        help="Only log the expected duration of every backup and of the run, based on the history_file",
+        dest="plan",
+        action="store_true",
+        default=False,
+    )
 
     osg = p.add_argument_group("oVirt server related options")
     osg.add_argument(
@@ -100,6 +153,14 @@ def create_argparser():
         dest="vm_names",
         default=None,
     )
+    vmg.add_argument(
+        "--vms-page-size",
+        help="Number of VMs fetched with one request when VMs are "
+             "enumerated or resolved by name",
+        dest="vms_page_size",
+        type=int,
+        default=None,
+    )
     vmg.add_argument(
         "--vm-middle",
         help="Middle part for the exported VM name",
@@ -142,16 +203,39 @@ def create_argparser():
     )
     mscg.add_argument(
         "--timeout",
-        help="Timeout in seconds to wait for time consuming operation",
+        help="Maximum time in seconds to wait before retrying an operation "
+             "which was rejected because another one is running",
         dest="timeout",
         default=None,
     )
+    mscg.add_argument(
+        "--operation-deadline",
+        help="Give up waiting for a single operation after this many "
+             "seconds, 0 means wait forever",
+        dest="operation_deadline",
+        type=int,
+        default=None,
+    )
     mscg.add_argument(
         "--backup-keep-count",
         help="Number of days to keep backups",
         dest="backup_keep_count",
         default=None,
     )
+    mscg.add_argument(
+        "--retention-mode",
+        help="'interleaved' deletes old backups of a VM before its export, "
+             "'end' deletes them after all backups are done",
+        dest="retention_mode",
+        default=None,
+    )
+    mscg.add_argument(
+        "--retention-max-operations",
+        help="Maximum of old backups deleted at the same time from the export domain",
+        dest="retention_max_operations",
+        type=int,
+        default=None,
+    )
     mscg.add_argument(
         "--vm-name-max-length",
         help="Limit for length of VM's name ",
@@ -179,6 +263,92 @@ def create_argparser():
         action="store_true",
         default=None,
     )
+    mscg.add_argument(
+        "--parallel",
+        help="Number of VMs which are backed up at the same time",
+        dest="parallel",
+        type=int,
+        default=None,
+    )
+    mscg.add_argument(
+        "--backup-mode",
+        help="'export' clones the VMs and exports them to the export domain, "
+             "'incremental' downloads the changed blocks of the disks into the backup directory, "
+             "'full' downloads the whole disks into the backup directory",
+        dest="backup_mode",
+        default=None,
+    )
+    mscg.add_argument(
+        "--backup-dir",
+        help="Directory of the backups if the backup mode isn't 'export'",
+        dest="backup_dir",
+        default=None,
+    )
+    mscg.add_argument(
+        "--transfer-connections",
+        help="Number of connections to the image server per disk",
+        dest="transfer_connections",
+        type=int,
+        default=None,
+    )
+    mscg.add_argument(
+        "--backup-format",
+        help="'files' keeps a file per disk, 'repository' stores every unique chunk of the disks once",
+        dest="backup_format",
+        default=None,
+    )
+    mscg.add_argument(
+        "--compression",
+        help="Compression of the downloaded disks: none, auto, zstd, lz4 or zlib",
+        dest="compression",
+        default=None,
+    )
+    mscg.add_argument(
+        "--backup-order",
+        help="'config' backs up the VMs in the order of the config or the engine, "
+             "'size' backs up the largest VMs first",
+        dest="backup_order",
+        default=None,
+    )
+    mscg.add_argument(
+        "--pipeline",
+        help="If set, the backup stages of different VMs overlap, e.g. the "
+             "next VM is cloned while the previous one is exported",
+        dest="pipeline",
+        action="store_true",
+        default=None,
+    )
+    mscg.add_argument(
+        "--stage-concurrency",
+        help="JSON object with the number of VMs per backup stage when "
+             "--pipeline is set, e.g. '{\"export\": 2}'",
+        dest="stage_concurrency",
+        default=None,
+    )
+    mscg.add_argument(
+        "--event-tracking",
+        help="If set, operations are tagged with a correlation id and their "
+             "end is detected from the engine events and jobs",
+        dest="event_tracking",
+        action="store_true",
+        default=None,
+    )
+    mscg.add_argument(
+        "--sdk-tracing",
+        help="If set, every REST call to the engine is timed and the top "
+             "endpoints with their latency percentiles are logged at the end",
+        dest="sdk_tracing",
+        action="store_true",
+        default=None,
+    )
+    mscg.add_argument(
+        "--storage-domain-max-operations",
+        help="Maximum of clone and export operations running at the same "
+             "time on one storage domain, 0 means no limit",
+        dest="storage_domain_max_operations",
+        type=int,
+        default=None,
+    )
 
     lg = p.add_argument_group("Logging related options")
     lg.add_argument(
@@ -198,7 +368,7 @@ def create_argparser():
 
 def arguments_to_dict(opts):
     result = {}
-    ignored_keys = ('config_file', 'dry_run', 'debug')
+    ignored_keys = ('config_file', 'dry_run', 'debug', 'resume', 'plan')
     for key, val in vars(opts).items():
         if key in ignored_keys:
             continue  # This doesn't have a place in config file
@@ -207,6 +377,45 @@ def arguments_to_dict(opts):
     return result
 
 
+def backup_workers():
+    """
+    :return: Number of VMs which are backed up at the same time, with the
+    pipeline the concurrency of the export or transfer stage
+    """
+    if config.get_pipeline():
+        stage = "export" if config.get_backup_mode() == BACKUP_MODE_EXPORT else "transfer"
+        return config.get_stage_concurrency().get(stage, config.get_parallel())
+    return config.get_parallel()
+
+
+def log_plan(vms, sizes):
+    """
+    Log the predicted duration of every backup and of the whole run
+    :param vms: List of VM objects in the order they are backed up
+    :param sizes: Dict of disk sizes in bytes by VM id
+    """
+    workers = backup_workers()
+    makespan, estimates = plan(vms, sizes, workers, history, config.get_backup_throughput() * MIB)
+    logger.info("Plan of the backup of %s VMs with %s workers:", len(vms), workers)
+    for vm, seconds, source in estimates:
+        logger.info("  %-40s %8s GiB  %6s:%02d minutes  (%s)", vm.name, round(sizes.get(vm.id, 0) / (1024.0 * MIB), 1),
+                    int(seconds // 60), int(seconds % 60), PLAN_SOURCES[source])
+    logger.info("Expected wall time: %s:%02d:%02d hours, %s GiB", int(makespan // 3600), int(makespan % 3600 // 60),
+                int(makespan % 60), sum(sizes.values()) // (1024 * MIB))
+
+
+def expected_duration(vm_name, operation):
+    """
+    :param vm_name: Name of the VM
+    :param operation: Name of the operation, e.g. "export"
+    :return: Seconds the operation took at least in the last backups of the
+    VM, None without history or with adaptive_polling off
+    """
+    if history is None or not config.get_adaptive_polling():
+        return None
+    return history.shortest_duration(vm_name, operation)
+
+
 def close_and_exit(err_msg):
     logger.error(err_msg)
     api.close()
@@ -227,255 +436,711 @@ def main(argv):
 
     time_start = int(time.time())
 
+    # Wall, waiting and working time of every stage of every VM
+    global run_metrics
+    run_metrics = metrics.RunMetrics()
+
     has_errors = False
 
+    # Every REST call is timed with --sdk-tracing
+    global tracer
+    tracer = CallTracer()
+
     # Connect to server
     connect()
 
     system_service = api.system_service()
 
+    # All lookups of data centers, clusters, storage domains and VMs are
+    # served from here
+    global inventory
+    inventory = Inventory(api, config.get_inventory_ttl())
+
+    export_mode = config.get_backup_mode() == BACKUP_MODE_EXPORT
+    if config.get_backup_mode() not in (BACKUP_MODE_EXPORT, BACKUP_MODE_INCREMENTAL, BACKUP_MODE_FULL):
+        close_and_exit(err_msg=f"!!! Check the backup_mode in the config {config.get_backup_mode()}")
+
+    # Data centers, clusters and storage domains are fetched at the same
+    # time, the checks below don't send requests anymore
+    inventory.preload([config.get_datacenter_name()] if export_mode else [])
+
     # Test if data center is valid
-    # Retrieve the data center service:
-    if system_service.data_centers_service().list(search='name=%s' % config.get_datacenter_name())[0] is None:
+    if inventory.data_center(config.get_datacenter_name()) is None:
         close_and_exit(err_msg="!!! Check the datacenter_name in the config")
+    if not export_mode and not os.path.isdir(config.get_backup_dir()):
+        close_and_exit(err_msg=f"!!! Check the backup_dir in the config {config.get_backup_dir()}")
+    if config.get_backup_format() not in (FORMAT_FILES, FORMAT_REPOSITORY):
+        close_and_exit(err_msg=f"!!! Check the backup_format in the config {config.get_backup_format()}")
 
     # Test if config export_domain is valid
-    if system_service.storage_domains_service().list(search='name=%s' % config.get_export_domain())[0] is None:
+    if export_mode and inventory.storage_domain(config.get_export_domain()) is None:
         close_and_exit(err_msg=f"!!! Check the export_domain in the config {config.get_export_domain()}")
+    if export_mode and inventory.attached_storage_domain(config.get_datacenter_name(),
+                                                         config.get_export_domain()) is None:
+        close_and_exit(err_msg=f"!!! The export_domain {config.get_export_domain()} isn't attached to the "
+                               f"datacenter {config.get_datacenter_name()}")
 
     # Test if config cluster_name is valid
-    if system_service.clusters_service().list(search='name=%s' % config.get_cluster_name())[0] is None:
+    if inventory.cluster(config.get_cluster_name()) is None:
         close_and_exit(err_msg="!!! Check the cluster_name in the config")
 
     # Test if config storage_domain is valid
-    if system_service.storage_domains_service().list(search='name=%s' % config.get_storage_domain())[0] is None:
+    if inventory.storage_domain(config.get_storage_domain()) is None:
         close_and_exit(err_msg="!!! Check the storage_domain in the config")
 
     vms_service = system_service.vms_service()
 
-    # Add all VM's to the config file
-    if config.get_all_vms():
-        vms = vms_service.list(max=VMS_MAX_LIST)
-        config.set_vm_names([vm.name for vm in vms])
-        # Update config file
-        if opts.config_file.name != "<stdin>":
-            config.write_update(opts.config_file.name)
-
-    # Add VM's with the tag to the vm list
-    if config.get_vm_tag():
-        vms = vms_service.list(max=VMS_MAX_LIST, search=f"tag={config.get_vm_tag()}")
-        config.set_vm_names([vm.name for vm in vms])
-        # Update config file
-        if opts.config_file.name != "<stdin>":
-            config.write_update(opts.config_file.name)
-
-    if config.get_vm_names_skip():
-        vms = vms_service.list(max=VMS_MAX_LIST)
-        vm_names_skip = config.get_vm_names_skip()
-        config.set_vm_names([vm.name for vm in vms if vm.name not in vm_names_skip])
-
-    # Test if all VM names are valid
-    for vm_from_list in config.get_vm_names():
-        if vms_service.list(search=f"name={vm_from_list}") is None:
-            close_and_exit(err_msg=f"!!! There are no VM with the following name in your cluster: {vm_from_list}")
-
     # Test if config vm_middle is valid
     if not config.get_vm_middle():
         close_and_exit(err_msg="!!! It's not valid to leave vm_middle empty")
 
+    # VMs found by all_vms, vm_tag and vm_names_skip are enumerated page by
+    # page, the first backups start before the enumeration is finished.
+    # Clones are excluded by the search, they are never backed up themselves.
+    page_size = config.get_vms_page_size()
+    update_config_file = False
+    if config.get_vm_names_skip():
+        # The skip list is part of the search, only names which don't fit
+        # into it are filtered here
+        search, vm_names_skip = VMTools.exclusion_search(
+            [VMTools.clone_pattern(config)] + config.get_vm_names_skip())
+        vms = (vm for vm in VMTools.iter_vms(vms_service, search, page_size)
+               if vm.name not in vm_names_skip and not VMTools.is_clone_name(config, vm.name))
+    elif config.get_vm_tag():
+        # Add VM's with the tag to the vm list
+        search = f"tag={config.get_vm_tag()} and name!={VMTools.clone_pattern(config)}"
+        vms = (vm for vm in VMTools.iter_vms(vms_service, search, page_size)
+               if not VMTools.is_clone_name(config, vm.name))
+        update_config_file = True
+    elif config.get_all_vms():
+        # Add all VM's to the config file
+        vms = (vm for vm in VMTools.iter_vms(vms_service, f"name!={VMTools.clone_pattern(config)}", page_size)
+               if not VMTools.is_clone_name(config, vm.name))
+        update_config_file = True
+    else:
+        # Test if all VM names are valid
+        resolved_vms = VMTools.resolve_vms(vms_service, config.get_vm_names(), page_size)
+        for vm_from_list in config.get_vm_names():
+            if vm_from_list not in resolved_vms:
+                close_and_exit(err_msg=f"!!! There are no VM with the following name in your cluster: {vm_from_list}")
+        vms = [resolved_vms[vm_from_list] for vm_from_list in config.get_vm_names()]
+
+    # Disk sizes of all VMs are fetched in bulk, the space of running
+    # clones is reserved on the storage domain
+    global ledger
+    ledger = CapacityLedger(api, config, inventory)
+
+    # Durations and sizes of the past runs, the estimates are based on them
+    global history
+    history = None
+    if config.get_history_file():
+        try:
+            history = History(config.get_history_file())
+        except sqlite3.Error as e:
+            close_and_exit(err_msg=f"!!! Check the history_file in the config {config.get_history_file()}: {e}")
+
+    if config.get_backup_order() == ORDER_SIZE:
+        # The order needs the size of all VMs, the backups start after the
+        # enumeration is finished
+        vms = list(vms)
+        ledger.add_vms(vms)
+        sizes = dict((vm.id, ledger.size(vm)) for vm in vms)
+        vms = order_longest_first(vms, sizes)
+        workers = backup_workers()
+        makespan, _ = plan(vms, sizes, workers, history, config.get_backup_throughput() * MIB)
+        logger.info("Backup of %s VMs (%s GiB) with %s workers, expected to be finished in %s:%02d hours at %s",
+                    len(vms), sum(sizes.values()) // (1024 * MIB), workers, int(makespan // 3600),
+                    int(makespan % 3600 // 60), time.strftime("%H:%M", time.localtime(time.time() + makespan)))
+    elif config.get_backup_order() != ORDER_CONFIG:
+        close_and_exit(err_msg=f"!!! Check the backup_order in the config {config.get_backup_order()}")
+
+    # Only the predicted durations are logged, nothing is changed
+    if opts.plan:
+        vms = list(vms)
+        ledger.add_vms(vms)
+        log_plan(vms, dict((vm.id, ledger.size(vm)) for vm in vms))
+        if history:
+            history.close()
+        api.close()
+        return
+
+    global limiter
+    limiter = StorageDomainLimiter(config.get_storage_domain_max_operations())
+
+    # Every step is recorded, a crashed run can be resumed
+    global journal
+    journal = NullJournal()
+    if config.get_journal_file() and not config.get_dry_run():
+        journal = Journal(config.get_journal_file(), opts.resume)
+    elif opts.resume:
+        close_and_exit(err_msg="!!! --resume needs the journal_file in the config")
+
+    # The checkpoint of the last backup of every VM is kept in backup_dir
+    global engine_backup
+    engine_backup = None
+    # The disks are compressed on all cores while they are downloaded
+    global compression_pool
+    compression_pool = None
+    if not export_mode and config.get_compression() not in ("", "none"):
+        # The workers are started by a fork server, a fork of this process
+        # would copy the locks held by its other threads
+        compression_pool = ProcessPoolExecutor(max_workers=config.get_compression_workers() or None,
+                                               mp_context=multiprocessing.get_context("forkserver"))
+    checkpoints = None
+    if config.get_backup_mode() == BACKUP_MODE_INCREMENTAL:
+        checkpoints = CheckpointStore(config.get_backup_dir())
+    if not export_mode:
+        try:
+            engine_backup = EngineBackup(api, config, checkpoints, compression_pool, journal)
+        except Exception as e:
+            close_and_exit(err_msg=f"!!! Check the compression in the config: {e}")
+
+    # The export domain is listed once, all deletions are planned from it
+    global retention
+    if export_mode:
+        retention = RetentionEngine(api, config, inventory)
+    else:
+        retention = DirectoryRetention(config)
+    if config.get_retention_mode() not in (RETENTION_INTERLEAVED, RETENTION_END):
+        close_and_exit(err_msg=f"!!! Check the retention_mode in the config {config.get_retention_mode()}")
+
+    # With more than one VM in flight all status checks are shared, one
+    # search query per tick instead of one request per operation
+    global monitor
+    monitor = None
+    if config.get_parallel() > 1 or config.get_pipeline():
+        monitor = StatusMonitor(api, config)
+        monitor.start()
+
+    # Follow the engine events instead of polling the objects
+    global tracker
+    tracker = None
+    if config.get_event_tracking():
+        tracker = EventTracker(api, config)
+        tracker.start()
+
+    if config.get_pipeline():
+        stage_concurrency = config.get_stage_concurrency()
+        stages = [
+            (name, run_metrics.instrument(name, function), stage_concurrency.get(name, config.get_parallel()))
+            for name, function in backup_stages()
+        ]
+    else:
+        stages = [("backup", backup_vm, config.get_parallel())]
+
     vms_with_failures = list()
 
-    dcs_service = system_service.data_centers_service()
-    dc = dcs_service.list(search='name=%s' % config.get_datacenter_name())[0]
-    dc_service = dcs_service.data_center_service(dc.id)
-    sds_service = dc_service.storage_domains_service()
-    sds_export_service = sds_service.list(search='name=%s' % config.get_export_domain())[0]
+    # The disk sizes of a resolved VM list are fetched with the first
+    # reservation, enumerated VMs are added one after the other
+    if isinstance(vms, list):
+        inventory.add_vms(vms)
+        ledger.add_vms(vms)
+
+    def create_jobs():
+        vm_names = list()
+        for vm in vms:
+            if not isinstance(vms, list):
+                inventory.add_vms([vm])
+                ledger.add_vms([vm])
+            vm_names.append(vm.name)
+            vms_with_failures.append(vm.name)
+            yield BackupJob(vm.name, journal.state(vm.name))
+        config.set_vm_names(vm_names)
+        # Update config file
+        if update_config_file and opts.config_file.name != "<stdin>":
+            config.write_update(opts.config_file.name)
 
-    if sds_export_service is None:
-        close_and_exit(err_msg="")
+    vms_done = list()
+    manifests = list()
+    # Provisioned size of every VM for the history
+    vm_sizes = dict()
+    for job, error in Pipeline(stages).run(create_jobs()):
+        if error is not None:
+            close_and_exit(err_msg=f"!!! Got unexpected exception: {error}")
+        if job.vm:
+            ledger.release(job.vm)
+            vm_sizes[job.vm_name] = ledger.size(job.vm)
+        if job.done:
+            vms_with_failures.remove(job.vm_name)
+            vms_done.append(job.vm_name)
+            if job.manifest:
+                manifests.append(job.manifest)
+        if job.has_errors:
+            has_errors = True
+
+    # Delete old backups of all successfully backed up VMs at once
+    if retention and config.get_retention_mode() == RETENTION_END:
+        with run_metrics.stage(None, "retention"):
+            if retention.execute(retention.plan(vms_done), tracker):
+                has_errors = True
 
-    for vm_from_list in config.get_vm_names():
-        vms_with_failures.append(vm_from_list)
+    logger.info("All backups done")
 
-        config.clear_vm_suffix()
-        vm_clone_name = vm_from_list + config.get_vm_middle() + config.get_vm_suffix()
+    for manifest in manifests:
+        for disk in manifest["disks"]:
+            if disk.get("compression"):
+                logger.info("Disk %s of %s: compression %s, ratio %s, %s seconds", disk["name"], manifest["vm"],
+                            disk["compression"]["codec"], disk["compression"]["ratio"],
+                            disk["compression"]["seconds"])
+    if compression_pool:
+        compression_pool.shutdown()
+    # Chunks are only deleted when no backup is running anymore
+    if not export_mode and config.get_backup_format() == FORMAT_REPOSITORY and not config.get_dry_run():
+        with run_metrics.stage(None, "garbage_collection"):
+            Repository(config.get_backup_dir()).collect_garbage(time_start)
 
-        # Check VM name length limitation
-        length = len(vm_clone_name)
-        if length > config.get_vm_name_max_length():
-            logger.error("!!! VM name with middle and suffix are to long (size: %s, allowed %s) !!!", length,
-                         config.get_vm_name_max_length())
-            logger.info("VM name: %s", vm_clone_name)
-            continue
+    if vms_with_failures:
+        logger.info("Backup failure for:")
+        for vm_with_failures in vms_with_failures:
+            logger.info(f"  {vm_with_failures}")
 
-        logger.info("Start backup for: %s", vm_from_list)
-        if config.get_dry_run():
-            vms_with_failures.remove(vm_from_list)
-            continue
+    report = run_metrics.report(vms_with_failures)
+    if config.get_sdk_tracing():
+        tracer.log_summary()
+        report["sdk_calls"] = tracer.summary()
+    for name, total in sorted(report["stages"].items()):
+        logger.info("Stage %s: %s VMs, %s seconds, %s seconds waiting, %s MiB", name, total["vms"],
+                    int(total["seconds"]), int(total["waiting"]), total["bytes"] // MIB)
+    try:
+        if config.get_metrics_report():
+            metrics.write_json(config.get_metrics_report(), report)
+        if config.get_metrics_textfile():
+            metrics.write_textfile(config.get_metrics_textfile(), report)
+    except OSError as e:
+        logger.warning("Can't write the metrics of the run: %s", e)
+        has_errors = True
+    if history:
+        # Durations of a dry run aren't the ones of a backup
+        if not config.get_dry_run():
+            try:
+                history.record_run(report, vm_sizes, backup_workers())
+            except sqlite3.Error as e:
+                logger.warning("Can't add the run to the history %s: %s", config.get_history_file(), e)
+                has_errors = True
+        history.close()
 
-        try:
-            VMTools.check_storage_domain_status(
-                api,
-                config.get_datacenter_name(),
-                config.get_export_domain()
-            )
-            # Cleanup: Delete the cloned VM
-            VMTools.delete_vm(api, config, vm_from_list)
-
-            # Get the VM
-            vm = vms_service.list(search='name=%s' % vm_from_list)
-            if len(vm) == 0:
-                logger.warning(
-                    "The VM (%s) doesn't exist anymore, skipping backup ...",
-                    vm_from_list
-                )
-                continue
+    if monitor:
+        monitor.stop()
+    if tracker:
+        tracker.stop()
+    journal.close()
 
-            vm = vm[0]
+    if has_errors:
+        close_and_exit(err_msg="Some errors occurred during the backup, please check the log file")
 
-            # Delete old backup snapshots
-            VMTools.delete_snapshots(api, vm, config, vm_from_list)
+    # Disconnect from the server
+    api.close()
 
-            # Check free space on the storage
-            VMTools.check_free_space(api, config, vm)
 
-            # Create a VM snapshot:
-            try:
-                logger.info("Snapshot creation started ...")
-                snapshots_service = vms_service.vm_service(vm.id).snapshots_service()
-                if not config.get_dry_run():
-                    # Add the new snapshot:
-                    snapshots_service.add(
-                        types.Snapshot(
-                            description=config.get_snapshot_description(),
-                            persist_memorystate=config.get_persist_memorystate(),
-                        ),
-                    )
-                    VMTools.wait_for_snapshot_operation(api, vm, config, "creation")
-                logger.info("Snapshot created")
-            except Exception as e:
-                logger.info("Can't create snapshot for VM: %s", vm_from_list)
-                logger.info("DEBUG: %s", e)
-                has_errors = True
-                continue
-            # Workaround for some SDK problems see issue #17
-            time.sleep(config.get_timeout())
-
-            # Clone the snapshot into a VM
-            snapshots = snapshots_service.list()
-            snap = None
-            for i in snapshots:
-                if i.description == config.get_snapshot_description():
-                    snap = i
-
-            if not snap:
-                logger.error("!!! No snapshot found !!!")
-                has_errors = True
-                continue
-
-            logger.info("Clone into VM (%s) started ..." % vm_clone_name)
-            if not config.get_dry_run():
-                cloned_vm = vms_service.add(
-                    vm=types.Vm(
-                        name=vm_clone_name,
-                        memory=vm.memory,
-                        snapshots=[
-                            types.Snapshot(
-                                id=snap.id
+class BackupJob(object):
+    """
+    Class which holds the state of one VM backup while it moves through the
+    backup stages
+    """
+
+    def __init__(self, vm_name, resume=None):
+        self.vm_name = vm_name
+        # VmState of a crashed run if the run is resumed
+        self.resume = resume
+        # Stages which were adopted from the crashed run
+        self.adopted = set()
+        self.vm = None
+        self.clone_name = None
+        self.clone_id = None
+        self.snapshot = None
+        # Manifest of a backup made with the backup API of the engine
+        self.manifest = None
+        # True if the backup was successful
+        self.done = False
+        # True if an error occurred which should fail the whole run
+        self.has_errors = False
+
+    def __str__(self):
+        return self.vm_name
+
+
+def backup_vm(job):
+    """
+    Run all backup stages for one VM one after the other
+    :param job: BackupJob
+    """
+    for name, function in backup_stages():
+        if not run_metrics.instrument(name, function)(job):
+            return False
+    return True
+
+
+def snapshot_stage(job):
+    """
+    Prepare the backup of the VM and create the backup snapshot
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    vm_from_list = job.vm_name
+    job.clone_name = vm_from_list + config.get_vm_middle() + config.new_vm_suffix()
+    if job.resume and job.resume.fields.get("clone_name"):
+        job.clone_name = job.resume.fields["clone_name"]
+
+    # Check VM name length limitation
+    length = len(job.clone_name)
+    if length > config.get_vm_name_max_length():
+        logger.error("!!! VM name with middle and suffix are to long (size: %s, allowed %s) !!!", length,
+                     config.get_vm_name_max_length())
+        logger.info("VM name: %s", job.clone_name)
+        return False
+
+    logger.info("Start backup for: %s", vm_from_list)
+    if config.get_dry_run():
+        job.done = True
+        return False
+
+    VMTools.check_storage_domain_status(
+        api,
+        config.get_datacenter_name(),
+        config.get_export_domain(),
+        inventory,
+    )
+    # Get the VM
+    vm = job.vm = inventory.vm(vm_from_list)
+    if vm is None:
+        logger.warning(
+            "The VM (%s) doesn't exist anymore, skipping backup ...",
+            vm_from_list
+        )
+        return False
+
+    # Adopt the snapshot or clone of a crashed run
+    job.adopted = resume_job(job)
+    if not job.adopted:
+        # Cleanup: Delete the cloned VM
+        VMTools.delete_vm(api, config, vm_from_list, monitor, tracker)
+
+        # Delete old backup snapshots
+        VMTools.delete_snapshots(api, vm, config, vm_from_list, monitor, tracker)
+
+    # Reserve the free space on the storage for the clone, waits while
+    # other backups hold the space
+    ledger.reserve(vm)
+    if "snapshot" in job.adopted:
+        return True
+
+    # Create a VM snapshot:
+    try:
+        logger.info("Snapshot creation started ...")
+        snapshots_service = api.system_service().vms_service().vm_service(vm.id).snapshots_service()
+        if not config.get_dry_run():
+            with metrics.timed("snapshot"), \
+                    tracked(tracker, "Snapshot creation for VM (%s)" % vm_from_list) as operation:
+                # Add the new snapshot:
+                job.snapshot = snapshots_service.add(
+                    types.Snapshot(
+                        description=config.get_snapshot_description(),
+                        persist_memorystate=config.get_persist_memorystate(),
+                    ),
+                    query=operation and operation.query,
+                )
+                # Waiting for this snapshot to be 'ok' replaces the sleep which
+                # was needed as workaround for issue #17
+                if operation:
+                    operation.wait()
+                else:
+                    VMTools.wait_for_snapshot_operation(api, vm, config, "creation", job.snapshot.id, monitor,
+                                                        expected_duration(vm_from_list, "snapshot"))
+            journal.record(vm_from_list, "snapshot", snapshot_id=job.snapshot.id, clone_name=job.clone_name)
+        logger.info("Snapshot created")
+    except Exception as e:
+        logger.info("Can't create snapshot for VM: %s", vm_from_list)
+        logger.info("DEBUG: %s", e)
+        job.has_errors = True
+        return False
+
+    if not job.snapshot:
+        logger.error("!!! No snapshot found !!!")
+        job.has_errors = True
+        return False
+    return True
+
+
+def resume_job(job):
+    """
+    Adopt the snapshot, clone or export of a crashed run from the journal
+    :param job: BackupJob with the VM
+    :return: Set of the stages which don't have to run again
+    """
+    resume = job.resume
+    if resume is None or not resume.fields.get("clone_name"):
+        return set()
+    vms_service = api.system_service().vms_service()
+    adopted = set()
+    if "export" in resume.events:
+        adopted = {"snapshot", "clone", "retention", "export"}
+    elif ("clone" in resume.events or "clone_started" in resume.events) and \
+            not VMTools.is_removed(vms_service.vm_service(resume.fields["clone_id"])):
+        adopted = {"snapshot", "clone"}
+        if "clone" not in resume.events:
+            # The engine keeps cloning when the backup crashes
+            VMTools.wait_for_vm_down(api, config, resume.fields["clone_id"], "clone",
+                                     "Cloning into VM (%s)" % resume.fields["clone_name"], monitor)
+            journal.record(job.vm_name, "clone", clone_id=resume.fields["clone_id"])
+        if "export_started" in resume.events:
+            # The engine keeps exporting when the backup crashes
+            VMTools.wait_for_vm_down(api, config, resume.fields["clone_id"], "export",
+                                     "Export of VM (%s)" % resume.fields["clone_name"], monitor)
+            if is_exported(resume.fields["clone_name"]):
+                adopted.update(("retention", "export"))
+    elif "snapshot" in resume.events:
+        snapshots_service = vms_service.vm_service(job.vm.id).snapshots_service()
+        if not VMTools.is_removed(snapshots_service.snapshot_service(resume.fields["snapshot_id"])):
+            adopted = {"snapshot"}
+    if adopted:
+        job.snapshot = types.Snapshot(id=resume.fields.get("snapshot_id"))
+        job.clone_id = resume.fields.get("clone_id")
+        logger.info("Resuming backup of %s, adopted from the last run: %s", job.vm_name,
+                    ", ".join(name for name, _ in BACKUP_STAGES if name in adopted))
+    return adopted
+
+
+def is_exported(clone_name):
+    """
+    :param clone_name: Name of the cloned VM
+    :return: True if the export domain has a backup with the name
+    """
+    export_sd = inventory.storage_domain(config.get_export_domain())
+    sds_service = api.system_service().storage_domains_service()
+    exported_vms = sds_service.storage_domain_service(export_sd.id).vms_service().list()
+    return any(i.name == clone_name for i in exported_vms)
+
+
+def clone_stage(job):
+    """
+    Clone the backup snapshot into a VM and delete the snapshot
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    if "clone" in job.adopted:
+        ledger.cloned(job.vm)
+        VMTools.delete_snapshots(api, job.vm, config, job.vm_name, monitor, tracker)
+        return True
+    vms_service = api.system_service().vms_service()
+    with limiter.hold(config.get_storage_domain()):
+        logger.info("Clone into VM (%s) started ..." % job.clone_name)
+        if not config.get_dry_run():
+            def add_clone():
+                try:
+                    return vms_service.add(
+                        vm=types.Vm(
+                            name=job.clone_name,
+                            memory=job.vm.memory,
+                            snapshots=[
+                                types.Snapshot(
+                                    id=job.snapshot.id
+                                )
+                            ],
+                            cluster=types.Cluster(
+                                name=config.get_cluster_name()
                             )
-                        ],
-                        cluster=types.Cluster(
-                            name=config.get_cluster_name()
-                        )
+                        ),
+                        query=operation and operation.query,
                     )
-                )
-                # Find the service that manages the cloned virtual machine:
-                cloned_vm_service = vms_service.vm_service(cloned_vm.id)
+                except Exception as e:
+                    # The VM can still be locked by the snapshot creation
+                    if VMTools.is_conflict(e):
+                        logger.debug("Got 409 wait for operation to be finished, DEBUG: %s", e)
+                        return None
+                    raise
+
+            with metrics.timed("clone"), tracked(tracker, "Cloning into VM (%s)" % job.clone_name) as operation:
+                cloned_vm = add_clone() or wait_for(config, "conflict", add_clone,
+                                                    "Clone into VM (%s)" % job.clone_name)
+                # A resumed run waits for this clone instead of cloning the
+                # snapshot again under the same name
+                journal.record(job.vm_name, "clone_started", clone_id=cloned_vm.id)
                 # Wait till the virtual machine is down, as that means that the creation
                 # of the disks of the virtual machine has been completed:
-                while True:
-                    time.sleep(config.get_timeout())
-                    logger.debug("Cloning into VM (%s) in progress ..." % vm_clone_name)
-                    cloned_vm = cloned_vm_service.get()
-                    if cloned_vm.status == types.VmStatus.DOWN:
-                        break
-
-            logger.info("Cloning finished")
-
-            # Delete backup snapshots
-            VMTools.delete_snapshots(api, vm, config, vm_from_list)
-
-            # Delete old backups
-            if config.get_backup_keep_count():
-                VMTools.delete_old_backups(api, config, vm_from_list)
-            if config.get_backup_keep_count_by_number():
-                VMTools.delete_old_backups_by_number(api, config, vm_from_list)
-
-            # Export the VM
-            try:
-                vm_clone = api.system_service().vms_service().list(search='name=%s' % vm_clone_name)[0]
-                logger.info("Export of VM (%s) started ..." % vm_clone_name)
-                if not config.get_dry_run():
-                    cloned_vm_service = vms_service.vm_service(vm_clone.id)
+                if operation:
+                    operation.wait()
+                else:
+                    VMTools.wait_for_vm_down(api, config, cloned_vm.id, "clone",
+                                             "Cloning into VM (%s)" % job.clone_name, monitor,
+                                             expected_duration(job.vm_name, "clone"))
+            job.clone_id = cloned_vm.id
+            journal.record(job.vm_name, "clone", clone_id=job.clone_id)
+            # The storage domain accounts for the clone after its next refresh
+            ledger.cloned(job.vm)
+
+        logger.info("Cloning finished")
+
+    # Delete backup snapshots
+    VMTools.delete_snapshots(api, job.vm, config, job.vm_name, monitor, tracker,
+                             expected_duration(job.vm_name, "snapshot_deletion"))
+    return True
+
+
+def retention_stage(job):
+    """
+    Delete old backups of the VM from the export domain
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    if "retention" in job.adopted:
+        return True
+    if retention and config.get_retention_mode() == RETENTION_INTERLEAVED:
+        if retention.execute(retention.plan([job.vm_name]), tracker):
+            job.has_errors = True
+    return True
+
+
+def export_stage(job):
+    """
+    Export the cloned VM to the export domain
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    if "export" in job.adopted:
+        return True
+    vms_service = api.system_service().vms_service()
+    try:
+        with limiter.hold(config.get_storage_domain(), config.get_export_domain()):
+            logger.info("Export of VM (%s) started ..." % job.clone_name)
+            if not config.get_dry_run():
+                cloned_vm_service = vms_service.vm_service(job.clone_id)
+                journal.record(job.vm_name, "export_started")
+                with metrics.timed("export"), tracked(tracker, "Export of VM (%s)" % job.clone_name) as operation:
                     cloned_vm_service.export(
                         exclusive=True,
                         discard_snapshots=True,
                         storage_domain=types.StorageDomain(
                             name=config.get_export_domain()
-                        )
+                        ),
+                        query=operation and operation.query,
                     )
-                    while True:
-                        time.sleep(config.get_timeout())
-                        cloned_vm = cloned_vm_service.get()
-                        if cloned_vm.status == types.VmStatus.DOWN:
-                            break
-
-                logger.info("Exporting finished")
-            except Exception as e:
-                logger.info("Can't export cloned VM (%s) to domain: %s", vm_clone_name, config.get_export_domain())
-                logger.info("DEBUG: %s", e)
-                has_errors = True
-                continue
-
-            # Delete the CLONED VM
-            VMTools.delete_vm(api, config, vm_from_list)
-
-            time_end = int(time.time())
-            time_diff = (time_end - time_start)
-            time_minutes = int(time_diff / 60)
-            time_seconds = time_diff % 60
-
-            logger.info("Duration: %s:%s minutes", time_minutes, time_seconds)
-            logger.info("VM exported as %s", vm_clone_name)
-            logger.info("Backup done for: %s", vm_from_list)
-            vms_with_failures.remove(vm_from_list)
-        except Exception as e:
-            close_and_exit(err_msg=f"!!! Got unexpected exception: {e}")
-
-    logger.info("All backups done")
-
-    if vms_with_failures:
-        logger.info("Backup failure for:")
-        for vm_with_failures in vms_with_failures:
-            logger.info(f"  {vm_with_failures}")
-
-    if has_errors:
-        close_and_exit(err_msg="Some errors occurred during the backup, please check the log file")
-
-    # Disconnect from the server
-    api.close()
+                    if operation:
+                        operation.wait()
+                    else:
+                        VMTools.wait_for_vm_down(api, config, job.clone_id, "export",
+                                                 "Export of VM (%s)" % job.clone_name, monitor,
+                                                 expected_duration(job.vm_name, "export"))
+                journal.record(job.vm_name, "export")
+
+            # The clone holds the provisioned size of the exported disks
+            metrics.add_bytes(ledger.size(job.vm))
+            logger.info("Exporting finished")
+    except Exception as e:
+        logger.info("Can't export cloned VM (%s) to domain: %s", job.clone_name, config.get_export_domain())
+        logger.info("DEBUG: %s", e)
+        job.has_errors = True
+        return False
+    return True
+
+
+def log_duration(job):
+    """
+    Log the wall time of the backup of the VM since its first stage started
+    :param job: BackupJob
+    """
+    time_diff = int(run_metrics.vm_seconds(job.vm_name))
+    logger.info("Duration: %s:%02d minutes", time_diff // 60, time_diff % 60)
+
+
+def cleanup_stage(job):
+    """
+    Delete the cloned VM and finish the backup of the VM
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    VMTools.delete_vm(api, config, job.vm_name, monitor, tracker, expected_duration(job.vm_name, "vm_deletion"))
+    ledger.release(job.vm)
+
+    log_duration(job)
+    logger.info("VM exported as %s", job.clone_name)
+    logger.info("Backup done for: %s", job.vm_name)
+    journal.record(job.vm_name, DONE)
+    job.done = True
+    return True
+
+
+def transfer_stage(job):
+    """
+    Download the disks of the VM with the backup API of the engine
+    :param job: BackupJob
+    :return: False if the backup of the VM can't continue
+    """
+    # The backup directory is named like the clone of the export mode
+    job.clone_name = job.vm_name + config.get_vm_middle() + config.new_vm_suffix()
+    if job.resume and job.resume.fields.get("backup_path"):
+        # The backup of a crashed run is continued in its directory
+        job.clone_name = os.path.basename(job.resume.fields["backup_path"])
+    logger.info("Start backup for: %s", job.vm_name)
+    if config.get_dry_run():
+        job.done = True
+        return False
+
+    vm = job.vm = inventory.vm(job.vm_name)
+    if vm is None:
+        logger.warning("The VM (%s) doesn't exist anymore, skipping backup ...", job.vm_name)
+        return False
+    try:
+        job.manifest = engine_backup.run(vm, os.path.join(config.get_backup_dir(), job.vm_name, job.clone_name),
+                                         job.resume)
+    except Exception as e:
+        logger.info("Can't back up the disks of VM: %s", job.vm_name)
+        logger.info("DEBUG: %s", e)
+        job.has_errors = True
+        return False
+
+    metrics.add_bytes(sum(i["transferred"] for i in job.manifest["disks"]))
+    log_duration(job)
+    logger.info("VM backed up as %s", job.clone_name)
+    logger.info("Backup done for: %s", job.vm_name)
+    journal.record(job.vm_name, DONE)
+    job.done = True
+    return True
+
+
+def backup_stages():
+    """
+    :return: The backup stages of the backup mode as tuples (name, function)
+    """
+    if config.get_backup_mode() == BACKUP_MODE_EXPORT:
+        return BACKUP_STAGES
+    return TRANSFER_STAGES
+
+
+# The backup stages in the order they run for each VM, old backups are
+# deleted before the export to free space on the export domain
+BACKUP_STAGES = (
+    ("snapshot", snapshot_stage),
+    ("clone", clone_stage),
+    ("retention", retention_stage),
+    ("export", export_stage),
+    ("cleanup", cleanup_stage),
+)
+
+# The backup stages of the backup API modes, no clone is made and old
+# backups are only deleted after the new one is complete
+TRANSFER_STAGES = (
+    ("transfer", transfer_stage),
+    ("retention", retention_stage),
+)
 
 
 def connect():
     global api
 
-    api = sdk.Connection(
-        url=config.get_server(),
-        username=config.get_username(),
-        password=config.get_password(),
-        insecure=True,
-        debug=False
-    )
+    # Every worker thread gets its own connection out of the pool, the SSO
+    # token is reused across runs if token_cache_file is set
+    token_cache = None
+    if config.get_token_cache_file():
+        token_cache = TokenCache(config.get_token_cache_file(), config.get_server(), config.get_username(),
+                                 config.get_token_ttl())
+    factory = sdk.Connection
+    if config.get_sdk_tracing():
+        factory = functools.partial(TracingConnection, tracer)
+    api = ConnectionPool(config, token_cache, factory)
+    try:
+        api.open()
+    except sdk.Error as e:
+        close_and_exit(err_msg=f"!!! Can't connect to the engine {config.get_server()}: {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import logging
+
+logger = logging.getLogger()
+
+
+def wait_all(futures):
+    """
+    Wait for requests which were sent with wait=False, the engine works on
+    all of them at the same time instead of one after the other
+    :param futures: Iterable of ovirtsdk futures
+    :return: List of the results in the order of the futures
+    :raises: The first error, after all requests are finished
+    """
+    results = []
+    error = None
+    for future in list(futures):
+        try:
+            results.append(future.wait())
+        except Exception as e:
+            # Every response is read, otherwise it would stay pending on the
+            # connection
+            logger.debug("Concurrent request failed: %s", e)
+            results.append(None)
+            error = error or e
+    if error is not None:
+        raise error
+    return results
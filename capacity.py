@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+from batch import wait_all
+from metrics import waiting
+from vmtools import VMTools
+from waiter import WaitTimeout, create_waiter
+
+logger = logging.getLogger()
+
+# Number of VMs whose disks are fetched with one request
+SIZES_CHUNK_SIZE = 50
+GIB = 1024 * 1024 * 1024
+
+
+class CapacityLedger(object):
+    """
+    Class which knows the disk sizes of all selected VMs and reserves the
+    space of their clones on the storage domain, so that backups running at
+    the same time can't overcommit it
+    """
+
+    def __init__(self, api, config, inventory):
+        """
+        :param api: ovirtsdk api
+        :param config: Configuration
+        :param inventory: Inventory to look up the storage domain
+        """
+        self._api = api
+        self._config = config
+        self._inventory = inventory
+        self._cond = threading.Condition()
+        self._unsized = []
+        self._sizes = {}
+        self._reservations = {}
+        # time.monotonic() when the clone of a reservation was finished
+        self._cloned = {}
+
+    def add_vms(self, vms):
+        """
+        Add selected VMs, their disk sizes are fetched in bulk on the next
+        lookup
+        :param vms: Iterable of VM objects
+        """
+        with self._cond:
+            self._unsized.extend(vm for vm in vms if vm.id not in self._sizes)
+
+    def _fetch(self):
+        """
+        Fetch the disks of all VMs added since the last lookup, with the
+        disks included in the VM listing, all chunks are requested at the
+        same time
+        """
+        vms, self._unsized = self._unsized, []
+        vms_service = self._api.system_service().vms_service()
+        excluded = self._config.get_disks_id_exclude()
+        terms = ["id=%s" % vm.id for vm in vms]
+        futures = [
+            vms_service.list(search=search, follow="disk_attachments.disk", wait=False)
+            for search, _ in VMTools.search_chunks(terms, "or", max_terms=SIZES_CHUNK_SIZE)
+        ]
+        for result in wait_all(futures):
+            for vm in result:
+                vm_size = 0
+                for disk_attachment in vm.disk_attachments or []:
+                    disk = disk_attachment.disk
+                    if disk.id in excluded:
+                        logger.info("excluded disk: %s", disk.id)
+                        continue
+                    # For safety reason "vm.actual_size" is not used
+                    if disk.provisioned_size is not None:
+                        vm_size += disk.provisioned_size
+                self._sizes[vm.id] = vm_size
+        logger.debug("Fetched the disk sizes of %s VMs", len(vms))
+
+    def size(self, vm):
+        """
+        :param vm: VM object
+        :return: Summarized provisioned size of the VM disks in bytes
+        """
+        with self._cond:
+            if vm.id not in self._sizes:
+                if not any(i.id == vm.id for i in self._unsized):
+                    self._unsized.append(vm)
+                self._fetch()
+            return self._sizes.get(vm.id, 0)
+
+    def _needed(self, vm_size):
+        storage_space_threshold = 0
+        if self._config.get_storage_space_threshold() > 0:
+            storage_space_threshold = self._config.get_storage_space_threshold()
+        return vm_size * (1 + storage_space_threshold)
+
+    def reserve(self, vm):
+        """
+        Reserve the space for the clone of the VM, waits while other
+        reservations don't leave enough free space
+        :param vm: VM object
+        :raises: Exception if the space isn't available even without other
+        reservations
+        """
+        vm_size = self.size(vm)
+        needed = self._needed(vm_size)
+        logger.info("VM SIZE: %s GiB", vm_size / GIB)
+        delays = create_waiter(self._config, "capacity").delays()
+        deadline = self._config.get_operation_deadline()
+        started = time.monotonic()
+        while True:
+            # The inventory can ask the engine, other reservations and
+            # releases don't wait for it
+            sd = self._inventory.storage_domain(self._config.get_storage_domain())
+            fetched = self._inventory.storage_domain_fetched(self._config.get_storage_domain())
+            with self._cond:
+                reserved = self._reserved(fetched)
+                if sd.available - reserved - needed > 0:
+                    self._reservations[vm.id] = needed
+                    return
+                if not self._reservations:
+                    raise Exception(
+                        "!!! The is not enough free storage on the storage domain '%s' available to backup the VM "
+                        "'%s', need at least %s GiB" % (self._config.get_storage_domain(), vm.name, needed / GIB))
+                logger.info("Waiting for %s GiB reserved by other backups to free space for VM %s",
+                            reserved / GIB, vm.name)
+                elapsed = time.monotonic() - started
+                if deadline and elapsed >= deadline:
+                    raise WaitTimeout("No free space for VM %s after %d seconds" % (vm.name, elapsed))
+                # Released reservations wake up early, space freed outside
+                # of the backup is seen after the inventory TTL
+                with waiting():
+                    self._cond.wait(next(delays))
+
+    def _reserved(self, fetched):
+        """
+        :param fetched: time.monotonic() when the available space of the
+        storage domain was fetched
+        :return: Reserved bytes which the available space doesn't account
+        for yet, the space of a clone finished before is already used
+        """
+        return sum(size for vm_id, size in self._reservations.items()
+                   if fetched is None or vm_id not in self._cloned or self._cloned[vm_id] > fetched)
+
+    def cloned(self, vm):
+        """
+        Mark the clone of the VM as finished, its reservation isn't counted
+        anymore once the storage domain was refreshed
+        :param vm: VM object, nothing happens without reservation
+        """
+        with self._cond:
+            if vm.id in self._reservations:
+                self._cloned[vm.id] = time.monotonic()
+
+    def release(self, vm):
+        """
+        Release the reservation of the VM after its clone was deleted
+        :param vm: VM object, nothing happens without reservation
+        """
+        with self._cond:
+            self._cloned.pop(vm.id, None)
+            if self._reservations.pop(vm.id, None) is not None:
+                self._cond.notify_all()
@@ -0,0 +1,216 @@
+import bisect
+import collections
+import json
+import logging
+import os
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger()
+
+# Raw bytes in one compressed frame, a restore reads at least one frame
+FRAME_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = ".idx"
+
+# File extension of every codec
+EXTENSIONS = {
+    "zstd": ".zst",
+    "lz4": ".lz4",
+    "zlib": ".zz",
+}
+
+
+def available_codecs():
+    """
+    :return: List of the codecs which can be used, the best first
+    """
+    codecs = []
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    codecs.append("zlib")
+    return codecs
+
+
+def select_codec(name):
+    """
+    :param name: Configured compression, "auto" selects the best available
+    codec
+    :return: The codec or None if the disks aren't compressed
+    :raises: Exception if the codec isn't installed
+    """
+    if name in ("", "none"):
+        return None
+    if name == "auto":
+        return available_codecs()[0]
+    if name not in available_codecs():
+        raise Exception("Compression %s isn't available, installed are: %s" % (name, ", ".join(available_codecs())))
+    return name
+
+
+def compress_frame(codec, data):
+    """
+    Compress one frame, runs in a process of the pool
+    :return: Tuple (compressed data, seconds spent)
+    """
+    started = time.process_time()
+    if codec == "zstd":
+        compressed = zstandard.ZstdCompressor().compress(data)
+    elif codec == "lz4":
+        compressed = lz4.frame.compress(data)
+    else:
+        compressed = zlib.compress(data, 6)
+    return compressed, time.process_time() - started
+
+
+def decompress_frame(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+class CompletedFrame(object):
+    """
+    Stands in for a future if frames are compressed without pool
+    """
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class CompressedWriter(object):
+    """
+    Class which compresses the chunks of a disk on a process pool into
+    independent frames and writes them in order, with an index of the raw
+    offset of every frame. Parts of the disk which are never written are
+    zeros.
+    """
+
+    def __init__(self, path, size, codec, pool=None, frame_size=FRAME_SIZE):
+        """
+        :param path: Target file without the extension of the codec
+        :param size: Size of the disk in bytes
+        :param codec: One of EXTENSIONS
+        :param pool: concurrent.futures executor, None compresses in the
+        calling thread
+        :param frame_size: Raw bytes in one frame
+        """
+        self.path = path + EXTENSIONS[codec]
+        self._size = size
+        self._codec = codec
+        self._pool = pool
+        self._frame_size = frame_size
+        # Frames in compression, bounded so that memory doesn't grow if the
+        # download is faster than the compression
+        self._pending = collections.deque()
+        self._max_pending = 2 * (os.cpu_count() or 1) if pool else 1
+        self._frames = []
+        self._file = open(self.path, "wb")
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    def write(self, offset, data):
+        """
+        :param offset: Offset of the data in the disk, must grow
+        :param data: The bytes
+        """
+        for i in range(0, len(data), self._frame_size):
+            frame = data[i:i + self._frame_size]
+            if self._pool is None:
+                future = CompletedFrame(compress_frame(self._codec, frame))
+            else:
+                future = self._pool.submit(compress_frame, self._codec, frame)
+            self._pending.append((offset + i, len(frame), future))
+            while len(self._pending) > self._max_pending:
+                self._write_frame()
+
+    def _write_frame(self):
+        raw_offset, raw_length, future = self._pending.popleft()
+        compressed, seconds = future.result()
+        self._frames.append((raw_offset, raw_length, self._file.tell(), len(compressed)))
+        self._file.write(compressed)
+        self.raw_bytes += raw_length
+        self.compressed_bytes += len(compressed)
+        self.seconds += seconds
+
+    def close(self):
+        while self._pending:
+            self._write_frame()
+        self._file.close()
+        with open(self.path + INDEX_SUFFIX, "w") as f:
+            json.dump({"codec": self._codec, "size": self._size, "frames": self._frames}, f)
+
+    def stats(self):
+        """
+        :return: Dict with the codec, compression ratio and the seconds
+        spent compressing, summed over all processes
+        """
+        return {
+            "codec": self._codec,
+            "ratio": round(self.raw_bytes / float(self.compressed_bytes), 2) if self.compressed_bytes else None,
+            "seconds": round(self.seconds, 2),
+        }
+
+    def describe(self):
+        """
+        :return: Entries of the disk in the manifest
+        """
+        return {"file": os.path.basename(self.path), "compression": self.stats()}
+
+
+class CompressedReader(object):
+    """
+    Class which reads any range of a compressed disk, only the frames of
+    the range are decompressed
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Compressed file with its extension
+        """
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        self.size = index["size"]
+        self._codec = index["codec"]
+        self._frames = index["frames"]
+        self._offsets = [i[0] for i in self._frames]
+        self._path = path
+
+    def read(self, offset, length):
+        """
+        :param offset: First byte in the disk
+        :param length: Number of bytes
+        :return: The bytes, zeros where no frame was written
+        """
+        result = bytearray(length)
+        end = offset + length
+        first = max(0, bisect.bisect_right(self._offsets, offset) - 1)
+        with open(self._path, "rb") as f:
+            for raw_offset, raw_length, file_offset, compressed_length in self._frames[first:]:
+                if raw_offset >= end:
+                    break
+                if raw_offset + raw_length <= offset:
+                    continue
+                f.seek(file_offset)
+                frame = decompress_frame(self._codec, f.read(compressed_length))
+                start = max(offset, raw_offset)
+                stop = min(end, raw_offset + raw_length)
+                result[start - offset:stop - offset] = frame[start - raw_offset:stop - raw_offset]
+        return bytes(result)
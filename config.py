@@ -14,6 +14,37 @@ DEFAULTS = {
     "logger_fmt": "%(asctime)s: %(message)s",
     "logger_file_path": None,
     "persist_memorystate": "false",
+    "parallel": "1",
+    "storage_domain_max_operations": "0",
+    "pipeline": "false",
+    "stage_concurrency": "{}",
+    "poll_intervals": "{}",
+    "operation_deadline": "0",
+    "event_tracking": "false",
+    "inventory_ttl": "60",
+    "vms_page_size": "100",
+    "retention_mode": "interleaved",
+    "retention_max_operations": "4",
+    "backup_order": "config",
+    "backup_mode": "export",
+    "backup_dir": "",
+    "transfer_connections": "4",
+    "require_consistency": "false",
+    "compression": "none",
+    "backup_format": "files",
+    "journal_file": "",
+    "history_file": "",
+    "adaptive_polling": "true",
+    "compression_workers": "0",
+    "backup_throughput": "100",
+    "connection_pool_size": "4",
+    "engine_connections": "4",
+    "engine_pipeline": "0",
+    "token_cache_file": "",
+    "token_ttl": "1800",
+    "metrics_report": "",
+    "metrics_textfile": "",
+    "sdk_tracing": "false",
 }
 
 
@@ -34,6 +65,7 @@ class Config(object):
 
             self.__vm_names = json.loads(config_parser.get(section, "vm_names", fallback="[]"))
             self.__vm_names_skip = json.loads(config_parser.get(section, "vm_names_skip", fallback="[]"))
+            self.__disks_id_exclude = json.loads(config_parser.get(section, "disks_id_exclude", fallback="[]"))
             self.__vm_tag = config_parser.get(section, "vm_tag", fallback=None)
             self.__all_vms = config_parser.getboolean(section, "all_vms", fallback=None)
             self.__vm_middle = config_parser.get(section, "vm_middle")
@@ -58,6 +90,37 @@ class Config(object):
             self.__logger_fmt = config_parser.get(section, "logger_fmt")
             self.__logger_file_path = config_parser.get(section, "logger_file_path")
             self.__persist_memorystate = config_parser.getboolean(section, "persist_memorystate")
+            self.__parallel = config_parser.getint(section, "parallel")
+            self.__storage_domain_max_operations = config_parser.getint(section, "storage_domain_max_operations")
+            self.__pipeline = config_parser.getboolean(section, "pipeline")
+            self.__stage_concurrency = json.loads(config_parser.get(section, "stage_concurrency"))
+            self.__poll_intervals = json.loads(config_parser.get(section, "poll_intervals"))
+            self.__operation_deadline = config_parser.getint(section, "operation_deadline")
+            self.__event_tracking = config_parser.getboolean(section, "event_tracking")
+            self.__inventory_ttl = config_parser.getint(section, "inventory_ttl")
+            self.__vms_page_size = config_parser.getint(section, "vms_page_size")
+            self.__retention_mode = config_parser.get(section, "retention_mode")
+            self.__retention_max_operations = config_parser.getint(section, "retention_max_operations")
+            self.__backup_order = config_parser.get(section, "backup_order")
+            self.__backup_mode = config_parser.get(section, "backup_mode")
+            self.__backup_dir = config_parser.get(section, "backup_dir")
+            self.__transfer_connections = config_parser.getint(section, "transfer_connections")
+            self.__require_consistency = config_parser.getboolean(section, "require_consistency")
+            self.__compression = config_parser.get(section, "compression")
+            self.__backup_format = config_parser.get(section, "backup_format")
+            self.__journal_file = config_parser.get(section, "journal_file")
+            self.__history_file = config_parser.get(section, "history_file")
+            self.__adaptive_polling = config_parser.getboolean(section, "adaptive_polling")
+            self.__compression_workers = config_parser.getint(section, "compression_workers")
+            self.__backup_throughput = config_parser.getfloat(section, "backup_throughput")
+            self.__connection_pool_size = config_parser.getint(section, "connection_pool_size")
+            self.__engine_connections = config_parser.getint(section, "engine_connections")
+            self.__engine_pipeline = config_parser.getint(section, "engine_pipeline")
+            self.__token_cache_file = config_parser.get(section, "token_cache_file")
+            self.__token_ttl = config_parser.getint(section, "token_ttl")
+            self.__metrics_report = config_parser.get(section, "metrics_report")
+            self.__metrics_textfile = config_parser.get(section, "metrics_textfile")
+            self.__sdk_tracing = config_parser.getboolean(section, "sdk_tracing")
         except (NoSectionError, NoOptionError) as e:
             print(str(e))
             sys.exit(1)
@@ -68,6 +131,9 @@ class Config(object):
     def get_vm_names_skip(self):
         return self.__vm_names_skip
 
+    def get_disks_id_exclude(self):
+        return self.__disks_id_exclude
+
     def set_vm_names(self, vms):
         self._cp.set(CONFIG_SECTION, 'vm_names', json.dumps(vms))
         self.__vm_names = vms[:]
@@ -82,9 +148,12 @@ class Config(object):
         return self.__vm_middle
 
     def clear_vm_suffix(self):
-        self.__vm_suffix = "_" + strftime("%Y%m%d_%H%M%S")
+        self.__vm_suffix = self.new_vm_suffix()
+
+    def new_vm_suffix(self):
         if self.__use_short_suffix:
-            self.__vm_suffix = "_" + strftime("%m%d%S")
+            return "_" + strftime("%m%d%S")
+        return "_" + strftime("%Y%m%d_%H%M%S")
 
     def get_vm_suffix(self):
         return self.__vm_suffix
@@ -150,6 +219,99 @@ class Config(object):
     def get_persist_memorystate(self):
         return self.__persist_memorystate
 
+    def get_parallel(self):
+        return self.__parallel
+
+    def get_storage_domain_max_operations(self):
+        return self.__storage_domain_max_operations
+
+    def get_pipeline(self):
+        return self.__pipeline
+
+    def get_stage_concurrency(self):
+        return self.__stage_concurrency
+
+    def get_poll_intervals(self):
+        return self.__poll_intervals
+
+    def get_operation_deadline(self):
+        return self.__operation_deadline
+
+    def get_event_tracking(self):
+        return self.__event_tracking
+
+    def get_inventory_ttl(self):
+        return self.__inventory_ttl
+
+    def get_vms_page_size(self):
+        return self.__vms_page_size
+
+    def get_retention_mode(self):
+        return self.__retention_mode
+
+    def get_retention_max_operations(self):
+        return self.__retention_max_operations
+
+    def get_backup_order(self):
+        return self.__backup_order
+
+    def get_backup_mode(self):
+        return self.__backup_mode
+
+    def get_backup_dir(self):
+        return self.__backup_dir
+
+    def get_transfer_connections(self):
+        return self.__transfer_connections
+
+    def get_require_consistency(self):
+        return self.__require_consistency
+
+    def get_compression(self):
+        return self.__compression
+
+    def get_backup_format(self):
+        return self.__backup_format
+
+    def get_journal_file(self):
+        return self.__journal_file
+
+    def get_history_file(self):
+        return self.__history_file
+
+    def get_adaptive_polling(self):
+        return self.__adaptive_polling
+
+    def get_compression_workers(self):
+        return self.__compression_workers
+
+    def get_backup_throughput(self):
+        return self.__backup_throughput
+
+    def get_connection_pool_size(self):
+        return self.__connection_pool_size
+
+    def get_engine_connections(self):
+        return self.__engine_connections
+
+    def get_engine_pipeline(self):
+        return self.__engine_pipeline
+
+    def get_token_cache_file(self):
+        return self.__token_cache_file
+
+    def get_token_ttl(self):
+        return self.__token_ttl
+
+    def get_metrics_report(self):
+        return self.__metrics_report
+
+    def get_metrics_textfile(self):
+        return self.__metrics_textfile
+
+    def get_sdk_tracing(self):
+        return self.__sdk_tracing
+
     def write_update(self, filename):
         """
         This method takes name of config file and update it according
@@ -0,0 +1,169 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import ovirtsdk4 as sdk
+
+logger = logging.getLogger()
+
+
+class TokenCache(object):
+    """
+    Class which keeps the SSO token of the engine in a file which only the
+    user can read, so that the next run doesn't log in again
+    """
+
+    def __init__(self, path, url, username, ttl):
+        """
+        :param path: Cache file
+        :param url: URL of the engine API, a token is only used for the
+        engine and user it was issued for
+        :param username: User name of the engine
+        :param ttl: Seconds after the last use after which the engine
+        expires the token
+        """
+        self._path = path
+        self._url = url
+        self._username = username
+        self._ttl = ttl
+
+    def load(self):
+        """
+        :return: The cached token or None if there is no valid one
+        """
+        try:
+            with open(self._path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("No cached SSO token: %s", e)
+            return None
+        if cached.get("url") != self._url or cached.get("username") != self._username:
+            return None
+        if time.time() - cached.get("used", 0) >= self._ttl:
+            logger.debug("Cached SSO token is expired")
+            return None
+        return cached.get("token")
+
+    def save(self, token):
+        """
+        Store the token, the file is created readable only by the user
+        :param token: SSO token, None removes the cached token
+        """
+        if token is None:
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            return
+        tmp_path = "%s.tmp" % self._path
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"url": self._url, "username": self._username, "token": token, "used": int(time.time())}, f)
+        os.replace(tmp_path, self._path)
+
+
+class ConnectionPool(object):
+    """
+    Class which stands in for sdk.Connection and gives every thread a
+    connection out of a pool. A connection handles one blocking request at
+    a time, with the pool the threads of the stages don't wait for each
+    other. All connections share one SSO token.
+    """
+
+    def __init__(self, config, token_cache=None, factory=sdk.Connection):
+        """
+        :param config: Configuration
+        :param token_cache: TokenCache, None logs in on every run and logs
+        out at the end
+        :param factory: Creates one connection, sdk.Connection
+        """
+        self._config = config
+        self._token_cache = token_cache
+        self._factory = factory
+        self._size = max(config.get_connection_pool_size(), 1)
+        self._lock = threading.Lock()
+        self._connections = [None] * self._size
+        self._next = itertools.count()
+        self._local = threading.local()
+        self._token = None
+
+    def _connect(self, token):
+        return self._factory(
+            url=self._config.get_server(),
+            username=self._config.get_username(),
+            password=self._config.get_password(),
+            token=token,
+            insecure=True,
+            debug=False,
+            connections=self._config.get_engine_connections(),
+            pipeline=self._config.get_engine_pipeline(),
+        )
+
+    def open(self):
+        """
+        Open the first connection, with the cached token if it is still
+        valid, otherwise the connection logs in
+        :raises: sdk.Error if the engine can't be reached
+        """
+        token = self._token_cache.load() if self._token_cache else None
+        connection = self._connect(token)
+        try:
+            # An expired token is replaced by the SDK on the first request
+            connection.test(raise_exception=True)
+        except Exception:
+            # The cached token is kept, the engine may only be unreachable
+            connection.close(logout=False)
+            raise
+        self._token = connection.authenticate()
+        if token is not None and token == self._token:
+            logger.debug("Reusing the cached SSO token")
+        self._connections[0] = connection
+        if self._token_cache:
+            self._token_cache.save(self._token)
+
+    def connection(self):
+        """
+        :return: The connection of the calling thread, threads are spread
+        evenly over the pool
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            index = next(self._next) % self._size
+            with self._lock:
+                if self._connections[index] is None:
+                    self._connections[index] = self._connect(self._token)
+                connection = self._local.connection = self._connections[index]
+        return connection
+
+    def system_service(self):
+        return self.connection().system_service()
+
+    def close(self):
+        """
+        Close all connections, the shared token is only revoked if it isn't
+        cached, tokens of later logins of single connections always
+        """
+        if self._connections[0] is None:
+            # Nothing was authenticated, the cached token stays
+            return
+        shared = self._token
+        if self._token_cache:
+            # The SDK replaces a token which expired during the run
+            self._token = self._connections[0].authenticate()
+        for index, connection in enumerate(self._connections):
+            if connection is None:
+                continue
+            if index == 0:
+                # The connections share the token, it is revoked once
+                logout = not self._token_cache
+            else:
+                # A connection which logged in again after the shared token
+                # expired holds a token of its own
+                logout = connection.authenticate() not in (shared, self._token)
+            try:
+                connection.close(logout=logout)
+            except sdk.Error as e:
+                logger.warning("Can't close the connection to the engine: %s", e)
+        if self._token_cache:
+            self._token_cache.save(self._token)
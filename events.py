@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import ovirtsdk4.types as types
+
+from batch import wait_all
+from metrics import waiting
+from waiter import WaitTimeout, create_waiter
+
+logger = logging.getLogger()
+
+# Seconds after which all running jobs are checked even without an event,
+# in case the engine suppressed an event because of its flood rate
+JOBS_CHECK_INTERVAL = 60
+
+
+@contextmanager
+def tracked(tracker, description):
+    """
+    Track an operation if an event tracker is used
+    :param tracker: EventTracker or None
+    :param description: Used for logging output
+    :return: TrackedOperation or None without tracker
+    """
+    if tracker is None:
+        yield None
+        return
+    with tracker.track(description) as operation:
+        yield operation
+
+
+class TrackedOperation(object):
+    """
+    Class which represents one operation tagged with a correlation id
+    """
+
+    def __init__(self, tracker, correlation_id, description):
+        self._tracker = tracker
+        self.correlation_id = correlation_id
+        self.description = description
+        # Pass this as query parameter to the ovirtsdk call
+        self.query = {"correlation_id": correlation_id}
+        self.status = None
+
+    def wait(self):
+        """
+        Wait till all engine jobs of the operation are finished
+        :raises: Exception if a job failed or was aborted
+        """
+        self._tracker.wait(self)
+
+
+class EventTracker(object):
+    """
+    Class which follows the event stream of the engine and resolves the
+    operations of the backup as soon as their jobs are finished
+    """
+
+    def __init__(self, api, config):
+        """
+        :param api: ovirtsdk api
+        :param config: Configuration
+        """
+        self._api = api
+        self._config = config
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._last_event = None
+        self._reset = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        events = self._api.system_service().events_service().list(max=1)
+        self._last_event = self._event_index(events[0]) if events else 0
+        self._thread = threading.Thread(target=self._run, name="event-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    @staticmethod
+    def _event_index(event):
+        return int(event.index if event.index is not None else event.id)
+
+    @contextmanager
+    def track(self, description):
+        """
+        Register a new operation, the ovirtsdk call has to be made inside
+        the with block and must get the query of the operation
+        :param description: Used for logging output
+        :return: TrackedOperation
+        """
+        operation = TrackedOperation(self, "oVirtBackup-%s" % uuid.uuid4().hex[:16], description)
+        with self._cond:
+            self._pending[operation.correlation_id] = operation
+            self._reset = True
+            self._cond.notify_all()
+        try:
+            yield operation
+        finally:
+            with self._cond:
+                self._pending.pop(operation.correlation_id, None)
+
+    def _new_events(self):
+        """
+        Fetch the events since the last seen one
+        :return: Set of correlation ids of pending operations which got an
+        event
+        """
+        events_service = self._api.system_service().events_service()
+        correlation_ids = set()
+        # The engine returns the newest events first, with max the oldest of
+        # them would be skipped, so all events since the last one are read
+        for event in events_service.list(from_=self._last_event):
+            self._last_event = max(self._last_event, self._event_index(event))
+            if event.correlation_id in self._pending:
+                logger.debug("Event %s for %s: %s", event.code, event.correlation_id, event.description)
+                correlation_ids.add(event.correlation_id)
+        return correlation_ids
+
+    def _check_jobs(self, correlation_ids):
+        """
+        Resolve the operations whose jobs are all finished
+        :param correlation_ids: Correlation ids to check
+        """
+        jobs_service = self._api.system_service().jobs_service()
+        correlation_ids = sorted(correlation_ids)
+        futures = [jobs_service.list(search="correlation_id=%s" % i, wait=False) for i in correlation_ids]
+        statuses = dict(
+            (correlation_id, [job.status for job in jobs])
+            for correlation_id, jobs in zip(correlation_ids, wait_all(futures))
+        )
+        with self._cond:
+            for correlation_id, job_statuses in statuses.items():
+                operation = self._pending.get(correlation_id)
+                # No job yet means the engine didn't start the operation
+                if operation is None or not job_statuses or types.JobStatus.STARTED in job_statuses:
+                    continue
+                if any(i in (types.JobStatus.FAILED, types.JobStatus.ABORTED) for i in job_statuses):
+                    operation.status = types.JobStatus.FAILED
+                else:
+                    operation.status = types.JobStatus.FINISHED
+                logger.debug("%s resolved by engine jobs: %s", operation.description, operation.status)
+            self._cond.notify_all()
+
+    def _run(self):
+        delays = create_waiter(self._config, "events").delays()
+        last_jobs_check = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            try:
+                correlation_ids = self._new_events()
+                if time.monotonic() - last_jobs_check >= JOBS_CHECK_INTERVAL:
+                    correlation_ids = set(self._pending)
+                    last_jobs_check = time.monotonic()
+                if correlation_ids:
+                    self._check_jobs(correlation_ids)
+            except Exception as e:
+                logger.warning("Event tracker can't read the engine events, retrying: %s", e)
+            with self._cond:
+                if self._reset:
+                    delays = create_waiter(self._config, "events").delays()
+                    self._reset = False
+                if not self._stopped:
+                    self._cond.wait(next(delays))
+
+    def wait(self, operation):
+        """
+        Wait till the operation is resolved
+        :param operation: TrackedOperation
+        :raises: Exception if a job of the operation failed
+        """
+        deadline = self._config.get_operation_deadline()
+        started = time.monotonic()
+        with waiting(), self._cond:
+            while operation.status is None:
+                if self._stopped:
+                    raise Exception("Event tracker stopped while waiting for %s" % operation.description)
+                elapsed = time.monotonic() - started
+                if deadline and elapsed >= deadline:
+                    raise WaitTimeout("%s not finished after %d seconds" % (operation.description, elapsed))
+                self._cond.wait(deadline - elapsed if deadline else None)
+        if operation.status != types.JobStatus.FINISHED:
+            raise Exception("%s failed, engine job status is %s" % (operation.description, operation.status))
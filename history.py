@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger()
+
+# Number of the last successful backups of a VM its estimate is based on
+HISTORY_RUNS = 5
+# Number of past durations of an operation of a VM which are needed before
+# its polling is adapted
+MIN_OPERATION_RUNS = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    failures INTEGER NOT NULL,
+    workers INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vms (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    vm TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    size INTEGER NOT NULL,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vms_vm ON vms (vm, run_id);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    vm TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    waiting REAL NOT NULL,
+    bytes INTEGER NOT NULL,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS operations (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    vm TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS operations_vm ON operations (vm, operation, run_id);
+"""
+
+
+class History(object):
+    """
+    Class which keeps the duration and size of every backup stage of every
+    VM of past runs in a SQLite database, the estimates of --plan are based
+    on it
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Database file, created if it doesn't exist
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def record_run(self, report, sizes, workers):
+        """
+        Add a run to the history
+        :param report: Dict of metrics.RunMetrics.report
+        :param sizes: Dict of the provisioned disk size in bytes by VM name
+        :param workers: Number of VMs which were backed up at the same time
+        """
+        with self._lock, self._db:
+            run_id = self._db.execute(
+                "INSERT INTO runs (started, finished, seconds, failures, workers) VALUES (?, ?, ?, ?, ?)",
+                (report["started"], report["finished"], report["seconds"], report["failures"], workers),
+            ).lastrowid
+            for vm_name, vm in report["vms"].items():
+                self._db.execute("INSERT INTO vms (run_id, vm, seconds, size, success) VALUES (?, ?, ?, ?, ?)",
+                                 (run_id, vm_name, vm["seconds"], sizes.get(vm_name, 0), int(vm["success"])))
+                for stage, timing in vm["stages"].items():
+                    self._db.execute(
+                        "INSERT INTO stages (run_id, vm, stage, seconds, waiting, bytes, result) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (run_id, vm_name, stage, timing["seconds"], timing["waiting"], timing["bytes"],
+                         timing["result"]),
+                    )
+                    self._db.executemany(
+                        "INSERT INTO operations (run_id, vm, stage, operation, seconds) VALUES (?, ?, ?, ?, ?)",
+                        [(run_id, vm_name, stage, operation, seconds)
+                         for operation, seconds in timing["operations"].items()],
+                    )
+        logger.debug("Run %s with %s VMs added to the history", run_id, len(report["vms"]))
+
+    def _successful(self, vm_name=None):
+        """
+        :param vm_name: Name of the VM, None for the last runs of all VMs
+        :return: List of tuples (seconds, size) of the last successful
+        backups
+        """
+        with self._lock:
+            if vm_name is not None:
+                return self._db.execute(
+                    "SELECT seconds, size FROM vms WHERE vm = ? AND success = 1 ORDER BY run_id DESC LIMIT ?",
+                    (vm_name, HISTORY_RUNS),
+                ).fetchall()
+            return self._db.execute(
+                "SELECT v.seconds, v.size FROM vms v WHERE v.success = 1 AND v.run_id IN "
+                "(SELECT id FROM runs ORDER BY id DESC LIMIT ?)",
+                (HISTORY_RUNS,),
+            ).fetchall()
+
+    def estimate(self, vm_name, size):
+        """
+        Estimate the duration of the backup of a VM from its last backups,
+        scaled to its current size, VMs without history get the rate of
+        all VMs of the last runs
+        :param vm_name: Name of the VM
+        :param size: Current provisioned disk size in bytes
+        :return: Tuple (seconds, source) with source "vm" or "all", None if
+        the history is empty
+        """
+        for source, rows in (("vm", self._successful(vm_name)), ("all", self._successful())):
+            if not rows:
+                continue
+            total_seconds = sum(i[0] for i in rows)
+            total_size = sum(i[1] for i in rows)
+            if total_size and size:
+                return total_seconds * size / float(total_size), source
+            # Without sizes a backup takes as long as the average one
+            return total_seconds / len(rows), source
+        return None
+
+    def shortest_duration(self, vm_name, operation):
+        """
+        :param vm_name: Name of the VM
+        :param operation: Name of the operation, e.g. "export", see
+        metrics.timed
+        :return: Shortest duration in seconds of the operation in the last
+        successful backups of the VM, None with less than MIN_OPERATION_RUNS
+        of them
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT SUM(o.seconds) FROM operations o JOIN vms v ON v.run_id = o.run_id AND v.vm = o.vm "
+                "WHERE o.vm = ? AND o.operation = ? AND v.success = 1 "
+                "GROUP BY o.run_id ORDER BY o.run_id DESC LIMIT ?",
+                (vm_name, operation, HISTORY_RUNS),
+            ).fetchall()
+        if len(rows) < MIN_OPERATION_RUNS:
+            return None
+        return min(i[0] for i in rows)
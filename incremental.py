@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import ovirtsdk4 as sdk
+import ovirtsdk4.types as types
+
+import transfer
+from journal import NullJournal
+from compression import CompressedWriter, select_codec
+from repository import Repository, RepositoryWriter
+from waiter import wait_for
+
+logger = logging.getLogger()
+
+MANIFEST = "manifest.json"
+
+# Every disk is a raw file, compressed if set
+FORMAT_FILES = "files"
+# The disks are split into chunks, every unique chunk is stored once
+FORMAT_REPOSITORY = "repository"
+CHECKPOINTS = "checkpoints.json"
+# Bytes after which the progress of a download is recorded in the journal
+JOURNAL_INTERVAL = 256 * 1024 * 1024
+
+
+def write_json(path, data):
+    """
+    Write a JSON file atomically, a crash leaves the old or the new file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointStore(object):
+    """
+    Class which keeps the last checkpoint of every VM in the backup
+    directory
+    """
+
+    def __init__(self, backup_dir):
+        """
+        :param backup_dir: Directory of the backups
+        """
+        self._path = os.path.join(backup_dir, CHECKPOINTS)
+        self._lock = threading.Lock()
+        self._checkpoints = {}
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                self._checkpoints = json.load(f)
+
+    def get(self, vm_id):
+        """
+        :param vm_id: Id of the VM
+        :return: Dict with the checkpoint id and the path of the backup which
+        created it, None if the VM has no checkpoint
+        """
+        with self._lock:
+            return self._checkpoints.get(vm_id)
+
+    def set(self, vm_id, checkpoint_id, backup_path):
+        """
+        :param vm_id: Id of the VM
+        :param checkpoint_id: Id of the checkpoint of the last backup
+        :param backup_path: Path of the last backup
+        """
+        with self._lock:
+            self._checkpoints[vm_id] = {"checkpoint": checkpoint_id, "backup": backup_path}
+            write_json(self._path, self._checkpoints)
+
+
+class EngineBackup(object):
+    """
+    Class which backs up the disks of a VM with the backup API of the engine
+    into a directory, incremental since the last checkpoint if possible
+    """
+
+    def __init__(self, api, config, checkpoints=None, pool=None, journal=None):
+        """
+        :param api: ovirtsdk api
+        :param config: Configuration
+        :param checkpoints: CheckpointStore, without it every backup is a
+        full backup
+        :param pool: Process pool which compresses the disks
+        :param journal: Journal which records the backups and the progress
+        of the downloads
+        """
+        self._api = api
+        self._config = config
+        self._checkpoints = checkpoints
+        self._journal = journal or NullJournal()
+        self._codec = select_codec(config.get_compression())
+        self._pool = pool
+        self._repository = None
+        if config.get_backup_format() == FORMAT_REPOSITORY:
+            self._repository = Repository(config.get_backup_dir(), self._codec)
+
+    def _writer(self, path, size, resume_offset):
+        """
+        :return: Tuple (writer, offset where the download continues)
+        """
+        if self._repository:
+            return RepositoryWriter(self._repository, path, size), 0
+        if self._codec:
+            return CompressedWriter(path, size, self._codec, self._pool), 0
+        # Only raw files can be continued behind their written data
+        if resume_offset and os.path.exists(path):
+            logger.info("Resuming download of %s at offset %s", path, resume_offset)
+            return transfer.RawWriter(path, size, resume=True), resume_offset
+        return transfer.RawWriter(path, size), 0
+
+    def _disks(self, vm_service):
+        disks_service = self._api.system_service().disks_service()
+        disks = []
+        for disk_attachment in vm_service.disk_attachments_service().list():
+            if disk_attachment.disk.id in self._config.get_disks_id_exclude():
+                logger.info("excluded disk: %s", disk_attachment.disk.id)
+                continue
+            disks.append(disks_service.disk_service(disk_attachment.disk.id).get())
+        return disks
+
+    def _parent(self, vm):
+        """
+        :return: Tuple (checkpoint id, path of its backup) or (None, None)
+        if a full backup is needed
+        """
+        checkpoint = self._checkpoints.get(vm.id) if self._checkpoints else None
+        if checkpoint is None:
+            return None, None
+        if not os.path.exists(os.path.join(checkpoint["backup"], MANIFEST)):
+            logger.warning("Backup %s of checkpoint %s is missing, full backup of VM %s",
+                           checkpoint["backup"], checkpoint["checkpoint"], vm.name)
+            return None, None
+        return checkpoint["checkpoint"], checkpoint["backup"]
+
+    def _start(self, vm, vm_service, disks, from_checkpoint_id):
+        backups_service = vm_service.backups_service()
+        try:
+            return backups_service.add(
+                types.Backup(
+                    disks=[types.Disk(id=disk.id) for disk in disks],
+                    from_checkpoint_id=from_checkpoint_id,
+                ),
+                require_consistency=self._config.get_require_consistency(),
+            )
+        except sdk.Error as e:
+            if from_checkpoint_id is None:
+                raise
+            # The engine doesn't know the checkpoint anymore, e.g. after a
+            # disk was restored or the VM was imported
+            logger.warning("Checkpoint %s of VM %s is broken, full backup instead: %s",
+                           from_checkpoint_id, vm.name, e)
+            return None
+
+    def _wait_backup(self, backup_service, phase, description):
+        def check():
+            try:
+                backup = backup_service.get()
+            except sdk.NotFoundError:
+                # Older engines remove the backup when it is finalized
+                if phase == types.BackupPhase.SUCCEEDED:
+                    return True
+                raise
+            if backup.phase == types.BackupPhase.FAILED:
+                raise Exception("%s failed" % description)
+            return backup if backup.phase == phase else None
+        return wait_for(self._config, "backup", check, description)
+
+    def _transfer_disk(self, vm, backup, disk, path, incremental, resume_offset=0):
+        """
+        Download one disk of a running backup
+        :param resume_offset: Offset till which an interrupted download was
+        written
+        :return: Tuple (number of bytes, list of changed ranges or None for a
+        full image, writer)
+        """
+        transfers_service = self._api.system_service().image_transfers_service()
+        image_transfer = transfers_service.add(
+            types.ImageTransfer(
+                disk=types.Disk(id=disk.id),
+                backup=types.Backup(id=backup.id),
+                direction=types.ImageTransferDirection.DOWNLOAD,
+                format=types.DiskFormat.RAW,
+            )
+        )
+        transfer_service = transfers_service.image_transfer_service(image_transfer.id)
+        description = "Transfer of disk %s" % disk.id
+
+        def transferring():
+            current = transfer_service.get()
+            if current.phase in (types.ImageTransferPhase.FINISHED_FAILURE, types.ImageTransferPhase.CANCELLED):
+                raise Exception("%s failed" % description)
+            return current if current.phase == types.ImageTransferPhase.TRANSFERRING else None
+
+        try:
+            image_transfer = wait_for(self._config, "transfer", transferring, description)
+            ranges = None
+            client = transfer.ImageioClient(image_transfer.transfer_url)
+            try:
+                if incremental:
+                    try:
+                        ranges = [(i["start"], i["length"]) for i in client.extents("dirty") if i["dirty"]]
+                    except transfer.TransferError as e:
+                        # A disk which was added after the checkpoint is backed up full
+                        logger.info("No changed blocks for disk %s, full image: %s", disk.id, e)
+                # Zero and unallocated extents aren't downloaded, they stay
+                # holes in the file
+                data = transfer.data_ranges(client)
+            finally:
+                client.close()
+            download_ranges = ranges if ranges is not None else [(0, disk.provisioned_size)]
+            if data is not None:
+                download_ranges = transfer.intersect_ranges(download_ranges, data)
+                logger.info("Disk %s has %s bytes of data, size is %s", disk.id, sum(i[1] for i in data),
+                            disk.provisioned_size)
+            writer, offset = self._writer(path, disk.provisioned_size, resume_offset)
+            recorded = [offset]
+
+            def progress(end):
+                if end - recorded[0] >= JOURNAL_INTERVAL:
+                    writer.sync()
+                    self._journal.record(vm.name, "transfer", disk=disk.id, offset=end)
+                    recorded[0] = end
+            try:
+                transferred = transfer.download(image_transfer.transfer_url, writer, disk.provisioned_size,
+                                                transfer.clip_ranges(download_ranges, offset),
+                                                connections=self._config.get_transfer_connections(),
+                                                progress=progress if hasattr(writer, "sync") else None)
+            finally:
+                writer.close()
+        except Exception:
+            transfer_service.cancel()
+            raise
+        transfer_service.finalize()
+        return transferred, ranges, writer
+
+    def _adopt(self, vm, vm_service, resume):
+        """
+        Adopt the engine backup of a crashed run if it is still ready
+        :param resume: VmState from the journal
+        :return: Tuple (backup, manifest) or (None, None)
+        """
+        backup_id = resume.fields["manifest"]["backup_id"]
+        try:
+            backup = vm_service.backups_service().backup_service(backup_id).get()
+        except sdk.Error as e:
+            logger.info("Backup %s of VM %s can't be resumed: %s", backup_id, vm.name, e)
+            return None, None
+        if backup.phase != types.BackupPhase.READY:
+            logger.info("Backup %s of VM %s can't be resumed, it is %s", backup_id, vm.name, backup.phase)
+            return None, None
+        manifest = resume.fields["manifest"]
+        manifest["disks"] = [i["entry"] for i in resume.disks.values() if "entry" in i]
+        logger.info("Resuming %s backup of VM %s, %s disks are done", manifest["mode"], vm.name,
+                    len(manifest["disks"]))
+        return backup, manifest
+
+    def _finalize_open(self, vm, vm_service):
+        """
+        Finalize the backups of the VM which an earlier run left open, e.g.
+        a failed run with journal which isn't resumed, the engine doesn't
+        start a new backup while one is open
+        """
+        backups_service = vm_service.backups_service()
+        for backup in backups_service.list():
+            if backup.phase in (types.BackupPhase.SUCCEEDED, types.BackupPhase.FAILED):
+                continue
+            logger.info("Finalizing backup %s of VM %s left open by an earlier run", backup.id, vm.name)
+            backup_service = backups_service.backup_service(backup.id)
+            description = "Finalize backup of VM (%s)" % vm.name
+            if backup.phase != types.BackupPhase.FINALIZING:
+                self._wait_backup(backup_service, types.BackupPhase.READY, description)
+                backup_service.finalize()
+            self._wait_backup(backup_service, types.BackupPhase.SUCCEEDED, description)
+
+    def run(self, vm, backup_path, resume=None):
+        """
+        Back up all disks of the VM
+        :param vm: VM object
+        :param backup_path: New directory for the backup
+        :param resume: VmState of a crashed run from the journal, its backup
+        is continued if the engine still has it
+        :return: Manifest of the backup
+        """
+        vm_service = self._api.system_service().vms_service().vm_service(vm.id)
+        disks = self._disks(vm_service)
+        backup, manifest = None, None
+        if resume and "manifest" in resume.fields:
+            backup, manifest = self._adopt(vm, vm_service, resume)
+            if backup is None and os.path.exists(backup_path):
+                # The incomplete backup of the crashed run
+                shutil.rmtree(backup_path)
+        if backup is None:
+            self._finalize_open(vm, vm_service)
+            from_checkpoint_id, parent = self._parent(vm)
+            backup = self._start(vm, vm_service, disks, from_checkpoint_id)
+            if backup is None:
+                from_checkpoint_id, parent = None, None
+                backup = self._start(vm, vm_service, disks, None)
+            mode = "incremental" if from_checkpoint_id else "full"
+            logger.info("%s backup of VM %s started", mode.capitalize(), vm.name)
+            os.makedirs(backup_path)
+            manifest = {
+                "vm": vm.name,
+                "vm_id": vm.id,
+                "backup_id": backup.id,
+                "mode": mode,
+                "from_checkpoint": from_checkpoint_id,
+                "parent": parent,
+                "created": int(time.time()),
+                "disks": [],
+            }
+            self._journal.record(vm.name, "backup", backup_path=backup_path, manifest=manifest)
+        mode = manifest["mode"]
+        done = set(i["id"] for i in manifest["disks"])
+        backup_service = vm_service.backups_service().backup_service(backup.id)
+        try:
+            # The id of the new checkpoint is known when the backup is ready
+            backup = self._wait_backup(backup_service, types.BackupPhase.READY, "Backup of VM (%s)" % vm.name)
+            for disk in disks:
+                if disk.id in done:
+                    continue
+                path = os.path.join(backup_path, "%s.raw" % disk.id)
+                resume_offset = resume.disks.get(disk.id, {}).get("offset", 0) if resume else 0
+                transferred, ranges, writer = self._transfer_disk(vm, backup, disk, path, mode == "incremental",
+                                                                  resume_offset)
+                entry = {
+                    "id": disk.id,
+                    "name": disk.alias or disk.name,
+                    "size": disk.provisioned_size,
+                    "ranges": ranges,
+                    "transferred": transferred,
+                }
+                entry.update(writer.describe())
+                manifest["disks"].append(entry)
+                self._journal.record(vm.name, "disk", disk=disk.id, entry=entry)
+        except Exception:
+            if not isinstance(self._journal, NullJournal):
+                # The backup stays ready and is continued with --resume
+                logger.info("Backup %s of VM %s is left ready for --resume", backup.id, vm.name)
+                raise
+            # Without a journal nothing continues the backup, the engine
+            # keeps the VM in backup until it is finalized
+            try:
+                backup_service.finalize()
+            except Exception as e:
+                logger.warning("Can't finalize backup %s of VM %s: %s", backup.id, vm.name, e)
+            raise
+        backup_service.finalize()
+        self._wait_backup(backup_service, types.BackupPhase.SUCCEEDED, "Finalize backup of VM (%s)" % vm.name)
+        manifest["checkpoint"] = backup.to_checkpoint_id
+        write_json(os.path.join(backup_path, MANIFEST), manifest)
+        # Only a complete backup can be the parent of the next incremental
+        if backup.to_checkpoint_id and self._checkpoints:
+            self._checkpoints.set(vm.id, backup.to_checkpoint_id, backup_path)
+        logger.info("%s backup of VM %s done, %s bytes transferred", mode.capitalize(), vm.name,
+                    sum(i["transferred"] for i in manifest["disks"]))
+        return manifest
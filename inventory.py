@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+from batch import wait_all
+
+logger = logging.getLogger()
+
+
+class Inventory(object):
+    """
+    Class which fetches data centers, clusters, storage domains and VMs in
+    bulk once per run and serves the lookups by name from memory.
+    Only storage domains, whose state changes during the run, are refreshed
+    after the TTL.
+    """
+
+    def __init__(self, api, ttl):
+        """
+        :param api: ovirtsdk api
+        :param ttl: Seconds after which the state of a storage domain is
+        fetched again
+        """
+        self._api = api
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        self._data_centers = None
+        self._clusters = None
+        self._storage_domains = None
+        self._attached_storage_domains = {}
+        self._vms = None
+
+    @staticmethod
+    def _index(objects):
+        return dict((i.name, i) for i in objects)
+
+    def preload(self, attached_data_centers=()):
+        """
+        Fetch data centers, clusters and storage domains with requests which
+        run at the same time, afterwards the checks at startup are served
+        from memory
+        :param attached_data_centers: Names of the data centers whose
+        attached storage domains are fetched too
+        """
+        system_service = self._api.system_service()
+        dcs_service = system_service.data_centers_service()
+        with self._lock:
+            fetched = time.monotonic()
+            data_centers, clusters, storage_domains = wait_all([
+                dcs_service.list(wait=False),
+                system_service.clusters_service().list(wait=False),
+                system_service.storage_domains_service().list(wait=False),
+            ])
+            self._data_centers = self._index(data_centers)
+            self._clusters = self._index(clusters)
+            self._storage_domains = dict((i.name, (i, fetched)) for i in storage_domains)
+            names = [i for i in attached_data_centers if i in self._data_centers]
+            fetched = time.monotonic()
+            attached = wait_all([
+                dcs_service.data_center_service(self._data_centers[i].id).storage_domains_service().list(wait=False)
+                for i in names
+            ])
+            for name, sds in zip(names, attached):
+                self._attached_storage_domains[name] = dict((i.name, (i, fetched)) for i in sds)
+            logger.debug("Inventory loaded %s data centers, %s clusters and %s storage domains",
+                         len(self._data_centers), len(self._clusters), len(self._storage_domains))
+
+    def _expired(self, fetched):
+        return time.monotonic() - fetched >= self._ttl
+
+    def data_center(self, name):
+        """
+        :param name: Name of the data center
+        :return: Data center object or None if it doesn't exist
+        """
+        with self._lock:
+            if self._data_centers is None:
+                self._data_centers = self._index(self._api.system_service().data_centers_service().list())
+                logger.debug("Inventory loaded %s data centers", len(self._data_centers))
+            return self._data_centers.get(name)
+
+    def cluster(self, name):
+        """
+        :param name: Name of the cluster
+        :return: Cluster object or None if it doesn't exist
+        """
+        with self._lock:
+            if self._clusters is None:
+                self._clusters = self._index(self._api.system_service().clusters_service().list())
+                logger.debug("Inventory loaded %s clusters", len(self._clusters))
+            return self._clusters.get(name)
+
+    def storage_domain(self, name):
+        """
+        :param name: Name of the storage domain
+        :return: Storage domain object, e.g. with the available space, or
+        None if it doesn't exist
+        """
+        with self._lock:
+            sds_service = self._api.system_service().storage_domains_service()
+            if self._storage_domains is None:
+                fetched = time.monotonic()
+                self._storage_domains = dict(
+                    (i.name, (i, fetched)) for i in sds_service.list()
+                )
+                logger.debug("Inventory loaded %s storage domains", len(self._storage_domains))
+            if name not in self._storage_domains:
+                return None
+            sd, fetched = self._storage_domains[name]
+            if self._expired(fetched):
+                sd = sds_service.storage_domain_service(sd.id).get()
+                self._storage_domains[name] = (sd, time.monotonic())
+            return sd
+
+    def storage_domain_fetched(self, name):
+        """
+        :param name: Name of the storage domain
+        :return: time.monotonic() when the state of the storage domain
+        returned by storage_domain was fetched, None if it isn't loaded
+        """
+        with self._lock:
+            if self._storage_domains is None or name not in self._storage_domains:
+                return None
+            return self._storage_domains[name][1]
+
+    def attached_storage_domain(self, data_center_name, name):
+        """
+        :param data_center_name: Name of the data center
+        :param name: Name of the storage domain
+        :return: Storage domain object as attached to the data center, e.g.
+        with its status in the data center, or None if it isn't attached
+        """
+        with self._lock:
+            dc = self.data_center(data_center_name)
+            if dc is None:
+                return None
+            dcs_service = self._api.system_service().data_centers_service()
+            sds_service = dcs_service.data_center_service(dc.id).storage_domains_service()
+            if data_center_name not in self._attached_storage_domains:
+                fetched = time.monotonic()
+                self._attached_storage_domains[data_center_name] = dict(
+                    (i.name, (i, fetched)) for i in sds_service.list()
+                )
+            attached = self._attached_storage_domains[data_center_name]
+            if name not in attached:
+                return None
+            sd, fetched = attached[name]
+            if self._expired(fetched):
+                sd = sds_service.storage_domain_service(sd.id).get()
+                attached[name] = (sd, time.monotonic())
+            return sd
+
+    def add_vms(self, vms):
+        """
+        Add already fetched VMs to the index, afterwards the list of all
+        VMs isn't fetched anymore
+        :param vms: Iterable of VM objects
+        """
+        with self._lock:
+            if self._vms is None:
+                self._vms = {}
+            for vm in vms:
+                self._vms[vm.name] = vm
+
+    def vm(self, name):
+        """
+        :param name: Name of the VM
+        :return: VM object or None if it doesn't exist
+        """
+        with self._lock:
+            if self._vms is None:
+                self.add_vms(self._api.system_service().vms_service().list())
+                logger.debug("Inventory loaded %s VMs", len(self._vms))
+            return self._vms.get(name)
@@ -0,0 +1,118 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Event which ends the journal of a VM, a resumed run starts it from scratch
+DONE = "done"
+
+
+class VmState(object):
+    """
+    Class which holds what the journal knows about the unfinished backup of
+    one VM
+    """
+
+    def __init__(self):
+        # Events which were recorded, e.g. completed stages
+        self.events = set()
+        # Fields of all records, later records override earlier ones
+        self.fields = {}
+        # Fields of the records of every disk by disk id
+        self.disks = {}
+
+    def apply(self, record):
+        self.events.add(record["event"])
+        fields = dict((k, v) for k, v in record.items() if k not in ("time", "vm", "event"))
+        disk_id = fields.pop("disk", None)
+        if disk_id is None:
+            self.fields.update(fields)
+        else:
+            self.disks.setdefault(disk_id, {}).update(fields)
+
+
+class Journal(object):
+    """
+    Class which appends every step of the backups to a JSON lines file, so
+    that a run with --resume can adopt the snapshots, clones and transfers
+    of a crashed run
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        :param path: Journal file
+        :param resume: Read the journal of the last run, otherwise it is
+        started anew
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._states = {}
+        if resume and os.path.exists(path):
+            self._replay()
+        mode = "a" if resume else "w"
+        self._file = open(path, mode)
+
+    def _replay(self):
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a crashed run can be incomplete
+                    logger.warning("Ignoring incomplete journal line: %s", line.strip())
+                    continue
+                if record["event"] == DONE:
+                    self._states.pop(record["vm"], None)
+                else:
+                    self._states.setdefault(record["vm"], VmState()).apply(record)
+        if self._states:
+            logger.info("Journal has unfinished backups of: %s", ", ".join(sorted(self._states)))
+
+    def record(self, vm_name, event, **fields):
+        """
+        Append a record and write it to the disk
+        :param vm_name: Name of the VM
+        :param event: What happened, e.g. the name of a completed stage
+        :param fields: Ids and offsets to remember, with disk=<id> they
+        belong to a disk
+        """
+        record = dict(fields, time=int(time.time()), vm=vm_name, event=event)
+        with self._lock:
+            self._file.write(json.dumps(record, sort_keys=True) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if event == DONE:
+                self._states.pop(vm_name, None)
+            else:
+                self._states.setdefault(vm_name, VmState()).apply(record)
+
+    def state(self, vm_name):
+        """
+        :param vm_name: Name of the VM
+        :return: VmState of the unfinished backup of the VM, None if there
+        is nothing to resume
+        """
+        with self._lock:
+            return copy.deepcopy(self._states.get(vm_name))
+
+    def close(self):
+        self._file.close()
+
+
+class NullJournal(object):
+    """
+    Stands in for the journal if no journal_file is set
+    """
+
+    def record(self, vm_name, event, **fields):
+        pass
+
+    def state(self, vm_name):
+        return None
+
+    def close(self):
+        pass
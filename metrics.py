@@ -0,0 +1,275 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# Timing of the stage which runs in the current thread
+_local = threading.local()
+
+PREFIX = "ovirt_backup"
+
+
+class StageTiming(object):
+    """
+    Class which holds what one stage of one VM spent
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.seconds = 0.0
+        # Seconds spent waiting for the engine, free space or operation
+        # slots, the rest of the wall time is working
+        self.waiting = 0.0
+        self.bytes = 0
+        # Seconds of the operations of the helpers, e.g. snapshot deletions
+        self.operations = {}
+        self.result = None
+
+    def to_dict(self):
+        return {
+            "seconds": round(self.seconds, 3),
+            "waiting": round(self.waiting, 3),
+            "working": round(max(self.seconds - self.waiting, 0), 3),
+            "bytes": self.bytes,
+            "operations": dict((k, round(v, 3)) for k, v in self.operations.items()),
+            "result": self.result,
+        }
+
+
+def _current():
+    return getattr(_local, "timing", None)
+
+
+@contextmanager
+def waiting():
+    """
+    Count the time of the block as waiting time of the current stage, nested
+    waits are counted once
+    """
+    timing = _current()
+    if timing is None or getattr(_local, "waiting", False):
+        yield
+        return
+    _local.waiting = True
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timing.waiting += time.monotonic() - started
+        _local.waiting = False
+
+
+@contextmanager
+def timed(operation):
+    """
+    Count the time of the block as an operation of the current stage
+    :param operation: Name of the operation, e.g. "snapshot_deletion"
+    """
+    timing = _current()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.operations[operation] = timing.operations.get(operation, 0.0) + time.monotonic() - started
+
+
+def add_bytes(count):
+    """
+    Add bytes moved by the current stage
+    :param count: Number of bytes
+    """
+    timing = _current()
+    if timing is not None:
+        timing.bytes += count
+
+
+class RunMetrics(object):
+    """
+    Class which collects the timing of every stage of every VM and writes
+    the run report as JSON and as Prometheus textfile
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        # Stages by VM name, in the order the VMs started
+        self._vms = {}
+        # Stages which run once for all VMs, e.g. retention at the end
+        self._run_stages = {}
+
+    @contextmanager
+    def stage(self, vm_name, name):
+        """
+        Time a stage, waits and operations in the block are added to it
+        :param vm_name: Name of the VM, None for a stage of the whole run
+        :param name: Name of the stage
+        :return: StageTiming
+        """
+        timing = StageTiming(name)
+        with self._lock:
+            stages = self._run_stages if vm_name is None else self._vms.setdefault(vm_name, {})
+            stages[name] = timing
+        previous = _current()
+        _local.timing = timing
+        started = time.monotonic()
+        try:
+            yield timing
+        except BaseException:
+            timing.result = "error"
+            raise
+        finally:
+            timing.seconds = time.monotonic() - started
+            timing.finished = timing.started + timing.seconds
+            _local.timing = previous
+
+    def instrument(self, name, function):
+        """
+        :param name: Name of the stage
+        :param function: Stage function which gets a BackupJob
+        :return: Stage function which records the timing of the stage
+        """
+        def stage_function(job):
+            with self.stage(job.vm_name, name) as timing:
+                proceed = function(job)
+                timing.result = "ok" if proceed else "stopped"
+                return proceed
+        return stage_function
+
+    def vm_seconds(self, vm_name):
+        """
+        :return: Wall time of the VM from the start of its first stage till
+        the end of its last stage, a running stage counts till now
+        """
+        with self._lock:
+            stages = list(self._vms.get(vm_name, {}).values())
+        if not stages:
+            return 0.0
+        now = time.time()
+        return max(i.finished or now for i in stages) - min(i.started for i in stages)
+
+    def report(self, failed_vms=()):
+        """
+        :param failed_vms: Names of the VMs whose backup failed
+        :return: Dict with the run, every VM and the totals of every stage
+        """
+        if self.finished is None:
+            self.finished = time.time()
+        totals = {}
+        vms = {}
+        with self._lock:
+            for vm_name, stages in self._vms.items():
+                for timing in stages.values():
+                    total = totals.setdefault(timing.name, {"seconds": 0.0, "waiting": 0.0, "bytes": 0, "vms": 0})
+                    total["seconds"] += timing.seconds
+                    total["waiting"] += timing.waiting
+                    total["bytes"] += timing.bytes
+                    total["vms"] += 1
+                vms[vm_name] = {
+                    "seconds": None,
+                    "success": vm_name not in failed_vms,
+                    "stages": dict((name, timing.to_dict()) for name, timing in stages.items()),
+                }
+            run_stages = dict((name, timing.to_dict()) for name, timing in self._run_stages.items())
+        for vm_name, vm in vms.items():
+            vm["seconds"] = round(self.vm_seconds(vm_name), 3)
+        return {
+            "started": int(self.started),
+            "finished": int(self.finished),
+            "seconds": round(self.finished - self.started, 3),
+            "failures": len(failed_vms),
+            "vms": vms,
+            "stages": dict((name, dict(total, seconds=round(total["seconds"], 3),
+                                       waiting=round(total["waiting"], 3)))
+                           for name, total in totals.items()),
+            "run_stages": run_stages,
+        }
+
+
+def _write_atomic(path, content):
+    # The node exporter must never read a half written file
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, report):
+    """
+    :param path: Target file
+    :param report: Dict of RunMetrics.report
+    """
+    _write_atomic(path, json.dumps(report, indent=2, sort_keys=True) + "\n")
+    logger.info("Run report written to %s", path)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_textfile(report):
+    """
+    :param report: Dict of RunMetrics.report
+    :return: Metrics in the text format of Prometheus
+    """
+    metrics = [
+        ("run_start_timestamp_seconds", "Start of the last backup run", [({}, report["started"])]),
+        ("run_end_timestamp_seconds", "End of the last backup run", [({}, report["finished"])]),
+        ("run_seconds", "Wall time of the last backup run", [({}, report["seconds"])]),
+        ("run_failures", "VMs whose backup failed in the last run", [({}, report["failures"])]),
+        ("vm_seconds", "Wall time of the backup of a VM",
+         [({"vm": vm_name}, vm["seconds"]) for vm_name, vm in report["vms"].items()]),
+        ("vm_success", "1 if the backup of a VM succeeded",
+         [({"vm": vm_name}, int(vm["success"])) for vm_name, vm in report["vms"].items()]),
+    ]
+    samples = dict((key, []) for key in ("seconds", "waiting", "bytes"))
+    for vm_name, vm in report["vms"].items():
+        for stage, timing in vm["stages"].items():
+            for key in samples:
+                samples[key].append(({"vm": vm_name, "stage": stage}, timing[key]))
+    for stage, timing in report["run_stages"].items():
+        for key in samples:
+            samples[key].append(({"vm": "", "stage": stage}, timing[key]))
+    metrics.extend([
+        ("stage_seconds", "Wall time of a backup stage", samples["seconds"]),
+        ("stage_waiting_seconds", "Part of the wall time of a stage spent waiting", samples["waiting"]),
+        ("stage_bytes", "Bytes moved by a backup stage", samples["bytes"]),
+    ])
+    lines = []
+    for name, description, values in metrics:
+        lines.append("# HELP %s_%s %s" % (PREFIX, name, description))
+        lines.append("# TYPE %s_%s gauge" % (PREFIX, name))
+        lines.extend(_sample(name, labels, value) for labels, value in values)
+    if report.get("sdk_calls"):
+        # Latency percentiles of the REST calls, see tracing.CallTracer
+        name = "sdk_call_seconds"
+        lines.append("# HELP %s_%s Latency of the REST calls to the engine by endpoint" % (PREFIX, name))
+        lines.append("# TYPE %s_%s summary" % (PREFIX, name))
+        for endpoint, calls in sorted(report["sdk_calls"].items()):
+            for key in sorted(i for i in calls if i.startswith("p")):
+                lines.append(_sample(name, {"endpoint": endpoint, "quantile": int(key[1:]) / 100.0}, calls[key]))
+            lines.append(_sample(name + "_sum", {"endpoint": endpoint}, calls["seconds"]))
+            lines.append(_sample(name + "_count", {"endpoint": endpoint}, calls["calls"]))
+    return "\n".join(lines) + "\n"
+
+
+def _sample(name, labels, value):
+    rendered = ",".join('%s="%s"' % (k, _label(v)) for k, v in sorted(labels.items()))
+    return "%s_%s%s %s" % (PREFIX, name, "{%s}" % rendered if rendered else "", value)
+
+
+def write_textfile(path, report):
+    """
+    :param path: Target file in the textfile directory of the node exporter,
+    must end with .prom
+    :param report: Dict of RunMetrics.report
+    """
+    _write_atomic(path, to_textfile(report))
+    logger.info("Prometheus metrics written to %s", path)
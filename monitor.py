@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+
+from batch import wait_all
+from metrics import waiting
+from waiter import WaitTimeout, create_waiter, learned_delay
+
+logger = logging.getLogger()
+
+# Number of ids in one search query, keeps the URL short
+SEARCH_CHUNK_SIZE = 50
+
+
+class StatusMonitor(object):
+    """
+    Class which polls the status of all watched VMs and snapshots with one
+    search query per tick and wakes the threads waiting for them
+    """
+
+    def __init__(self, api, config):
+        """
+        :param api: ovirtsdk api
+        :param config: Configuration
+        """
+        self._api = api
+        self._config = config
+        self._cond = threading.Condition()
+        self._watches = {}
+        self._polled = set()
+        self._vms = {}
+        self._snapshots = {}
+        self._tick = 0
+        self._reset = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="status-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def _poll(self, watches):
+        """
+        Fetch the status of all watched objects, the requests of each kind
+        are sent at the same time
+        :param watches: Iterable of tuples (vm_id, snapshot_id)
+        :return: Tuple of dicts, VMs by id and snapshots by VM id and id
+        """
+        vms_service = self._api.system_service().vms_service()
+        vm_ids = sorted(set(vm_id for vm_id, _ in watches))
+        vms = {}
+        futures = [
+            vms_service.list(search=" or ".join("id=%s" % vm_id for vm_id in vm_ids[i:i + SEARCH_CHUNK_SIZE]),
+                             wait=False)
+            for i in range(0, len(vm_ids), SEARCH_CHUNK_SIZE)
+        ]
+        for result in wait_all(futures):
+            for vm in result:
+                vms[vm.id] = vm
+        # Snapshots are only listed for VMs which have a snapshot operation
+        snapshot_vm_ids = sorted(set(vm_id for vm_id, snapshot_id in watches if snapshot_id and vm_id in vms))
+        futures = [vms_service.vm_service(vm_id).snapshots_service().list(wait=False) for vm_id in snapshot_vm_ids]
+        snapshots = dict(
+            (vm_id, dict((snap.id, snap) for snap in result))
+            for vm_id, result in zip(snapshot_vm_ids, wait_all(futures))
+        )
+        logger.debug("Status monitor polled %s VMs, %s with snapshots", len(vm_ids), len(snapshots))
+        return vms, snapshots
+
+    def _run(self):
+        delays = create_waiter(self._config, "monitor").delays()
+        while True:
+            with self._cond:
+                while not self._watches and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                watches = dict(self._watches)
+            try:
+                vms, snapshots = self._poll(watches.values())
+            except Exception as e:
+                logger.warning("Status monitor can't poll the engine, retrying: %s", e)
+                vms, snapshots = None, None
+            with self._cond:
+                if vms is not None:
+                    self._vms = vms
+                    self._snapshots = snapshots
+                    self._polled = set(watches)
+                    self._tick += 1
+                    self._cond.notify_all()
+                if self._reset:
+                    # A new operation started, check it soon
+                    delays = create_waiter(self._config, "monitor").delays()
+                    self._reset = False
+                if not self._stopped:
+                    self._cond.wait(next(delays))
+
+    def _wait(self, vm_id, snapshot_id, condition, description, expected=None):
+        key = object()
+        deadline = self._config.get_operation_deadline()
+        started = time.monotonic()
+        first = learned_delay(expected, create_waiter(self._config, "monitor").initial)
+        with waiting(), self._cond:
+            if first:
+                # The object isn't part of the polls before the operation is
+                # expected to be finished
+                self._cond.wait_for(lambda: self._stopped, min(first, deadline) if deadline else first)
+            self._watches[key] = (vm_id, snapshot_id)
+            self._reset = True
+            if len(self._watches) == 1:
+                self._cond.notify_all()
+            try:
+                tick = self._tick
+                while True:
+                    # Only results of a poll which included this watch count
+                    self._cond.wait_for(lambda: (self._tick != tick and key in self._polled) or self._stopped)
+                    if self._stopped:
+                        raise Exception("Status monitor stopped while waiting for %s" % description)
+                    tick = self._tick
+                    if snapshot_id:
+                        result = self._snapshots.get(vm_id, {}).get(snapshot_id)
+                    else:
+                        result = self._vms.get(vm_id)
+                    if condition(result):
+                        return result
+                    elapsed = time.monotonic() - started
+                    if deadline and elapsed >= deadline:
+                        raise WaitTimeout("%s not finished after %d seconds" % (description, elapsed))
+                    logger.debug("%s in progress ...", description)
+            finally:
+                del self._watches[key]
+
+    def wait_vm(self, vm_id, condition, description="VM operation", expected=None):
+        """
+        Wait till the condition is true for a VM
+        :param vm_id: Id of the VM
+        :param condition: Callable which gets the VM or None if the VM
+        doesn't exist
+        :param description: Used for debugging output
+        :param expected: Seconds the operation took at least in the past,
+        the VM is polled from shortly before, None polls it right away
+        :return: The VM or None
+        """
+        return self._wait(vm_id, None, condition, description, expected)
+
+    def wait_snapshot(self, vm_id, snapshot_id, condition, description="Snapshot operation", expected=None):
+        """
+        Wait till the condition is true for a snapshot
+        :param vm_id: Id of the VM which owns the snapshot
+        :param snapshot_id: Id of the snapshot
+        :param condition: Callable which gets the snapshot or None if the
+        snapshot doesn't exist
+        :param description: Used for debugging output
+        :param expected: Seconds the operation took at least in the past,
+        see wait_vm
+        :return: The snapshot or None
+        """
+        return self._wait(vm_id, snapshot_id, condition, description, expected)
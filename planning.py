@@ -0,0 +1,75 @@
+import heapq
+import logging
+
+logger = logging.getLogger()
+
+# VMs are backed up in the order of the config or of the engine
+ORDER_CONFIG = "config"
+# Largest VMs first, so that no large VM starts at the end of the run
+ORDER_SIZE = "size"
+
+MIB = 1024 * 1024
+
+
+def order_longest_first(vms, sizes):
+    """
+    Sort the VMs by their disk size, largest first
+    :param vms: List of VM objects
+    :param sizes: Dict of disk sizes in bytes by VM id
+    :return: Sorted list of VM objects, VMs of the same size keep their
+    order
+    """
+    return sorted(vms, key=lambda vm: -sizes.get(vm.id, 0))
+
+
+def estimate_makespan(sizes, workers, throughput):
+    """
+    Estimate the duration of a run in which every worker takes the next VM
+    as soon as it is free
+    :param sizes: List of disk sizes in bytes in the order they are backed
+    up
+    :param workers: Number of VMs which are backed up at the same time
+    :param throughput: Bytes per second of one backup
+    :return: Tuple (seconds till all backups are done, list of seconds
+    each worker is busy)
+    """
+    return schedule([size / float(throughput) for size in sizes], workers)
+
+
+def schedule(durations, workers):
+    """
+    Estimate the duration of a run from the duration of every backup
+    :param durations: List of seconds of the backups in the order they run
+    :param workers: Number of VMs which are backed up at the same time
+    :return: Tuple (seconds till all backups are done, list of seconds
+    each worker is busy)
+    """
+    finish_times = [0.0] * max(1, workers)
+    for duration in durations:
+        # The worker which is free first takes the next VM
+        finished = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, finished + duration)
+    return max(finish_times), sorted(finish_times)
+
+
+def plan(vms, sizes, workers, history, throughput):
+    """
+    Predict the duration of every backup and of the whole run
+    :param vms: List of VM objects in the order they are backed up
+    :param sizes: Dict of disk sizes in bytes by VM id
+    :param workers: Number of VMs which are backed up at the same time
+    :param history: History of the past runs, None without one
+    :param throughput: Bytes per second of one backup, used for VMs
+    without history
+    :return: Tuple (seconds till all backups are done, list of tuples
+    (VM object, seconds, source)), source is "vm" for VMs with own history,
+    "all" for the rate of all VMs and "throughput" without history
+    """
+    estimates = []
+    for vm in vms:
+        estimate = history.estimate(vm.name, sizes.get(vm.id, 0)) if history else None
+        if estimate is None:
+            estimate = sizes.get(vm.id, 0) / float(throughput), "throughput"
+        estimates.append((vm, estimate[0], estimate[1]))
+    makespan, _ = schedule([i[1] for i in estimates], workers)
+    return makespan, estimates
@@ -0,0 +1,204 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+from compression import EXTENSIONS, compress_frame, decompress_frame
+
+logger = logging.getLogger()
+
+# Chunk boundaries are only searched at sector ends, writes of a guest
+# shift the content of a disk by whole sectors
+SECTOR = 512
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# A sector ends a chunk if its checksum is divisible by this, which gives
+# chunks of about MIN_CHUNK + 512 KiB
+BOUNDARY_DIVISOR = 1024
+
+CHUNKS = "chunks"
+
+
+def chunk_length(data, start=0, final=False):
+    """
+    Find the end of the next content defined chunk
+    :param data: Buffer
+    :param start: Start of the chunk in the buffer
+    :param final: True if no data follows the buffer
+    :return: Length of the chunk, None if the buffer ends before the end of
+    the chunk was found
+    """
+    available = len(data) - start
+    with memoryview(data) as view:
+        for length in range(MIN_CHUNK, min(MAX_CHUNK, available) + 1, SECTOR):
+            if zlib.crc32(view[start + length - SECTOR:start + length]) % BOUNDARY_DIVISOR == 0:
+                return length
+    if available >= MAX_CHUNK:
+        return MAX_CHUNK
+    if final and available:
+        return available
+    return None
+
+
+class Repository(object):
+    """
+    Class which stores every unique chunk of the disks once, named by its
+    SHA-256. The manifests of the backups list the chunks of every disk.
+    """
+
+    def __init__(self, backup_dir, codec=None):
+        """
+        :param backup_dir: Directory of the backups, the chunks are kept in
+        its subdirectory chunks
+        :param codec: Compression of the chunks, None stores them raw
+        """
+        self._backup_dir = backup_dir
+        self._path = os.path.join(backup_dir, CHUNKS)
+        self._codec = codec
+
+    def _chunk_path(self, digest):
+        return os.path.join(self._path, digest[:2], digest + (EXTENSIONS[self._codec] if self._codec else ""))
+
+    def store(self, data):
+        """
+        Store a chunk if it isn't stored yet
+        :param data: The bytes
+        :return: Tuple (SHA-256 of the data, number of bytes written, 0 if
+        the chunk was stored before)
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        if self._codec:
+            data, _ = compress_frame(self._codec, bytes(data))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Backups running at the same time can store the same chunk
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return digest, len(data)
+
+    def load(self, digest):
+        """
+        :param digest: SHA-256 of the chunk
+        :return: The bytes of the chunk
+        """
+        with open(self._chunk_path(digest), "rb") as f:
+            data = f.read()
+        return decompress_frame(self._codec, data) if self._codec else data
+
+    def restore(self, disk, path):
+        """
+        Write a disk of a manifest into a sparse raw file
+        :param disk: Entry of the disk in the manifest
+        :param path: Target file
+        """
+        with open(path, "wb") as f:
+            f.truncate(disk["size"])
+            for offset, length, digest in disk["chunks"]:
+                f.seek(offset)
+                f.write(self.load(digest))
+
+    def referenced(self):
+        """
+        :return: Set of the chunks which are referenced by any manifest
+        """
+        digests = set()
+        for path in glob.glob(os.path.join(glob.escape(self._backup_dir), "*", "*", "manifest.json")):
+            with open(path) as f:
+                manifest = json.load(f)
+            for disk in manifest["disks"]:
+                digests.update(i[2] for i in disk.get("chunks") or [])
+        return digests
+
+    def collect_garbage(self, started):
+        """
+        Delete the chunks which no manifest references anymore. Chunks
+        written since the start of the run are kept, a backup which is
+        still running can reference them.
+        :param started: Start of the run, seconds since the epoch
+        :return: Tuple (number of deleted chunks, bytes)
+        """
+        referenced = self.referenced()
+        removed, removed_bytes = 0, 0
+        for path in glob.glob(os.path.join(glob.escape(self._path), "*", "*")):
+            digest = os.path.basename(path).split(".")[0]
+            if digest in referenced or path.endswith(".tmp"):
+                continue
+            stat = os.stat(path)
+            if stat.st_mtime >= started:
+                continue
+            os.remove(path)
+            removed += 1
+            removed_bytes += stat.st_size
+        logger.info("Garbage collection deleted %s chunks (%s MiB), %s chunks are referenced", removed,
+                    removed_bytes // (1024 * 1024), len(referenced))
+        return removed, removed_bytes
+
+
+class RepositoryWriter(object):
+    """
+    Class which splits a disk into content defined chunks and stores them
+    in the repository
+    """
+
+    def __init__(self, repository, path, size):
+        """
+        :param repository: Repository
+        :param path: Name of the disk for logging output
+        :param size: Size of the disk in bytes
+        """
+        self.path = path
+        self._repository = repository
+        self._size = size
+        self._buffer = bytearray()
+        self._offset = 0
+        self.chunks = []
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    def write(self, offset, data):
+        """
+        :param offset: Offset of the data in the disk, must grow
+        :param data: The bytes
+        """
+        if self._buffer and offset != self._offset + len(self._buffer):
+            # The data before a hole ends a chunk
+            self._flush(final=True)
+        if not self._buffer:
+            self._offset = offset
+        self._buffer += data
+        self._flush(final=False)
+
+    def _flush(self, final):
+        start = 0
+        while True:
+            length = chunk_length(self._buffer, start, final)
+            if length is None:
+                break
+            digest, stored = self._repository.store(self._buffer[start:start + length])
+            self.chunks.append((self._offset + start, length, digest))
+            self.raw_bytes += length
+            self.stored_bytes += stored
+            start += length
+        del self._buffer[:start]
+        self._offset += start
+
+    def close(self):
+        self._flush(final=True)
+
+    def describe(self):
+        """
+        :return: Entries of the disk in the manifest
+        """
+        return {
+            "chunks": self.chunks,
+            "deduplication": {
+                "raw": self.raw_bytes,
+                "stored": self.stored_bytes,
+            },
+        }
@@ -0,0 +1,272 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from contextlib import ExitStack
+
+import ovirtsdk4.types as types
+
+from events import tracked
+from incremental import MANIFEST
+from waiter import WaitTimeout, wait_for
+
+logger = logging.getLogger()
+
+REASON_DATE = "by date"
+REASON_NUMBER = "by number"
+
+
+def apply_policy(config, backups, created):
+    """
+    Apply backup_keep_count and backup_keep_count_by_number to the backups
+    of one VM, the date policy first
+    :param config: Configuration
+    :param backups: List of backups, oldest first
+    :param created: Callable which returns the creation date of a backup
+    :return: Tuple (list of tuples (backup, reason) to delete, list of the
+    kept backups)
+    """
+    keep_days = config.get_backup_keep_count()
+    keep_number = config.get_backup_keep_count_by_number()
+    deletions = []
+    kept = []
+    if keep_days:
+        oldest_kept = datetime.date.today() - datetime.timedelta(keep_days)
+    for backup in backups:
+        if keep_days and created(backup) < oldest_kept:
+            deletions.append((backup, REASON_DATE))
+        else:
+            kept.append(backup)
+    if keep_number:
+        while len(kept) > keep_number:
+            deletions.append((kept.pop(0), REASON_NUMBER))
+    return deletions, kept
+
+
+class RetentionEngine(object):
+    """
+    Class which lists the export domain once per run, groups the backup
+    images by their source VM and plans the deletion of old backups by date
+    and by number in one pass
+    """
+
+    def __init__(self, api, config, inventory):
+        """
+        :param api: ovirtsdk api
+        :param config: Configuration
+        :param inventory: Inventory to look up the export domain
+        """
+        self._api = api
+        self._config = config
+        self._inventory = inventory
+        self._lock = threading.Lock()
+        self._index = None
+        # Deletions running at the same time on the export domain, shared
+        # by all VMs
+        self._slots = threading.BoundedSemaphore(max(1, config.get_retention_max_operations()))
+        # Image names are <vm name><vm_middle>_<suffix>
+        self._image_name = re.compile(
+            r"^(?P<vm>.+)" + re.escape(config.get_vm_middle()) + r"_\d+(_\d+)?$"
+        )
+
+    def _vms_service(self):
+        export_sd = self._inventory.storage_domain(self._config.get_export_domain())
+        sds_service = self._api.system_service().storage_domains_service()
+        return sds_service.storage_domain_service(export_sd.id).vms_service()
+
+    def _load(self):
+        """
+        List the export domain and index the images by source VM name
+        """
+        if self._index is not None:
+            return
+        self._index = {}
+        exported_vms = self._vms_service().list()
+        for image in exported_vms:
+            match = self._image_name.match(image.name)
+            if match:
+                self._index.setdefault(match.group("vm"), []).append(image)
+        for images in self._index.values():
+            images.sort(key=lambda x: x.creation_time)
+        logger.info("Found %s backup images of %s VMs in export_domain.",
+                    sum(len(i) for i in self._index.values()), len(self._index))
+
+    def plan(self, vm_names):
+        """
+        Plan the deletion of old backups
+        :param vm_names: Names of the VMs whose backups are checked
+        :return: List of tuples (image, vm name, reason), oldest first per VM
+        """
+        deletions = []
+        with self._lock:
+            self._load()
+            for vm_name in vm_names:
+                images = self._index.get(vm_name, [])
+                deleted, kept = apply_policy(self._config, images, lambda x: x.creation_time.date())
+                deletions.extend((image, vm_name, reason) for image, reason in deleted)
+                logger.debug("Retention for %s: %s images, %s to delete", vm_name, len(images),
+                             len(images) - len(kept))
+        return deletions
+
+    def execute(self, deletions, tracker=None):
+        """
+        Delete the planned backups, up to retention_max_operations at the
+        same time, and wait for all of them together
+        :param deletions: List of tuples (image, vm name, reason) from plan
+        :param tracker: EventTracker to get failed deletions from the engine
+        jobs
+        :return: List of tuples (image, error) of the failed deletions
+        """
+        if self._config.get_dry_run():
+            for image, vm_name, reason in deletions:
+                logger.info("Backup deletion (%s) started for backup: %s", reason, image.name)
+            return []
+        vms_service = self._vms_service()
+        queue = list(deletions)
+        pending = {}
+        failed = []
+        done = 0
+        try:
+            while queue or pending:
+                # Block for a slot only if nothing is in progress, otherwise
+                # send as many deletions as there are free slots
+                while queue and self._slots.acquire(blocking=not pending):
+                    image, vm_name, reason = queue.pop(0)
+                    logger.info("Backup deletion (%s) started for backup: %s", reason, image.name)
+                    stack = ExitStack()
+                    try:
+                        operation = stack.enter_context(
+                            tracked(tracker, "Delete old backup (%s)" % image.name)
+                        )
+                        vms_service.vm_service(id=image.id).remove(query=operation and operation.query)
+                    except Exception as e:
+                        stack.close()
+                        self._slots.release()
+                        logger.error("Backup deletion failed for backup: %s, %s", image.name, e)
+                        failed.append((image, e))
+                        continue
+                    pending[image.id] = (image, vm_name, operation, stack)
+                if not pending:
+                    continue
+                try:
+                    finished = wait_for(self._config, "backup_deletion",
+                                        lambda: self._finished(vms_service, pending),
+                                        "Delete %s old backups" % len(pending))
+                except WaitTimeout as e:
+                    finished = [(i, e) for i in pending]
+                for image_id, error in finished:
+                    image, vm_name, operation, stack = pending.pop(image_id)
+                    stack.close()
+                    self._slots.release()
+                    done += 1
+                    if error is None:
+                        with self._lock:
+                            self._index[vm_name].remove(image)
+                        logger.info("Backup deletion complete for backup: %s (%s/%s)", image.name, done,
+                                    len(deletions))
+                    else:
+                        logger.error("Backup deletion failed for backup: %s, %s", image.name, error)
+                        failed.append((image, error))
+        finally:
+            for image, vm_name, operation, stack in pending.values():
+                stack.close()
+                self._slots.release()
+        return failed
+
+    @staticmethod
+    def _finished(vms_service, pending):
+        """
+        Check all pending deletions with one listing of the export domain
+        :param vms_service: ovirtsdk vms service of the export domain
+        :param pending: Dict of the pending deletions by image id
+        :return: List of tuples (image id, error or None), empty if no
+        deletion is finished
+        """
+        existing = set(i.id for i in vms_service.list())
+        finished = []
+        for image_id, (image, vm_name, operation, stack) in pending.items():
+            if operation and operation.status == types.JobStatus.FAILED:
+                finished.append((image_id, Exception("engine job status is %s" % operation.status)))
+            elif image_id not in existing:
+                finished.append((image_id, None))
+        return finished
+
+
+class DirectoryRetention(object):
+    """
+    Class which plans and deletes old backups in the backup directory. A
+    backup stays as long as a kept incremental backup depends on it.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: Configuration
+        """
+        self._config = config
+
+    def _backups(self, vm_name):
+        """
+        :return: List of tuples (path, manifest) of the complete backups of
+        the VM, oldest first
+        """
+        backups = []
+        pattern = os.path.join(glob.escape(os.path.join(self._config.get_backup_dir(), vm_name)), "*", MANIFEST)
+        for path in glob.glob(pattern):
+            with open(path) as f:
+                backups.append((os.path.dirname(path), json.load(f)))
+        backups.sort(key=lambda x: x[1]["created"])
+        return backups
+
+    def plan(self, vm_names):
+        """
+        Plan the deletion of old backups
+        :param vm_names: Names of the VMs whose backups are checked
+        :return: List of tuples (path, vm name, reason), oldest first per VM
+        """
+        deletions = []
+        for vm_name in vm_names:
+            backups = self._backups(vm_name)
+            deleted, kept = apply_policy(
+                self._config, backups, lambda x: datetime.date.fromtimestamp(x[1]["created"])
+            )
+            parents = dict((path, manifest.get("parent")) for path, manifest in backups)
+            # The parents of kept backups are needed to restore them
+            needed = set()
+            for path, _ in kept:
+                while path and path not in needed:
+                    needed.add(path)
+                    path = parents.get(path)
+            for (path, _), reason in deleted:
+                if path in needed:
+                    logger.info("Backup %s is kept, a newer incremental backup depends on it", path)
+                    continue
+                deletions.append((path, vm_name, reason))
+        return deletions
+
+    def execute(self, deletions, tracker=None):
+        """
+        Delete the planned backups
+        :param deletions: List of tuples (path, vm name, reason) from plan
+        :param tracker: Not used, no engine operation is involved
+        :return: List of tuples (path, error) of the failed deletions
+        """
+        failed = []
+        for path, vm_name, reason in deletions:
+            logger.info("Backup deletion (%s) started for backup: %s", reason, path)
+            if self._config.get_dry_run():
+                continue
+            try:
+                # Without manifest the backup isn't complete anymore, the rest
+                # is deleted afterwards
+                os.remove(os.path.join(path, MANIFEST))
+                shutil.rmtree(path)
+            except OSError as e:
+                logger.error("Backup deletion failed for backup: %s, %s", path, e)
+                failed.append((path, e))
+                continue
+            logger.info("Backup deletion complete for backup: %s", path)
+        return failed
@@ -0,0 +1,152 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+from metrics import waiting
+
+logger = logging.getLogger()
+
+
+class StorageDomainLimiter(object):
+    """
+    Class which limits the number of concurrent operations per storage domain
+    """
+
+    def __init__(self, max_operations):
+        """
+        :param max_operations: Maximum of operations which may run at the same
+        time on one storage domain, 0 means no limit
+        """
+        self._max_operations = max_operations
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, storage_domain):
+        with self._lock:
+            if storage_domain not in self._semaphores:
+                self._semaphores[storage_domain] = threading.BoundedSemaphore(self._max_operations)
+            return self._semaphores[storage_domain]
+
+    @contextmanager
+    def hold(self, *storage_domains):
+        """
+        Hold one operation slot on each of the given storage domains
+        :param storage_domains: Names of the storage domains used by the
+        operation
+        """
+        if not self._max_operations:
+            yield
+            return
+        # Always acquire in the same order to avoid dead locks between
+        # operations which need more than one storage domain
+        semaphores = [self._semaphore(i) for i in sorted(set(storage_domains))]
+        acquired = []
+        try:
+            for semaphore in semaphores:
+                if not semaphore.acquire(blocking=False):
+                    logger.debug("Waiting for a free operation slot on storage domains %s ...",
+                                 ", ".join(storage_domains))
+                    with waiting():
+                        semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
+class Pipeline(object):
+    """
+    Class which moves jobs through a list of stages. Every stage has its own
+    queue and worker threads, so different stages of different jobs overlap.
+    """
+
+    _STOP = object()
+    _FED = object()
+
+    def __init__(self, stages):
+        """
+        :param stages: List of tuples (name, function, concurrency). The
+        function is called with the job and returns False if the job should
+        not continue with the next stage.
+        """
+        self._stages = stages
+        self._aborted = False
+
+    def _worker(self, index, queues, results):
+        name, function, concurrency = self._stages[index]
+        while True:
+            job = queues[index].get()
+            if job is self._STOP:
+                return
+            if self._aborted:
+                continue
+            threading.current_thread().name = str(job)
+            try:
+                proceed = function(job)
+            except BaseException as e:
+                logger.debug("Stage %s failed for %s: %s", name, job, e)
+                results.put((job, e))
+                continue
+            if proceed and index + 1 < len(self._stages):
+                queues[index + 1].put(job)
+            else:
+                results.put((job, None))
+
+    def _feeder(self, jobs, queues, results):
+        count = 0
+        try:
+            for job in jobs:
+                if self._aborted:
+                    break
+                queues[0].put(job)
+                count += 1
+        except BaseException as e:
+            results.put((None, e))
+        results.put((self._FED, count))
+
+    def run(self, jobs):
+        """
+        Run the jobs through all stages
+        :param jobs: Iterable of jobs, it is consumed while the first jobs
+        are already processed
+        :return: Generator of tuples (job, exception) in the order the jobs
+        finish, exception is None if no stage raised one
+        """
+        # Bounded queues give back pressure, a stage only takes work if the
+        # next stage has room for it
+        queues = [queue.Queue(maxsize=max(concurrency, 1)) for _, _, concurrency in self._stages]
+        results = queue.Queue()
+        threads = []
+        for index, (name, _, concurrency) in enumerate(self._stages):
+            for number in range(max(concurrency, 1)):
+                thread = threading.Thread(
+                    target=self._worker, args=(index, queues, results),
+                    name="%s-%s" % (name, number), daemon=True,
+                )
+                thread.start()
+                threads.append((index, thread))
+        threading.Thread(target=self._feeder, args=(jobs, queues, results), daemon=True).start()
+
+        finished = 0
+        total = None
+        try:
+            while total is None or finished < total:
+                job, error = results.get()
+                if job is self._FED:
+                    total = error
+                    continue
+                if job is None:
+                    raise error
+                finished += 1
+                yield job, error
+        except BaseException:
+            # Running operations finish in the background, queued jobs are
+            # dropped
+            self._aborted = True
+            raise
+        for index, thread in threads:
+            queues[index].put(self._STOP)
+        for _, thread in threads:
+            thread.join()
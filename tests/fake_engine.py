@@ -0,0 +1,491 @@
+import datetime
+import fnmatch
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import ovirtsdk4.types as types
+from ovirtsdk4.reader import Reader
+from ovirtsdk4.writer import Writer
+
+import backup
+from fake_imageio import ThreadedServer
+from tracing import endpoint
+
+API_PATH = "/ovirt-engine/api"
+GIB = 1024 * 1024 * 1024
+
+# Poll intervals of the backups against the fake engine
+POLL_INTERVALS = dict((name, [0.01, 0.01]) for name in
+                      ("snapshot", "clone", "export", "vm_deletion", "backup_deletion", "monitor", "conflict"))
+
+
+# Seconds every asynchronous operation takes by default
+DEFAULT_LATENCIES = {
+    "snapshot": 0.0,
+    "clone": 0.0,
+    "export": 0.0,
+    "snapshot_deletion": 0.0,
+    "vm_deletion": 0.0,
+    "backup_deletion": 0.0,
+}
+
+
+class FakeError(Exception):
+    def __init__(self, status, reason, detail=""):
+        super(FakeError, self).__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.detail = detail
+
+
+def _match_term(obj, term):
+    match = re.match(r"^(\w+)(!=|=)(.*)$", term.strip())
+    if match is None:
+        return True
+    field, operator, pattern = match.groups()
+    if field == "tag":
+        matched = any(fnmatch.fnmatchcase(i, pattern) for i in getattr(obj, "tags_", []))
+    else:
+        value = getattr(obj, field, None)
+        matched = value is not None and fnmatch.fnmatchcase(str(value), pattern)
+    return matched if operator == "=" else not matched
+
+
+def search(objects, expression):
+    """
+    Filter objects with the subset of the engine search language the backup
+    uses: terms joined by "or" or "and", wildcards, sortby and page
+    :return: List of the matching objects
+    """
+    page = None
+    if expression:
+        paged = re.search(r"\s+page\s+(\d+)$", expression)
+        if paged:
+            page = int(paged.group(1))
+            expression = expression[:paged.start()]
+        expression = re.sub(r"\s+sortby\s+.*$", "", expression)
+    if expression:
+        if " or " in expression:
+            terms = expression.split(" or ")
+            objects = [i for i in objects if any(_match_term(i, t) for t in terms)]
+        else:
+            terms = expression.split(" and ")
+            objects = [i for i in objects if all(_match_term(i, t) for t in terms)]
+    return objects, page
+
+
+class FakeEngine(object):
+    """
+    In-process oVirt engine which speaks enough of the REST API for the
+    backup: data centers, clusters, storage domains, VMs, snapshots,
+    clones, exports, events and jobs. Asynchronous operations finish after
+    their latency, requests can be made to fail or to get 409 conflicts.
+    """
+
+    def __init__(self, vms=10, disk_size=GIB, latencies=None, free_space=100000 * GIB):
+        """
+        :param vms: Number of VMs, named vm0, vm1, ...
+        :param disk_size: Provisioned size of the one disk of every VM
+        :param latencies: Seconds of the asynchronous operations, see
+        DEFAULT_LATENCIES
+        :param free_space: Available bytes on the data storage domain
+        """
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        # Operation -> set of source VM names whose requests fail with 400
+        self.failures = {}
+        # Operation -> number of the next requests which get 409
+        self.conflicts = {}
+        # Number of requests by endpoint, see tracing.endpoint
+        self.calls = {}
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._events = []
+        self._jobs = []
+        # Tuples (time, function) of operations which finish later
+        self._pending = []
+
+        self.data_center = types.DataCenter(id=self._id(), name="Default")
+        self.cluster = types.Cluster(id=self._id(), name="Default")
+        self.storage_domain = types.StorageDomain(
+            id=self._id(), name="storage", type=types.StorageDomainType.DATA, available=free_space,
+            status=types.StorageDomainStatus.ACTIVE)
+        self.export_domain = types.StorageDomain(
+            id=self._id(), name="backup", type=types.StorageDomainType.EXPORT, available=100000 * GIB,
+            status=types.StorageDomainStatus.ACTIVE)
+        self.vms = {}
+        self.snapshots = {}
+        self.exported = {}
+        for i in range(vms):
+            self.add_vm("vm%s" % i, disk_size)
+
+        engine = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                status, content_type, data = engine.handle(self.command, self.path, body)
+                payload = data.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        self._server = ThreadedServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s%s" % (self._server.server_address[1], API_PATH)
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _id(self):
+        return str(uuid.UUID(int=next(self._ids)))
+
+    def add_vm(self, name, disk_size=GIB, tags=()):
+        vm = types.Vm(
+            id=self._id(), name=name, status=types.VmStatus.UP, memory=GIB,
+            creation_time=datetime.datetime.now(datetime.timezone.utc),
+            disk_attachments=[types.DiskAttachment(disk=types.Disk(id=self._id(), provisioned_size=disk_size))],
+        )
+        vm.tags_ = list(tags)
+        with self._lock:
+            self.vms[vm.id] = vm
+            self.snapshots[vm.id] = {}
+        return vm
+
+    def add_snapshot(self, vm, description):
+        """
+        Add a finished snapshot to a VM
+        :param vm: VM of add_vm
+        :param description: Description of the snapshot
+        """
+        snapshot = types.Snapshot(id=self._id(), description=description, snapshot_status=types.SnapshotStatus.OK,
+                                  date=datetime.datetime.now(datetime.timezone.utc))
+        with self._lock:
+            self.snapshots[vm.id][snapshot.id] = snapshot
+        return snapshot
+
+    def add_backup(self, name, creation_time):
+        """
+        Add an image of an earlier backup to the export domain
+        :param name: Name of the exported clone, e.g. vm0_BACKUP_20200101_000000
+        :param creation_time: datetime of the backup
+        """
+        image = types.Vm(id=self._id(), name=name, creation_time=creation_time)
+        with self._lock:
+            self.exported[image.id] = image
+        return image
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    # Asynchronous operations
+
+    def _later(self, operation, function):
+        with self._lock:
+            self._pending.append((time.monotonic() + self.latencies[operation], function))
+
+    def _advance(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [i for i in self._pending if i[0] <= now]
+            self._pending = [i for i in self._pending if i[0] > now]
+        for _, function in due:
+            function()
+
+    def _check(self, operation, vm_name):
+        with self._lock:
+            if self.conflicts.get(operation):
+                self.conflicts[operation] -= 1
+                raise FakeError(409, "Conflict", "Cannot %s. Related operation is currently in progress." % operation)
+            if vm_name in self.failures.get(operation, ()):
+                raise FakeError(400, "Operation Failed", "Injected failure of %s for %s" % (operation, vm_name))
+
+    def _job(self, correlation_id, description):
+        """
+        :return: Function which finishes the engine job of the operation
+        """
+        if not correlation_id:
+            return lambda: None
+        job = types.Job(id=self._id(), description=description, status=types.JobStatus.STARTED)
+        job.correlation_id_ = correlation_id
+        with self._lock:
+            self._jobs.append(job)
+
+        def finish():
+            job.status = types.JobStatus.FINISHED
+            with self._lock:
+                index = len(self._events) + 1
+                self._events.append(types.Event(id=str(index), index=index, code=1,
+                                                description="%s finished" % description,
+                                                correlation_id=correlation_id))
+        return finish
+
+    # REST API
+
+    def handle(self, method, raw_path, body):
+        """
+        :return: Tuple (status, content type, body)
+        """
+        parsed = urlparse(raw_path)
+        query = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        if parsed.path.startswith("/ovirt-engine/sso/oauth/token"):
+            return 200, "application/json", json.dumps({"access_token": "fake-token", "token_type": "bearer"})
+        if parsed.path.startswith("/ovirt-engine/services/sso-logout"):
+            return 200, "application/json", "{}"
+        path = parsed.path[len(API_PATH):].strip("/")
+        with self._lock:
+            name = endpoint(method, path)
+            self.calls[name] = self.calls.get(name, 0) + 1
+        self._advance()
+        try:
+            result = self._route(method, path.split("/") if path else [], query, body)
+        except FakeError as e:
+            return e.status, "application/xml", Writer.write(types.Fault(reason=e.reason, detail=e.detail))
+        if result is None:
+            return 200, "application/xml", ""
+        root, data = result
+        return 200, "application/xml", Writer.write(data, root=root)
+
+    def _get(self, objects, object_id):
+        if object_id not in objects:
+            raise FakeError(404, "Not Found", "Entity not found: %s" % object_id)
+        return objects[object_id]
+
+    def _list(self, root, objects, query):
+        with self._lock:
+            objects, page = search(list(objects), query.get("search"))
+        if "max" in query:
+            size = int(query["max"])
+            start = (page - 1) * size if page else 0
+            objects = objects[start:start + size]
+        return root, objects
+
+    def _route(self, method, segments, query, body):
+        if not segments:
+            return None, types.Api(product_info=types.ProductInfo(name="fake engine"))
+        collection = segments[0]
+        if collection == "datacenters":
+            if len(segments) == 1:
+                return self._list("data_centers", [self.data_center], query)
+            if len(segments) == 3:
+                return self._list("storage_domains", [self.storage_domain, self.export_domain], query)
+            return None, self.export_domain if segments[-1] == self.export_domain.id else self.storage_domain
+        if collection == "clusters":
+            return self._list("clusters", [self.cluster], query)
+        if collection == "storagedomains":
+            return self._storage_domains(method, segments, query)
+        if collection == "vms":
+            return self._vms(method, segments, query, body)
+        if collection == "events":
+            return self._events_list(query)
+        if collection == "jobs":
+            correlation_id = query.get("search", "").partition("correlation_id=")[2]
+            with self._lock:
+                return "jobs", [i for i in self._jobs if i.correlation_id_ == correlation_id]
+        raise FakeError(404, "Not Found", "Unknown collection %s" % collection)
+
+    def _storage_domains(self, method, segments, query):
+        domains = {self.storage_domain.id: self.storage_domain, self.export_domain.id: self.export_domain}
+        if len(segments) == 1:
+            return self._list("storage_domains", domains.values(), query)
+        if len(segments) == 2:
+            return None, self._get(domains, segments[1])
+        # Only the export domain has VMs
+        if len(segments) == 3:
+            return self._list("vms", self.exported.values(), query)
+        image = self._get(self.exported, segments[3])
+        if method == "DELETE":
+            self._check("backup_deletion", image.name)
+            finish = self._job(query.get("correlation_id"), "Removing VM %s image" % image.name)
+
+            def removed():
+                with self._lock:
+                    self.exported.pop(image.id, None)
+                finish()
+            self._later("backup_deletion", removed)
+            return None
+        return None, image
+
+    def _events_list(self, query):
+        with self._lock:
+            events = list(self._events)
+        # Newest first like the engine
+        events = list(reversed(events))
+        if "from" in query:
+            events = [i for i in events if i.index > int(query["from"])]
+        if "max" in query:
+            events = events[:int(query["max"])]
+        return "events", events
+
+    def _vms(self, method, segments, query, body):
+        if len(segments) == 1:
+            if method == "POST":
+                return None, self._clone(Reader.read(body), query)
+            root, vms = self._list("vms", self.vms.values(), query)
+            if query.get("follow") is None:
+                vms = [types.Vm(id=i.id, name=i.name, status=i.status, memory=i.memory,
+                                creation_time=i.creation_time) for i in vms]
+            return root, vms
+        vm = self._get(self.vms, segments[1])
+        if len(segments) == 2:
+            if method == "DELETE":
+                return self._remove_vm(vm, query)
+            return None, vm
+        if segments[2] == "export":
+            return self._export(vm, Reader.read(body), query)
+        if segments[2] == "snapshots":
+            return self._snapshots(method, vm, segments, query, body)
+        raise FakeError(404, "Not Found", "Unknown path %s" % "/".join(segments))
+
+    def _remove_vm(self, vm, query):
+        if vm.status == types.VmStatus.IMAGE_LOCKED:
+            raise FakeError(409, "Conflict", "Cannot remove VM. VM is locked.")
+        self._check("vm_deletion", vm.name)
+        finish = self._job(query.get("correlation_id"), "Removing VM %s" % vm.name)
+        vm.status = types.VmStatus.IMAGE_LOCKED
+
+        def removed():
+            with self._lock:
+                self.vms.pop(vm.id, None)
+                self.snapshots.pop(vm.id, None)
+            finish()
+        self._later("vm_deletion", removed)
+
+    def _clone(self, clone, query):
+        snapshot_id = clone.snapshots[0].id
+        with self._lock:
+            source_id = [vm_id for vm_id, snaps in self.snapshots.items() if snapshot_id in snaps][0]
+            source, snapshot = self.vms[source_id], self.snapshots[source_id][snapshot_id]
+        if snapshot.snapshot_status != types.SnapshotStatus.OK:
+            raise FakeError(409, "Conflict", "Cannot add VM. The snapshot is locked.")
+        self._check("clone", source.name)
+        vm = self.add_vm(clone.name, source.disk_attachments[0].disk.provisioned_size)
+        vm.status = types.VmStatus.IMAGE_LOCKED
+        finish = self._job(query.get("correlation_id"), "Creating VM %s from snapshot" % clone.name)
+
+        def cloned():
+            vm.status = types.VmStatus.DOWN
+            finish()
+        self._later("clone", cloned)
+        return vm
+
+    def _export(self, vm, action, query):
+        if vm.status != types.VmStatus.DOWN:
+            raise FakeError(409, "Conflict", "Cannot export VM. VM is not down.")
+        self._check("export", vm.name)
+        vm.status = types.VmStatus.IMAGE_LOCKED
+        finish = self._job(query.get("correlation_id"), "Exporting VM %s" % vm.name)
+
+        def exported():
+            vm.status = types.VmStatus.DOWN
+            image = types.Vm(id=self._id(), name=vm.name, creation_time=datetime.datetime.now(datetime.timezone.utc))
+            with self._lock:
+                self.exported[image.id] = image
+            finish()
+        self._later("export", exported)
+        return None, types.Action(status="complete")
+
+    def _snapshots(self, method, vm, segments, query, body):
+        snapshots = self.snapshots[vm.id]
+        if len(segments) == 3:
+            if method == "POST":
+                self._check("snapshot", vm.name)
+                if any(i.snapshot_status == types.SnapshotStatus.LOCKED for i in snapshots.values()):
+                    raise FakeError(409, "Conflict", "Cannot create snapshot. Snapshot is currently being created.")
+                request = Reader.read(body)
+                snapshot = types.Snapshot(id=self._id(), description=request.description,
+                                          snapshot_status=types.SnapshotStatus.LOCKED,
+                                          date=datetime.datetime.now(datetime.timezone.utc))
+                with self._lock:
+                    snapshots[snapshot.id] = snapshot
+                finish = self._job(query.get("correlation_id"), "Creating snapshot of VM %s" % vm.name)
+
+                def created():
+                    snapshot.snapshot_status = types.SnapshotStatus.OK
+                    finish()
+                self._later("snapshot", created)
+                return None, snapshot
+            return self._list("snapshots", snapshots.values(), query)
+        snapshot = self._get(snapshots, segments[3])
+        if method == "DELETE":
+            if snapshot.snapshot_status != types.SnapshotStatus.OK:
+                raise FakeError(409, "Conflict", "Cannot remove snapshot. Snapshot is locked.")
+            self._check("snapshot_deletion", vm.name)
+            snapshot.snapshot_status = types.SnapshotStatus.LOCKED
+            finish = self._job(query.get("correlation_id"), "Removing snapshot of VM %s" % vm.name)
+
+            def removed():
+                with self._lock:
+                    snapshots.pop(snapshot.id, None)
+                finish()
+            self._later("snapshot_deletion", removed)
+            return None
+        return None, snapshot
+
+
+def write_config(path, engine, **options):
+    """
+    :param path: Config file to write
+    :param engine: FakeEngine to back up
+    :param options: Options which replace the defaults below, VMs are
+    backed up one at a time unless a test sets parallel
+    """
+    values = {
+        "vm_names": "[]",
+        "vm_names_skip": "[]",
+        "all_vms": "True",
+        "vm_middle": "_BACKUP",
+        "snapshot_description": "Snapshot for backup script",
+        "server": engine.url,
+        "username": "admin@internal",
+        "password": "secret",
+        "export_domain": "backup",
+        "timeout": "5",
+        "poll_intervals": json.dumps(POLL_INTERVALS),
+        "cluster_name": "Default",
+        "datacenter_name": "Default",
+        "backup_keep_count": "3",
+        "backup_keep_count_by_number": "3",
+        "dry_run": "False",
+        "vm_name_max_length": "32",
+        "use_short_suffix": "False",
+        "storage_domain": "storage",
+        "storage_space_threshold": "0.1",
+        "parallel": "1",
+    }
+    values.update(options)
+    with open(path, "w") as f:
+        f.write("[config]\n")
+        for key, value in values.items():
+            f.write("%s=%s\n" % (key, value))
+
+
+def run_main(config_path, *arguments):
+    """
+    :param config_path: Config file, see write_config
+    :param arguments: Further command line arguments
+    :return: Exit code of backup.main
+    """
+    try:
+        backup.main(["-c", str(config_path)] + list(arguments))
+    except SystemExit as e:
+        return e.code
+    return 0
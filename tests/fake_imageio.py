@@ -0,0 +1,78 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server with a thread per connection, http.server has one only since
+    Python 3.7
+    """
+
+    daemon_threads = True
+
+
+class FakeImageio(object):
+    """
+    In-process image server which serves disks for image transfers
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.extents = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests.append((self.path, self.headers.get("Range")))
+                path, _, query = self.path.partition("?")
+                if path.endswith("/extents"):
+                    context = query.partition("context=")[2]
+                    extents = server.extents.get(path[:-len("/extents")], {}).get(context)
+                    if extents is None:
+                        return self._send(404, b"no extents")
+                    return self._send(200, json.dumps(extents).encode())
+                image = server.images.get(path)
+                if image is None:
+                    return self._send(404, b"no image")
+                match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range") or "")
+                if match:
+                    start, end = int(match.group(1)), int(match.group(2))
+                    return self._send(206, bytes(image[start:end + 1]))
+                return self._send(200, bytes(image))
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadedServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def add_image(self, name, data, extents=None):
+        """
+        :param name: Path of the image below /images/
+        :param data: Content of the disk
+        :param extents: Dict of the extents by context
+        :return: transfer_url of the image
+        """
+        path = "/images/%s" % name
+        self.images[path] = bytearray(data)
+        self.extents[path] = extents or {}
+        return self.url + path
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+
+class FakeFuture(object):
+    """
+    Stands in for the future which ovirtsdk returns for wait=False
+    """
+
+    def __init__(self, result):
+        self._result = result
+
+    def wait(self):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+def respond(result, wait):
+    """
+    :return: The result, or a future of it if the request didn't wait
+    """
+    return result if wait else FakeFuture(result)
+
+
+class FakeConfig(object):
+    """
+    Stands in for config.Config, get_<option> returns the keyword of the
+    option or its default below
+    """
+
+    DEFAULTS = {
+        "poll_intervals": {},
+        "operation_deadline": 0,
+        "timeout": 1,
+        "dry_run": False,
+        "disks_id_exclude": [],
+        "storage_domain": "storage",
+        "export_domain": "export",
+        "vm_middle": "_BACKUP",
+    }
+
+    def __init__(self, **options):
+        """
+        :param options: Values of the options, e.g. operation_deadline=5
+        """
+        self.options = dict(self.DEFAULTS, **options)
+
+    def __getattr__(self, name):
+        option = name[len("get_"):]
+        if not name.startswith("get_") or option not in self.options:
+            raise AttributeError(name)
+        return lambda: self.options[option]
+
+
+class FakeApi(object):
+    """
+    Stands in for the connection of ovirtsdk, its system service has a
+    <name>_service method for every keyword, e.g. FakeApi(vms=vms_service)
+    """
+
+    def __init__(self, **services):
+        """
+        :param services: Service objects by name
+        """
+        self._system_service = SimpleNamespace(**dict(
+            ("%s_service" % name, self._getter(service)) for name, service in services.items()
+        ))
+
+    @staticmethod
+    def _getter(service):
+        return lambda: service
+
+    def system_service(self):
+        return self._system_service
@@ -0,0 +1,151 @@
+import datetime
+import logging
+
+import ovirtsdk4.types as types
+import pytest
+from ovirtsdk4.reader import Reader
+from ovirtsdk4.writer import Writer
+
+import backup
+from fake_engine import API_PATH, FakeEngine, run_main, write_config
+from fake_sdk import FakeConfig
+from journal import Journal
+
+
+@pytest.fixture
+def engine():
+    engine = FakeEngine(vms=4)
+    yield engine
+    engine.close()
+
+
+def backed_up(engine):
+    return sorted(i.name.split("_")[0] for i in engine.exported.values())
+
+
+def test_all_vms_are_exported(engine, tmp_path):
+    write_config(tmp_path / "backup.cfg", engine)
+    assert run_main(tmp_path / "backup.cfg") == 0
+    assert backed_up(engine) == ["vm0", "vm1", "vm2", "vm3"]
+    # Clones and backup snapshots are deleted
+    assert sorted(i.name for i in engine.vms.values()) == ["vm0", "vm1", "vm2", "vm3"]
+    assert all(not i for i in engine.snapshots.values())
+
+
+@pytest.mark.parametrize("options", [{"parallel": "4"}, {"pipeline": "True"}, {"event_tracking": "True"}])
+def test_all_vms_are_exported_with_options(engine, tmp_path, options):
+    write_config(tmp_path / "backup.cfg", engine, **options)
+    assert run_main(tmp_path / "backup.cfg") == 0
+    assert backed_up(engine) == ["vm0", "vm1", "vm2", "vm3"]
+
+
+
+def test_leftover_clones_dont_shift_the_pages(tmp_path):
+    engine = FakeEngine(vms=0)
+    try:
+        # Sorted by creation date the clone of a crashed run is on the first
+        # page, its deletion moves the later VMs up
+        engine.add_vm("vm0")
+        engine.add_vm("vm0_BACKUP_20200101_000000")
+        for i in range(1, 5):
+            engine.add_vm("vm%s" % i)
+        write_config(tmp_path / "backup.cfg", engine, vms_page_size=2)
+        assert run_main(tmp_path / "backup.cfg") == 0
+        assert backed_up(engine) == ["vm0", "vm1", "vm2", "vm3", "vm4"]
+    finally:
+        engine.close()
+
+def test_failed_vm_fails_the_run(engine, tmp_path):
+    engine.failures["snapshot"] = {"vm2"}
+    write_config(tmp_path / "backup.cfg", engine)
+    assert run_main(tmp_path / "backup.cfg") == 1
+    assert backed_up(engine) == ["vm0", "vm1", "vm3"]
+
+
+def test_conflicts_are_retried(engine, tmp_path):
+    engine.conflicts.update({"clone": 3, "snapshot_deletion": 2, "vm_deletion": 2})
+    write_config(tmp_path / "backup.cfg", engine, parallel=4)
+    assert run_main(tmp_path / "backup.cfg") == 0
+    assert backed_up(engine) == ["vm0", "vm1", "vm2", "vm3"]
+    assert not any(engine.conflicts.values())
+
+
+def test_old_backups_are_deleted(engine, tmp_path):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for days in range(1, 6):
+        created = now - datetime.timedelta(days=days)
+        engine.add_backup("vm0_BACKUP_%s" % created.strftime("%Y%m%d_%H%M%S"), created)
+    write_config(tmp_path / "backup.cfg", engine)
+    assert run_main(tmp_path / "backup.cfg") == 0
+    # Old backups are deleted before the export, three are kept by date and
+    # number besides the new one
+    assert backed_up(engine).count("vm0") == 4
+    oldest = min(i.creation_time for i in engine.exported.values())
+    assert now - oldest < datetime.timedelta(days=3, hours=1)
+
+
+def crash_during_clone(engine, vm_name, clone_name, journal_file):
+    """
+    Leave the snapshot, the clone and the journal of a run which crashed
+    while the engine cloned the VM
+    """
+    vm = [i for i in engine.vms.values() if i.name == vm_name][0]
+    snapshot = engine.add_snapshot(vm, "Snapshot for backup script")
+    _, _, data = engine.handle("POST", API_PATH + "/vms",
+                               Writer.write(types.Vm(name=clone_name, snapshots=[types.Snapshot(id=snapshot.id)])))
+    journal = Journal(str(journal_file))
+    journal.record(vm_name, "snapshot", snapshot_id=snapshot.id, clone_name=clone_name)
+    journal.record(vm_name, "clone_started", clone_id=Reader.read(data).id)
+    journal.close()
+
+
+def test_crashed_clone_is_resumed(engine, tmp_path):
+    engine.latencies["clone"] = 0.3
+    crash_during_clone(engine, "vm0", "vm0_BACKUP_20200101_000000", tmp_path / "journal")
+    write_config(tmp_path / "backup.cfg", engine, journal_file=tmp_path / "journal")
+    assert run_main(tmp_path / "backup.cfg", "--resume") == 0
+    # The clone of the crashed run is exported, vm0 isn't cloned again
+    assert "vm0_BACKUP_20200101_000000" in [i.name for i in engine.exported.values()]
+    assert backed_up(engine) == ["vm0", "vm1", "vm2", "vm3"]
+    assert engine.calls["vms_service.add"] == 4
+    assert sorted(i.name for i in engine.vms.values()) == ["vm0", "vm1", "vm2", "vm3"]
+    assert all(not i for i in engine.snapshots.values())
+
+
+
+@pytest.mark.parametrize("mode, workers", [("export", 2), ("incremental", 3), ("full", 3)])
+def test_workers_follow_the_stages_of_the_backup_mode(monkeypatch, mode, workers):
+    config = FakeConfig(pipeline=True, parallel=4, backup_mode=mode, stage_concurrency={"export": 2, "transfer": 3})
+    # The config is a global of backup.main
+    monkeypatch.setattr(backup, "config", config, raising=False)
+    assert backup.backup_workers() == workers
+
+def test_plan_is_based_on_the_history(engine, tmp_path, caplog):
+    write_config(tmp_path / "backup.cfg", engine, history_file=tmp_path / "history.db")
+    assert run_main(tmp_path / "backup.cfg") == 0
+    calls = engine.total_calls()
+    caplog.set_level(logging.INFO)
+    assert run_main(tmp_path / "backup.cfg", "--plan") == 0
+    assert "history of the VM" in caplog.text
+    assert "Expected wall time" in caplog.text
+    # Nothing is backed up
+    assert len(engine.exported) == 4
+    assert engine.total_calls() - calls < 10
+
+
+@pytest.mark.parametrize("parallel", [1, 2])
+def test_polling_is_adapted_to_the_history(tmp_path, parallel):
+    engine = FakeEngine(vms=2, latencies={"snapshot": 0.2, "clone": 0.3, "export": 0.3, "vm_deletion": 0.2})
+    try:
+        write_config(tmp_path / "backup.cfg", engine, history_file=tmp_path / "history.db", parallel=parallel)
+        calls = []
+        for _ in range(3):
+            before = engine.total_calls()
+            assert run_main(tmp_path / "backup.cfg") == 0
+            calls.append(engine.total_calls() - before)
+    finally:
+        engine.close()
+    # The third run has two earlier durations of every operation, it
+    # doesn't poll before they are almost over, with parallel backups the
+    # status monitor polls less
+    assert calls[2] < calls[0] * 0.8
@@ -0,0 +1,24 @@
+import pytest
+
+from batch import wait_all
+from fake_sdk import FakeFuture
+
+
+class CountingFuture(FakeFuture):
+    waited = []
+
+    def wait(self):
+        self.waited.append(self)
+        return FakeFuture.wait(self)
+
+
+def test_results_in_order_of_futures():
+    assert wait_all([FakeFuture(1), FakeFuture(2), FakeFuture(3)]) == [1, 2, 3]
+    assert wait_all([]) == []
+
+
+def test_all_responses_are_read_before_the_error_is_raised():
+    futures = [CountingFuture(1), CountingFuture(Exception("failed")), CountingFuture(3)]
+    with pytest.raises(Exception, match="failed"):
+        wait_all(futures)
+    assert CountingFuture.waited == futures
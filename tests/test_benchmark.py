@@ -0,0 +1,55 @@
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from fake_engine import FakeEngine, run_main, write_config
+
+MIB = 1024 * 1024
+
+# Limits of a run by number of VMs: (seconds, API calls per VM, peak MiB of
+# the Python heap of the backup and the fake engine), with room for slow CI
+# machines. A change which exceeds one of them is a throughput regression.
+BUDGETS = {
+    10: (8, 18, 10),
+    100: (40, 16, 20),
+    1000: (500, 16, 100),
+}
+
+# The run with 1,000 VMs takes minutes, it only runs when this is set
+LARGE_ENV = "OVIRT_BACKUP_BENCHMARK_LARGE"
+
+
+@pytest.mark.parametrize("vms", [
+    10,
+    100,
+    pytest.param(1000, marks=pytest.mark.skipif(not os.environ.get(LARGE_ENV), reason="set %s" % LARGE_ENV)),
+])
+def test_backup_throughput(vms, tmp_path, record_property):
+    engine = FakeEngine(vms=vms, latencies={"snapshot": 0.02, "clone": 0.05, "export": 0.05})
+    try:
+        write_config(tmp_path / "backup.cfg", engine, parallel=10)
+        tracemalloc.start()
+        started = time.monotonic()
+        try:
+            assert run_main(tmp_path / "backup.cfg") == 0
+            seconds = time.monotonic() - started
+            peak = tracemalloc.get_traced_memory()[1] / float(MIB)
+        finally:
+            tracemalloc.stop()
+        assert len(engine.exported) == vms
+        calls = engine.total_calls() / float(vms)
+    finally:
+        engine.close()
+
+    # Shown in the JUnit XML report of the CI run
+    record_property("seconds", round(seconds, 2))
+    record_property("calls_per_vm", round(calls, 2))
+    record_property("peak_mib", round(peak, 2))
+    print("%s VMs: %.2f seconds, %.2f API calls per VM, %.2f MiB peak memory" % (vms, seconds, calls, peak))
+
+    max_seconds, max_calls, max_peak = BUDGETS[vms]
+    assert seconds < max_seconds
+    assert calls < max_calls
+    assert peak < max_peak
@@ -0,0 +1,126 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from capacity import GIB, CapacityLedger
+from fake_sdk import FakeApi, FakeConfig, respond
+
+CONFIG = FakeConfig(disks_id_exclude=["excluded"], storage_space_threshold=0.5,
+                    poll_intervals={"capacity": (0.01, 0.01)})
+
+
+def disk(disk_id, size):
+    return SimpleNamespace(disk=SimpleNamespace(id=disk_id, provisioned_size=size))
+
+
+class FakeVmsService(object):
+    def __init__(self, vms):
+        self.searches = []
+        self.vms = vms
+
+    def list(self, search, follow, wait=True):
+        assert follow == "disk_attachments.disk"
+        self.searches.append(search)
+        ids = [i.split("=")[1] for i in search.split(" or ")]
+        return respond([vm for vm in self.vms if vm.id in ids], wait)
+
+
+class FakeInventory(object):
+    def __init__(self, available):
+        self.available = available
+        self.fetched = time.monotonic()
+
+    def storage_domain(self, name):
+        return SimpleNamespace(available=self.available)
+
+    def storage_domain_fetched(self, name):
+        return self.fetched
+
+
+@pytest.fixture
+def ledger():
+    vms = [
+        SimpleNamespace(id="1", name="vm1", disk_attachments=[disk("a", 2 * GIB), disk("excluded", 50 * GIB)]),
+        SimpleNamespace(id="2", name="vm2", disk_attachments=[disk("b", 4 * GIB), disk("c", 2 * GIB)]),
+    ]
+    vms_service = FakeVmsService(vms)
+    ledger = CapacityLedger(FakeApi(vms=vms_service), CONFIG, FakeInventory(10 * GIB))
+    ledger.add_vms(vms)
+    return vms_service, vms, ledger
+
+
+def test_sizes_are_fetched_in_bulk(ledger):
+    vms_service, vms, ledger = ledger
+    assert ledger.size(vms[0]) == 2 * GIB
+    assert ledger.size(vms[1]) == 6 * GIB
+    assert vms_service.searches == ["id=1 or id=2"]
+
+
+def test_reservation_waits_for_release(ledger):
+    vms_service, vms, ledger = ledger
+    ledger.reserve(vms[0])
+    reserved = threading.Event()
+
+    def reserve():
+        ledger.reserve(vms[1])
+        reserved.set()
+    threading.Thread(target=reserve, daemon=True).start()
+    # 3 GiB reserved plus 9 GiB needed don't fit into 10 GiB
+    assert not reserved.wait(0.1)
+    ledger.release(vms[0])
+    assert reserved.wait(5)
+
+
+def test_reservation_fails_without_other_reservations(ledger):
+    vms_service, vms, ledger = ledger
+    vms[1].disk_attachments.append(disk("d", 20 * GIB))
+    with pytest.raises(Exception, match="not enough free storage"):
+        ledger.reserve(vms[1])
+
+
+def test_storage_domain_is_refreshed_without_lock(ledger):
+    vms_service, vms, _ = ledger
+    refreshing = threading.Event()
+    entered = threading.Event()
+    refreshed = threading.Event()
+    inventory = FakeInventory(10 * GIB)
+
+    def storage_domain(name):
+        if refreshing.is_set():
+            entered.set()
+            refreshed.wait(5)
+        return SimpleNamespace(available=10 * GIB)
+    inventory.storage_domain = storage_domain
+    ledger = CapacityLedger(FakeApi(vms=vms_service), CONFIG, inventory)
+    ledger.add_vms(vms)
+    ledger.reserve(vms[0])
+    refreshing.set()
+    threading.Thread(target=ledger.reserve, args=(vms[1],), daemon=True).start()
+    assert entered.wait(5)
+    released = threading.Thread(target=ledger.release, args=(vms[0],), daemon=True)
+    released.start()
+    # The release doesn't wait for the request of the inventory
+    released.join(1)
+    assert not released.is_alive()
+    refreshed.set()
+
+
+def test_finished_clone_is_counted_once(ledger):
+    vms_service, vms, _ = ledger
+    inventory = FakeInventory(14 * GIB)
+    ledger = CapacityLedger(FakeApi(vms=vms_service), CONFIG, inventory)
+    ledger.add_vms(vms)
+    ledger.reserve(vms[0])
+    ledger.cloned(vms[0])
+    # The refreshed storage domain has the 2 GiB of the clone in use
+    inventory.available, inventory.fetched = 12 * GIB, time.monotonic()
+    reserved = threading.Event()
+
+    def reserve():
+        ledger.reserve(vms[1])
+        reserved.set()
+    threading.Thread(target=reserve, daemon=True).start()
+    # 9 GiB needed fit besides the clone, not besides its reservation too
+    assert reserved.wait(1)
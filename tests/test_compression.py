@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from compression import CompressedReader, CompressedWriter, select_codec
+
+
+def test_select_codec():
+    assert select_codec("none") is None
+    assert select_codec("zlib") == "zlib"
+    assert select_codec("auto") in ("zstd", "lz4", "zlib")
+    with pytest.raises(Exception, match="isn't available"):
+        select_codec("brotli")
+
+
+@pytest.mark.parametrize("pool", [False, True])
+def test_frames_can_be_read_at_any_offset(tmpdir, pool):
+    size = 64 * 1024
+    data = os.urandom(4096) + b"\0" * 8192 + b"a" * 8192
+    executor = None
+    if pool:
+        executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("forkserver"))
+    writer = CompressedWriter(str(tmpdir.join("disk.raw")), size, "zlib", executor, frame_size=4096)
+    # The last 43 KiB are never written, like a hole of a sparse download
+    writer.write(0, data[:12288])
+    writer.write(12288, data[12288:])
+    writer.close()
+    if executor:
+        executor.shutdown()
+    assert writer.path.endswith(".zz")
+    stats = writer.stats()
+    assert stats["codec"] == "zlib"
+    assert stats["ratio"] > 1
+
+    reader = CompressedReader(writer.path)
+    assert reader.size == size
+    assert reader.read(0, len(data)) == data
+    assert reader.read(4000, 200) == data[4000:4200]
+    assert reader.read(len(data) - 10, 20) == data[-10:] + b"\0" * 10
+    assert reader.read(size - 100, 100) == b"\0" * 100
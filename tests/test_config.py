@@ -1,4 +1,4 @@
-from cStringIO import StringIO
+from io import StringIO
 from config import Config
 
 
@@ -13,7 +13,9 @@ default_config_data = [
     "export_domain=backup",
     "timeout=5",
     "cluster_name=Default",
+    "datacenter_name=Default",
     "backup_keep_count=3",
+    "backup_keep_count_by_number=",
     "dry_run=False",
     "vm_name_max_length=32",
     "use_short_suffix=False",
@@ -72,3 +74,16 @@ def test_config_persist_memory():
     data_stream = StringIO("\n".join(default_config_data))
     c = Config(data_stream, False, {"persist_memorystate": True})
     assert c.get_persist_memorystate() is True
+
+
+def test_config_parallel():
+    # Test default
+    data_stream = StringIO("\n".join(default_config_data))
+    c = Config(data_stream, False, dict())
+    assert c.get_parallel() == 1
+    assert c.get_storage_domain_max_operations() == 0
+    # Test setting from CLI
+    data_stream = StringIO("\n".join(default_config_data))
+    c = Config(data_stream, False, {"parallel": 4, "storage_domain_max_operations": 2})
+    assert c.get_parallel() == 4
+    assert c.get_storage_domain_max_operations() == 2
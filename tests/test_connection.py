@@ -0,0 +1,116 @@
+import os
+import stat
+import threading
+
+import pytest
+
+from connection import ConnectionPool, TokenCache
+from fake_sdk import FakeConfig
+
+
+CONFIG = FakeConfig(server="https://engine/ovirt-engine/api", username="admin@internal", password="secret",
+                    connection_pool_size=2, engine_connections=4, engine_pipeline=0)
+
+
+class FakeConnection(object):
+    logins = []
+    created = []
+    unreachable = False
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+        self.kwargs = kwargs
+        self.closed = None
+        self.created.append(self)
+
+    def test(self, raise_exception=False):
+        if self.unreachable:
+            raise IOError("engine unreachable")
+        if self.token in (None, "expired"):
+            self.logins.append(self)
+            self.token = "token%s" % len(self.logins)
+        return True
+
+    def authenticate(self):
+        return self.token
+
+    def system_service(self):
+        return self
+
+    def close(self, logout=True):
+        self.closed = logout
+
+
+def create_pool(tmpdir, cached=True):
+    FakeConnection.logins = []
+    FakeConnection.created = []
+    FakeConnection.unreachable = False
+    cache = TokenCache(str(tmpdir.join("token")), "https://engine/ovirt-engine/api", "admin@internal", 60)
+    return ConnectionPool(CONFIG, cache if cached else None, FakeConnection), cache
+
+
+def test_token_is_reused_by_the_next_run(tmpdir):
+    pool, cache = create_pool(tmpdir)
+    pool.open()
+    pool.close()
+    assert cache.load() == "token1"
+    assert stat.S_IMODE(os.stat(str(tmpdir.join("token"))).st_mode) == 0o600
+    assert FakeConnection.created[0].closed is False
+
+    pool, _ = create_pool(tmpdir)
+    pool.open()
+    assert FakeConnection.logins == []
+    assert FakeConnection.created[0].token == "token1"
+
+
+def test_token_of_other_user_or_expired_is_not_used(tmpdir):
+    cache = TokenCache(str(tmpdir.join("token")), "https://engine/ovirt-engine/api", "admin@internal", 60)
+    cache.save("token1")
+    assert TokenCache(str(tmpdir.join("token")), "https://engine/ovirt-engine/api", "other", 60).load() is None
+    assert TokenCache(str(tmpdir.join("token")), "https://engine/ovirt-engine/api", "admin@internal", 0).load() is None
+
+
+def test_threads_share_the_pool(tmpdir):
+    pool, _ = create_pool(tmpdir, cached=False)
+    pool.open()
+    connections = []
+    threads = [threading.Thread(target=lambda: connections.append(pool.system_service())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert len(FakeConnection.created) == 2
+    assert set(connections) == set(FakeConnection.created)
+    # All connections use the token of the first one
+    assert all(i.token == "token1" for i in FakeConnection.created)
+    assert FakeConnection.created[1].kwargs["connections"] == 4
+    pool.close()
+    # Without cache the token is revoked once
+    assert [i.closed for i in FakeConnection.created] == [True, False]
+
+
+def test_cached_token_is_kept_if_the_engine_is_unreachable(tmpdir):
+    pool, cache = create_pool(tmpdir)
+    cache.save("token1")
+    FakeConnection.unreachable = True
+    with pytest.raises(IOError):
+        pool.open()
+    pool.close()
+    assert cache.load() == "token1"
+    assert FakeConnection.created[0].closed is False
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_token_of_a_later_login_is_revoked(tmpdir, cached):
+    pool, cache = create_pool(tmpdir, cached)
+    pool.open()
+    threads = [threading.Thread(target=pool.system_service) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    # The shared token expired and the second connection logged in again
+    FakeConnection.created[1].token = "expired"
+    FakeConnection.created[1].test()
+    pool.close()
+    assert [i.closed for i in FakeConnection.created] == [not cached, True]
+    if cached:
+        assert cache.load() == "token1"
@@ -0,0 +1,111 @@
+import threading
+from types import SimpleNamespace
+
+import ovirtsdk4.types as types
+import pytest
+
+from events import EventTracker, tracked
+from fake_sdk import FakeApi, FakeConfig, respond
+
+
+class FakeEngine(object):
+    """
+    Engine which emits events and jobs for operations started with a
+    correlation id
+    """
+
+    def __init__(self):
+        self.events = [SimpleNamespace(id="1", index=1, code=30, correlation_id=None, description="login")]
+        self.jobs = {}
+        self.event_requests = []
+        self.job_requests = []
+        self.lock = threading.Lock()
+
+    def start_operation(self, correlation_id):
+        with self.lock:
+            self.jobs[correlation_id] = [SimpleNamespace(status=types.JobStatus.STARTED)]
+            self._emit(correlation_id, "started")
+
+    def finish_operation(self, correlation_id, status=types.JobStatus.FINISHED):
+        with self.lock:
+            self.jobs[correlation_id] = [SimpleNamespace(status=status)]
+            self._emit(correlation_id, "finished")
+
+    def _emit(self, correlation_id, description):
+        index = len(self.events) + 1
+        self.events.append(SimpleNamespace(
+            id=str(index), index=index, code=68, correlation_id=correlation_id, description=description,
+        ))
+
+    def list_events(self, from_=None, max=None):
+        with self.lock:
+            self.event_requests.append(from_)
+            # Newest first like the engine
+            events = list(reversed(self.events))
+            if from_ is not None:
+                events = [i for i in events if i.index > from_]
+            return events[:max]
+
+    def list_jobs(self, search=None, wait=True):
+        with self.lock:
+            self.job_requests.append(search)
+            return respond(list(self.jobs.get(search[len("correlation_id="):], [])), wait)
+
+
+@pytest.fixture
+def engine():
+    return FakeEngine()
+
+
+@pytest.fixture
+def tracker(engine):
+    api = FakeApi(events=SimpleNamespace(list=engine.list_events), jobs=SimpleNamespace(list=engine.list_jobs))
+    tracker = EventTracker(api, FakeConfig(poll_intervals={"events": [0.01, 0.01]}, operation_deadline=5))
+    tracker.start()
+    yield tracker
+    tracker.stop()
+
+
+def test_operation_is_resolved_by_events(engine, tracker):
+    with tracker.track("Export") as operation:
+        engine.start_operation(operation.query["correlation_id"])
+        threading.Timer(0.05, engine.finish_operation, [operation.correlation_id]).start()
+        operation.wait()
+    # The stream is followed from the last event seen at start on
+    assert engine.event_requests[:2] == [None, 1]
+    assert engine.job_requests
+    assert all(i == "correlation_id=%s" % operation.correlation_id for i in engine.job_requests)
+
+
+def test_failed_job_raises(engine, tracker):
+    with tracker.track("Export") as operation:
+        engine.start_operation(operation.correlation_id)
+        engine.finish_operation(operation.correlation_id, types.JobStatus.FAILED)
+        with pytest.raises(Exception, match="failed"):
+            operation.wait()
+
+
+def test_events_of_other_operations_are_ignored(engine, tracker):
+    engine.start_operation("someone-else")
+    engine.finish_operation("someone-else")
+    with tracker.track("Export") as operation:
+        engine.finish_operation(operation.correlation_id)
+        operation.wait()
+    assert "correlation_id=someone-else" not in engine.job_requests
+
+
+
+def test_flood_of_events_doesnt_hide_older_ones(engine, tracker):
+    with tracker.track("Export") as operation:
+        engine.start_operation(operation.correlation_id)
+        with engine.lock:
+            engine.jobs[operation.correlation_id] = [SimpleNamespace(status=types.JobStatus.FINISHED)]
+            engine._emit(operation.correlation_id, "finished")
+            for _ in range(1000):
+                engine._emit("someone-else", "finished")
+        operation.wait()
+    assert operation.status == types.JobStatus.FINISHED
+
+def test_tracked_without_tracker():
+    with tracked(None, "Export") as operation:
+        assert operation is None
@@ -0,0 +1,52 @@
+from history import History
+
+
+def report(vms, started=1000):
+    return {
+        "started": started,
+        "finished": started + 100,
+        "seconds": 100.0,
+        "failures": sum(1 for vm in vms.values() if not vm[1]),
+        "vms": dict((name, {
+            "seconds": seconds,
+            "success": success,
+            "stages": {"export": {"seconds": seconds, "waiting": seconds / 2, "bytes": 10, "result": "ok",
+                                  "operations": {"vm_deletion": 1.5}}},
+        }) for name, (seconds, success) in vms.items()),
+    }
+
+
+def test_estimate_is_scaled_to_the_size(tmp_path):
+    history = History(str(tmp_path / "history.db"))
+    assert history.estimate("vm1", 100) is None
+    history.record_run(report({"vm1": (60.0, True), "vm2": (30.0, True)}), {"vm1": 100, "vm2": 200}, 2)
+    history.record_run(report({"vm1": (80.0, True), "vm2": (900.0, False)}, 2000), {"vm1": 100, "vm2": 200}, 2)
+    assert history.estimate("vm1", 200) == (140.0, "vm")
+    # Failed backups don't count
+    assert history.estimate("vm2", 200) == (30.0, "vm")
+    # New VMs get the rate of all VMs
+    assert history.estimate("vm3", 400) == (170.0, "all")
+    history.close()
+
+
+def test_history_is_kept_between_runs(tmp_path):
+    path = str(tmp_path / "history.db")
+    history = History(path)
+    history.record_run(report({"vm1": (60.0, True)}), {"vm1": 0}, 1)
+    history.close()
+    history = History(path)
+    assert history.estimate("vm1", 0) == (60.0, "vm")
+    history.close()
+
+
+def test_shortest_duration_of_an_operation(tmp_path):
+    history = History(str(tmp_path / "history.db"))
+    history.record_run(report({"vm1": (60.0, True)}), {}, 1)
+    # One run isn't enough to learn from
+    assert history.shortest_duration("vm1", "vm_deletion") is None
+    history.record_run(report({"vm1": (60.0, False)}, 2000), {}, 1)
+    assert history.shortest_duration("vm1", "vm_deletion") is None
+    history.record_run(report({"vm1": (60.0, True)}, 3000), {}, 1)
+    assert history.shortest_duration("vm1", "vm_deletion") == 1.5
+    assert history.shortest_duration("vm1", "export") is None
+    history.close()
@@ -0,0 +1,216 @@
+import json
+import os
+from types import SimpleNamespace
+
+import ovirtsdk4 as sdk
+import ovirtsdk4.types as types
+import pytest
+
+import waiter
+from fake_imageio import FakeImageio
+from fake_sdk import FakeApi, FakeConfig
+from incremental import CheckpointStore, EngineBackup
+from journal import Journal
+
+DISK_SIZE = 64 * 1024
+CONFIG = FakeConfig(transfer_connections=2, require_consistency=False, compression="none", backup_format="files")
+
+
+class FakeEngine(FakeApi):
+    """
+    Backup API of one VM with one disk
+    """
+
+    def __init__(self, imageio):
+        vm_service = SimpleNamespace(
+            disk_attachments_service=lambda: SimpleNamespace(
+                list=lambda: [SimpleNamespace(disk=SimpleNamespace(id="disk1"))]),
+            backups_service=lambda: SimpleNamespace(add=self.add_backup, backup_service=self.backup_service,
+                                                    list=lambda: list(self.backups)),
+        )
+        super(FakeEngine, self).__init__(
+            vms=SimpleNamespace(vm_service=lambda vm_id: vm_service),
+            disks=SimpleNamespace(disk_service=lambda disk_id: SimpleNamespace(get=lambda: self.disk)),
+            image_transfers=SimpleNamespace(
+                add=lambda image_transfer: SimpleNamespace(id="transfer"),
+                image_transfer_service=self.image_transfer_service,
+            ),
+        )
+        self.imageio = imageio
+        self.data = bytes(range(256)) * (DISK_SIZE // 256)
+        self.backups = []
+        self.finalized = []
+        self.broken_checkpoints = set()
+        self.checkpoint = 0
+        self.require_consistency = None
+        self.disk = SimpleNamespace(id="disk1", alias="disk1", name="disk1", provisioned_size=DISK_SIZE)
+
+    def add_backup(self, backup, require_consistency=None):
+        if backup.from_checkpoint_id in self.broken_checkpoints:
+            raise sdk.Error("checkpoint %s doesn't exist" % backup.from_checkpoint_id)
+        if any(i.phase == types.BackupPhase.READY for i in self.backups):
+            raise sdk.Error("Cannot backup VM. The VM is during a backup operation.")
+        self.require_consistency = require_consistency
+        self.checkpoint += 1
+        backup = SimpleNamespace(id="backup%s" % len(self.backups), from_checkpoint_id=backup.from_checkpoint_id,
+                                 to_checkpoint_id="checkpoint%s" % self.checkpoint, phase=types.BackupPhase.READY)
+        self.backups.append(backup)
+        extents = {"zero": [{"start": 0, "length": DISK_SIZE, "zero": False}]}
+        if backup.from_checkpoint_id:
+            extents["dirty"] = [
+                {"start": 0, "length": 4096, "dirty": True},
+                {"start": 4096, "length": DISK_SIZE - 8192, "dirty": False},
+                {"start": DISK_SIZE - 4096, "length": 4096, "dirty": True},
+            ]
+        self.transfer_url = self.imageio.add_image(backup.id, self.data, extents)
+        return backup
+
+    def backup_service(self, backup_id):
+        backup = [i for i in self.backups if i.id == backup_id][0]
+
+        def finalize():
+            backup.phase = types.BackupPhase.SUCCEEDED
+        return SimpleNamespace(get=lambda: backup, finalize=finalize)
+
+    def image_transfer_service(self, transfer_id):
+        return SimpleNamespace(
+            get=lambda: SimpleNamespace(phase=types.ImageTransferPhase.TRANSFERRING, transfer_url=self.transfer_url),
+            finalize=lambda: self.finalized.append(transfer_id),
+            cancel=lambda: None,
+        )
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(waiter.time, "sleep", lambda seconds: None)
+    imageio = FakeImageio()
+    yield FakeEngine(imageio)
+    imageio.close()
+
+
+def backup(engine, tmpdir, name, incremental=True):
+    vm = SimpleNamespace(id="vm1", name="vm1")
+    path = os.path.join(str(tmpdir), "vm1", name)
+    checkpoints = CheckpointStore(str(tmpdir)) if incremental else None
+    return EngineBackup(engine, CONFIG, checkpoints).run(vm, path), path
+
+
+def test_first_backup_is_full(engine, tmpdir):
+    manifest, path = backup(engine, tmpdir, "vm1_BACKUP_1")
+    assert manifest["mode"] == "full"
+    assert manifest["disks"][0]["transferred"] == DISK_SIZE
+    with open(os.path.join(path, "disk1.raw"), "rb") as f:
+        assert f.read() == engine.data
+    with open(os.path.join(path, "manifest.json")) as f:
+        assert json.load(f)["checkpoint"] == "checkpoint1"
+    assert CheckpointStore(str(tmpdir)).get("vm1") == {"checkpoint": "checkpoint1", "backup": path}
+    assert engine.finalized == ["transfer"]
+    assert engine.require_consistency is False
+
+
+def test_next_backup_downloads_changed_blocks(engine, tmpdir):
+    _, parent = backup(engine, tmpdir, "vm1_BACKUP_1")
+    engine.imageio.requests[:] = []
+    manifest, path = backup(engine, tmpdir, "vm1_BACKUP_2")
+    assert engine.backups[1].from_checkpoint_id == "checkpoint1"
+    assert manifest["mode"] == "incremental"
+    assert manifest["parent"] == parent
+    assert manifest["disks"][0]["ranges"] == [(0, 4096), (DISK_SIZE - 4096, 4096)]
+    assert manifest["disks"][0]["transferred"] == 8192
+    # The ranges are read by several connections at the same time
+    assert sorted(r for _, r in engine.imageio.requests if r) == [
+        "bytes=0-4095", "bytes=%s-%s" % (DISK_SIZE - 4096, DISK_SIZE - 1)]
+    assert CheckpointStore(str(tmpdir)).get("vm1")["checkpoint"] == "checkpoint2"
+
+
+def test_broken_checkpoint_chain_falls_back_to_full(engine, tmpdir):
+    backup(engine, tmpdir, "vm1_BACKUP_1")
+    engine.broken_checkpoints.add("checkpoint1")
+    manifest, _ = backup(engine, tmpdir, "vm1_BACKUP_2")
+    assert manifest["mode"] == "full"
+    assert manifest["parent"] is None
+    assert manifest["disks"][0]["transferred"] == DISK_SIZE
+
+
+def test_full_mode_keeps_no_checkpoint(engine, tmpdir):
+    backup(engine, tmpdir, "vm1_BACKUP_1", incremental=False)
+    manifest, _ = backup(engine, tmpdir, "vm1_BACKUP_2", incremental=False)
+    assert manifest["mode"] == "full"
+    assert engine.backups[1].from_checkpoint_id is None
+    assert not os.path.exists(os.path.join(str(tmpdir), "checkpoints.json"))
+
+
+def crashed_backup(engine, tmpdir, written):
+    """
+    Journal of a run which crashed while the disk was downloaded
+    """
+    path = os.path.join(str(tmpdir), "vm1", "vm1_BACKUP_1")
+    backup = engine.add_backup(types.Backup(from_checkpoint_id=None))
+    os.makedirs(path)
+    with open(os.path.join(path, "disk1.raw"), "wb") as f:
+        f.write(engine.data[:written])
+    journal = Journal(os.path.join(str(tmpdir), "journal"))
+    manifest = {"vm": "vm1", "vm_id": "vm1", "backup_id": backup.id, "mode": "full", "from_checkpoint": None,
+                "parent": None, "created": 0, "disks": []}
+    journal.record("vm1", "backup", backup_path=path, manifest=manifest)
+    journal.record("vm1", "transfer", disk="disk1", offset=written)
+    journal.close()
+    return Journal(os.path.join(str(tmpdir), "journal"), resume=True), path
+
+
+def test_resume_continues_ready_backup(engine, tmpdir):
+    journal, path = crashed_backup(engine, tmpdir, DISK_SIZE // 2)
+    vm = SimpleNamespace(id="vm1", name="vm1")
+    manifest = EngineBackup(engine, CONFIG, None, journal=journal).run(vm, path, journal.state("vm1"))
+    assert len(engine.backups) == 1
+    assert manifest["disks"][0]["transferred"] == DISK_SIZE // 2
+    assert [r for _, r in engine.imageio.requests if r] == ["bytes=%s-%s" % (DISK_SIZE // 2, DISK_SIZE - 1)]
+    with open(os.path.join(path, "disk1.raw"), "rb") as f:
+        assert f.read() == engine.data
+    assert journal.state("vm1").disks["disk1"]["entry"]["file"] == "disk1.raw"
+
+
+def test_resume_restarts_finalized_backup(engine, tmpdir):
+    journal, path = crashed_backup(engine, tmpdir, DISK_SIZE // 2)
+    engine.backups[0].phase = types.BackupPhase.SUCCEEDED
+    vm = SimpleNamespace(id="vm1", name="vm1")
+    manifest = EngineBackup(engine, CONFIG, None, journal=journal).run(vm, path, journal.state("vm1"))
+    assert len(engine.backups) == 2
+    assert manifest["backup_id"] == "backup1"
+    assert manifest["disks"][0]["transferred"] == DISK_SIZE
+
+
+@pytest.mark.parametrize("journal", [False, True])
+def test_failed_backup_is_finalized_without_journal(engine, tmpdir, monkeypatch, journal):
+    def fail(*args):
+        raise IOError("connection lost")
+    monkeypatch.setattr(EngineBackup, "_transfer_disk", fail)
+    vm = SimpleNamespace(id="vm1", name="vm1")
+    path = os.path.join(str(tmpdir), "vm1", "vm1_BACKUP_1")
+    engine_backup = EngineBackup(engine, CONFIG, None,
+                                 journal=Journal(os.path.join(str(tmpdir), "journal")) if journal else None)
+    with pytest.raises(IOError):
+        engine_backup.run(vm, path)
+    # With a journal the ready backup is continued by --resume
+    expected = types.BackupPhase.READY if journal else types.BackupPhase.SUCCEEDED
+    assert engine.backups[0].phase == expected
+
+
+def test_backup_left_open_by_failed_run_is_finalized(engine, tmpdir, monkeypatch):
+    transfer_disk = EngineBackup._transfer_disk
+
+    def fail(*args):
+        raise IOError("connection lost")
+    monkeypatch.setattr(EngineBackup, "_transfer_disk", fail)
+    vm = SimpleNamespace(id="vm1", name="vm1")
+    with pytest.raises(IOError):
+        EngineBackup(engine, CONFIG, None, journal=Journal(os.path.join(str(tmpdir), "journal"))).run(
+            vm, os.path.join(str(tmpdir), "vm1", "vm1_BACKUP_1"))
+    assert engine.backups[0].phase == types.BackupPhase.READY
+    # The next run without --resume starts the journal anew
+    monkeypatch.setattr(EngineBackup, "_transfer_disk", transfer_disk)
+    manifest = EngineBackup(engine, CONFIG, None, journal=Journal(os.path.join(str(tmpdir), "journal"))).run(
+        vm, os.path.join(str(tmpdir), "vm1", "vm1_BACKUP_2"))
+    assert engine.backups[0].phase == types.BackupPhase.SUCCEEDED
+    assert manifest["backup_id"] == "backup1"
+    assert manifest["disks"][0]["transferred"] == DISK_SIZE
@@ -0,0 +1,92 @@
+import time
+from types import SimpleNamespace
+
+from fake_sdk import FakeApi, respond
+from inventory import Inventory
+
+
+class FakeCollection(object):
+    def __init__(self, objects, calls, name):
+        self.objects = objects
+        self.calls = calls
+        self.name = name
+
+    def list(self, wait=True):
+        self.calls.append("%s.list" % self.name)
+        return respond(list(self.objects), wait)
+
+    def data_center_service(self, dc_id):
+        return SimpleNamespace(storage_domains_service=lambda: self.attached[dc_id])
+
+    def storage_domain_service(self, sd_id):
+        def get():
+            self.calls.append("%s.get" % self.name)
+            return [i for i in self.objects if i.id == sd_id][0]
+        return SimpleNamespace(get=get)
+
+
+def create_api():
+    """
+    :return: FakeApi of one data center with two storage domains, the
+    requests are recorded in api.calls
+    """
+    calls = []
+    sds = FakeCollection([
+        SimpleNamespace(id="1", name="storage", available=100),
+        SimpleNamespace(id="2", name="backup", available=10),
+    ], calls, "storage_domains")
+    vms = FakeCollection([
+        SimpleNamespace(id="3", name="vm1"),
+        SimpleNamespace(id="4", name="vm2"),
+    ], calls, "vms")
+    dcs = FakeCollection([SimpleNamespace(id="5", name="dc")], calls, "data_centers")
+    dcs.attached = {"5": FakeCollection(sds.objects[1:], calls, "attached_storage_domains")}
+    clusters = FakeCollection([SimpleNamespace(id="6", name="cluster")], calls, "clusters")
+    api = FakeApi(data_centers=dcs, clusters=clusters, storage_domains=sds, vms=vms)
+    api.calls, api.sds = calls, sds
+    return api
+
+
+def test_lookups_are_served_from_one_bulk_request():
+    api = create_api()
+    inventory = Inventory(api, ttl=60)
+    assert inventory.storage_domain("storage").available == 100
+    assert inventory.storage_domain("backup").available == 10
+    assert inventory.storage_domain("missing") is None
+    assert inventory.vm("vm1").id == "3"
+    assert inventory.vm("vm2").id == "4"
+    assert inventory.vm("missing") is None
+    assert api.calls == ["storage_domains.list", "vms.list"]
+
+
+def test_storage_domain_is_refreshed_after_ttl():
+    api = create_api()
+    inventory = Inventory(api, ttl=0)
+    inventory.storage_domain("storage")
+    api.sds.objects[0].available = 50
+    assert inventory.storage_domain("storage").available == 50
+    assert api.calls == ["storage_domains.list", "storage_domains.get", "storage_domains.get"]
+    assert inventory.storage_domain_fetched("storage") <= time.monotonic()
+    assert inventory.storage_domain_fetched("missing") is None
+
+
+def test_added_vms_are_not_fetched_again():
+    api = create_api()
+    inventory = Inventory(api, ttl=60)
+    inventory.add_vms([SimpleNamespace(id="5", name="vm5")])
+    assert inventory.vm("vm5").id == "5"
+    assert api.calls == []
+
+
+def test_preload_serves_startup_checks():
+    api = create_api()
+    inventory = Inventory(api, ttl=60)
+    inventory.preload(["dc", "missing"])
+    assert api.calls == ["data_centers.list", "clusters.list", "storage_domains.list",
+                         "attached_storage_domains.list"]
+    assert inventory.data_center("dc").id == "5"
+    assert inventory.cluster("cluster").id == "6"
+    assert inventory.storage_domain("storage").id == "1"
+    assert inventory.attached_storage_domain("dc", "backup").id == "2"
+    assert inventory.attached_storage_domain("dc", "storage") is None
+    assert len(api.calls) == 4
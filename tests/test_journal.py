@@ -0,0 +1,53 @@
+import json
+
+from journal import DONE, Journal
+
+
+def test_resume_replays_unfinished_vms(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = Journal(path)
+    journal.record("vm1", "snapshot", snapshot_id="s1", clone_name="vm1_BACKUP")
+    journal.record("vm1", "clone", clone_id="c1")
+    journal.record("vm2", "snapshot", snapshot_id="s2", clone_name="vm2_BACKUP")
+    journal.record("vm2", DONE)
+    journal.close()
+
+    journal = Journal(path, resume=True)
+    state = journal.state("vm1")
+    assert state.events == {"snapshot", "clone"}
+    assert state.fields == {"snapshot_id": "s1", "clone_name": "vm1_BACKUP", "clone_id": "c1"}
+    assert journal.state("vm2") is None
+    journal.close()
+
+
+def test_resume_ignores_incomplete_last_line(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = Journal(path)
+    journal.record("vm1", "snapshot", snapshot_id="s1")
+    journal.close()
+    with open(path, "a") as f:
+        f.write(json.dumps({"vm": "vm1", "event": "clone"})[:10])
+
+    assert Journal(path, resume=True).state("vm1").events == {"snapshot"}
+
+
+def test_disk_records(tmpdir):
+    journal = Journal(str(tmpdir.join("journal")))
+    journal.record("vm1", "transfer", disk="d1", offset=10)
+    journal.record("vm1", "transfer", disk="d1", offset=20)
+    journal.record("vm1", "transfer", disk="d2", offset=5)
+    state = journal.state("vm1")
+    assert state.disks == {"d1": {"offset": 20}, "d2": {"offset": 5}}
+    assert state.fields == {}
+    # The state is a copy
+    state.disks.clear()
+    assert journal.state("vm1").disks["d1"] == {"offset": 20}
+
+
+def test_new_run_starts_empty_journal(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = Journal(path)
+    journal.record("vm1", "snapshot", snapshot_id="s1")
+    journal.close()
+    assert Journal(path).state("vm1") is None
+    assert Journal(path, resume=True).state("vm1") is None
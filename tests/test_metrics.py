@@ -0,0 +1,67 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+from metrics import RunMetrics
+
+
+def test_stage_records_waiting_operations_and_bytes():
+    run = RunMetrics()
+
+    def stage(job):
+        with metrics.waiting():
+            # Nested waits are counted once
+            with metrics.waiting():
+                time.sleep(0.05)
+        with metrics.timed("snapshot_deletion"):
+            time.sleep(0.01)
+        metrics.add_bytes(1024)
+        return True
+
+    assert run.instrument("snapshot", stage)(SimpleNamespace(vm_name="vm1"))
+    report = run.report()
+    timing = report["vms"]["vm1"]["stages"]["snapshot"]
+    assert timing["result"] == "ok"
+    assert 0.05 <= timing["waiting"] < timing["seconds"]
+    assert timing["operations"]["snapshot_deletion"] >= 0.01
+    assert timing["bytes"] == 1024
+    assert report["stages"]["snapshot"]["vms"] == 1
+    assert report["vms"]["vm1"]["success"]
+
+
+def test_failed_stage_and_vm_duration():
+    run = RunMetrics()
+
+    def failing(job):
+        raise Exception("failed")
+
+    with pytest.raises(Exception):
+        run.instrument("clone", failing)(SimpleNamespace(vm_name="vm1"))
+    report = run.report(["vm1"])
+    assert report["vms"]["vm1"]["stages"]["clone"]["result"] == "error"
+    assert not report["vms"]["vm1"]["success"]
+    assert report["failures"] == 1
+    # Without a stage of the VM nothing is measured
+    assert run.vm_seconds("vm2") == 0.0
+
+
+def test_report_files(tmpdir):
+    run = RunMetrics()
+    run.instrument("export", lambda job: False)(SimpleNamespace(vm_name='vm"1'))
+    with run.stage(None, "retention"):
+        pass
+    report = run.report()
+    metrics.write_json(str(tmpdir.join("report.json")), report)
+    with open(str(tmpdir.join("report.json"))) as f:
+        assert json.load(f)["vms"]['vm"1']["stages"]["export"]["result"] == "stopped"
+    metrics.write_textfile(str(tmpdir.join("backup.prom")), report)
+    with open(str(tmpdir.join("backup.prom"))) as f:
+        text = f.read()
+    assert '# TYPE ovirt_backup_stage_seconds gauge' in text
+    assert 'ovirt_backup_stage_bytes{stage="export",vm="vm\\"1"} 0' in text
+    assert 'ovirt_backup_stage_seconds{stage="retention",vm=""}' in text
+    assert 'ovirt_backup_vm_success{vm="vm\\"1"} 1' in text
+    assert tmpdir.listdir(lambda p: p.ext == ".tmp") == []
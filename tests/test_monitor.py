@@ -0,0 +1,53 @@
+import threading
+from types import SimpleNamespace
+
+from fake_sdk import FakeApi, FakeConfig, respond
+from monitor import StatusMonitor
+
+CONFIG = FakeConfig(poll_intervals={"monitor": [0.01, 0.01]}, operation_deadline=5)
+
+
+class FakeVmsService(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.searches = []
+
+    def list(self, search=None, wait=True):
+        self.searches.append(search)
+        ids = [term.strip()[len("id="):] for term in search.split(" or ")]
+        return respond([SimpleNamespace(id=i, status=self.statuses[i]) for i in ids if i in self.statuses], wait)
+
+
+def test_monitor_polls_all_vms_with_one_query():
+    statuses = dict(("vm%s" % i, "image_locked") for i in range(10))
+    vms_service = FakeVmsService(statuses)
+    monitor = StatusMonitor(FakeApi(vms=vms_service), CONFIG)
+    monitor.start()
+    finished = []
+
+    def wait(vm_id):
+        monitor.wait_vm(vm_id, lambda vm: vm.status == "down")
+        finished.append(vm_id)
+
+    threads = [threading.Thread(target=wait, args=(i,)) for i in statuses]
+    for thread in threads:
+        thread.start()
+    while len(vms_service.searches) < 3:
+        threading.Event().wait(0.01)
+    for vm_id in statuses:
+        statuses[vm_id] = "down"
+    for thread in threads:
+        thread.join()
+    monitor.stop()
+
+    assert sorted(finished) == sorted(statuses)
+    # Every tick is one query, not one request per waiting operation
+    assert max(search.count("id=") for search in vms_service.searches) == 10
+
+
+def test_monitor_reports_removed_vm_as_none():
+    vms_service = FakeVmsService({})
+    monitor = StatusMonitor(FakeApi(vms=vms_service), CONFIG)
+    monitor.start()
+    assert monitor.wait_vm("gone", lambda vm: vm is None) is None
+    monitor.stop()
@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+from planning import estimate_makespan, order_longest_first, plan
+
+
+def test_largest_vms_first():
+    vms = [SimpleNamespace(id=str(i)) for i in range(4)]
+    sizes = {"0": 1, "1": 5, "2": 3, "3": 5}
+    assert [vm.id for vm in order_longest_first(vms, sizes)] == ["1", "3", "2", "0"]
+
+
+def test_makespan_of_free_workers():
+    # A large VM at the end extends the run, first it is shared by workers
+    assert estimate_makespan([1, 1, 1, 1, 4], 2, 1)[0] == 6
+    assert estimate_makespan([4, 1, 1, 1, 1], 2, 1) == (4, [4, 4])
+    assert estimate_makespan([10, 20], 1, 10)[0] == 3
+
+
+class FakeHistory(object):
+    def estimate(self, vm_name, size):
+        return (size * 2.0, "vm") if vm_name == "known" else None
+
+
+def test_plan_uses_history_and_falls_back_to_throughput():
+    vms = [SimpleNamespace(id="1", name="known"), SimpleNamespace(id="2", name="new")]
+    makespan, estimates = plan(vms, {"1": 10, "2": 30}, 1, FakeHistory(), 10)
+    assert [(vm.name, seconds, source) for vm, seconds, source in estimates] == [
+        ("known", 20.0, "vm"), ("new", 3.0, "throughput")]
+    assert makespan == 23
+    assert plan(vms, {"1": 10, "2": 30}, 2, None, 10)[0] == 3
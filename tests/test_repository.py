@@ -0,0 +1,79 @@
+import json
+import os
+import random
+import time
+
+from repository import MAX_CHUNK, MIN_CHUNK, Repository, RepositoryWriter, chunk_length
+
+
+def disk_data(seed, size):
+    return random.Random(seed).randbytes(size)
+
+
+def backup(repository, tmpdir, name, data, holes=()):
+    writer = RepositoryWriter(repository, name, len(data))
+    offset = 0
+    for start, end in holes:
+        writer.write(offset, data[offset:start])
+        offset = end
+    writer.write(offset, data[offset:])
+    writer.close()
+    path = tmpdir.join("vm1", name)
+    path.ensure(dir=True)
+    disk = dict(writer.describe(), size=len(data))
+    path.join("manifest.json").write(json.dumps({"disks": [disk]}))
+    return writer, disk
+
+
+def test_chunk_boundaries_follow_the_content():
+    data = disk_data(1, 8 * 1024 * 1024)
+    length = chunk_length(data)
+    assert MIN_CHUNK <= length <= MAX_CHUNK
+    # Inserting a sector before the chunk moves its end by one sector
+    shifted = os.urandom(512) + data
+    assert chunk_length(shifted, 512) == length
+    assert chunk_length(data[:MIN_CHUNK]) is None
+    assert chunk_length(data[:1000], final=True) == 1000
+
+
+def test_unchanged_chunks_are_stored_once(tmpdir):
+    repository = Repository(str(tmpdir))
+    data = bytearray(disk_data(2, 12 * 1024 * 1024))
+    first, _ = backup(repository, tmpdir, "backup1", data)
+    assert first.stored_bytes == len(data)
+    data[5 * 1024 * 1024:5 * 1024 * 1024 + 4096] = os.urandom(4096)
+    second, disk = backup(repository, tmpdir, "backup2", data)
+    assert second.raw_bytes == len(data)
+    assert second.stored_bytes <= 2 * MAX_CHUNK
+
+    path = str(tmpdir.join("restored.raw"))
+    repository.restore(disk, path)
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_holes_are_not_stored(tmpdir):
+    repository = Repository(str(tmpdir), "zlib")
+    data = bytearray(disk_data(3, 2 * 1024 * 1024))
+    data[512 * 1024:1536 * 1024] = bytes(1024 * 1024)
+    writer, disk = backup(repository, tmpdir, "backup1", data, holes=[(512 * 1024, 1536 * 1024)])
+    assert writer.raw_bytes == 1024 * 1024
+    path = str(tmpdir.join("restored.raw"))
+    repository.restore(disk, path)
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_garbage_collection_keeps_referenced_chunks(tmpdir):
+    repository = Repository(str(tmpdir))
+    backup(repository, tmpdir, "backup1", disk_data(4, 2 * 1024 * 1024))
+    _, disk = backup(repository, tmpdir, "backup2", disk_data(5, 2 * 1024 * 1024))
+    tmpdir.join("vm1", "backup1").remove()
+    # Chunks written since the start of the run are kept
+    assert repository.collect_garbage(time.time() - 3600) == (0, 0)
+    removed, _ = repository.collect_garbage(time.time() + 1)
+    assert removed > 0
+    path = str(tmpdir.join("restored.raw"))
+    repository.restore(disk, path)
+    with open(path, "rb") as f:
+        assert f.read() == disk_data(5, 2 * 1024 * 1024)
@@ -0,0 +1,141 @@
+import datetime
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import waiter
+from fake_sdk import FakeApi, FakeConfig
+from retention import REASON_DATE, REASON_NUMBER, DirectoryRetention, RetentionEngine
+
+
+def retention_config(keep_days="", keep_number="", max_operations=4, dry_run=True, **options):
+    return FakeConfig(backup_keep_count=keep_days, backup_keep_count_by_number=keep_number,
+                      retention_max_operations=max_operations, dry_run=dry_run, **options)
+
+
+class FakeExportService(object):
+    """
+    VMs service of the export domain
+    """
+
+    def __init__(self, images):
+        self.calls = []
+        self.images = images
+        self.removing = set()
+
+    def list(self):
+        self.calls.append("export.list")
+        # Deletions finish one listing after they were sent
+        self.images = [i for i in self.images if i.id not in self.removing]
+        return list(self.images)
+
+    def vm_service(self, id):
+        def remove(query=None):
+            self.calls.append("remove %s" % id)
+            if id == "broken":
+                raise Exception("status: 500")
+            self.removing.add(id)
+        return SimpleNamespace(remove=remove)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(waiter.time, "sleep", lambda seconds: None)
+
+
+def image(name, days_ago, image_id=None):
+    created = datetime.datetime.now() - datetime.timedelta(days=days_ago)
+    return SimpleNamespace(id=image_id or name, name=name, creation_time=created)
+
+
+def engine(images, **kwargs):
+    export = FakeExportService(images)
+    sd_service = SimpleNamespace(vms_service=lambda: export)
+    api = FakeApi(storage_domains=SimpleNamespace(storage_domain_service=lambda sd_id: sd_service))
+    inventory = SimpleNamespace(storage_domain=lambda name: SimpleNamespace(id="1"))
+    return export, RetentionEngine(api, retention_config(**kwargs), inventory)
+
+
+def test_images_are_grouped_by_source_vm():
+    export, retention = engine([
+        image("vm1_BACKUP_20240101_120000", 3),
+        image("vm1_BACKUP_20240102_120000", 2),
+        image("vm1_BACKUP_20240103_120000", 1),
+        # A VM whose name starts with the name of another VM
+        image("vm1_BACKUP_old_BACKUP_20240101_120000", 3),
+        image("vm1_BACKUPx_20240101_120000", 3),
+        image("other", 3),
+    ], keep_number=1)
+    deletions = retention.plan(["vm1", "vm1_BACKUP_old"])
+    assert [(i.name, vm, reason) for i, vm, reason in deletions] == [
+        ("vm1_BACKUP_20240101_120000", "vm1", REASON_NUMBER),
+        ("vm1_BACKUP_20240102_120000", "vm1", REASON_NUMBER),
+    ]
+
+
+def test_date_and_number_policies_in_one_pass():
+    export, retention = engine([
+        image("vm1_BACKUP_1", 1),
+        image("vm1_BACKUP_2", 10),
+        image("vm1_BACKUP_3", 2),
+        image("vm1_BACKUP_4", 3),
+    ], keep_days=5, keep_number=2)
+    deletions = retention.plan(["vm1"])
+    assert [(i.name, reason) for i, _, reason in deletions] == [
+        ("vm1_BACKUP_2", REASON_DATE),
+        ("vm1_BACKUP_4", REASON_NUMBER),
+    ]
+
+
+def test_export_domain_is_listed_once():
+    export, retention = engine([image("vm1_BACKUP_1", 1), image("vm2_BACKUP_1", 1)], keep_days=5)
+    for vm_name in ("vm1", "vm2", "vm3"):
+        retention.execute(retention.plan([vm_name]))
+    assert export.calls == ["export.list"]
+
+
+def test_deletions_run_concurrently_up_to_the_limit():
+    export, retention = engine([image("vm1_BACKUP_%s" % i, 10) for i in range(3)],
+                            keep_days=5, max_operations=2, dry_run=False)
+    assert retention.execute(retention.plan(["vm1"])) == []
+    assert export.calls == [
+        "export.list",
+        "remove vm1_BACKUP_0",
+        "remove vm1_BACKUP_1",
+        "export.list",
+        "remove vm1_BACKUP_2",
+        "export.list",
+    ]
+    assert retention.plan(["vm1"]) == []
+
+
+def test_failed_deletion_is_reported_per_image():
+    export, retention = engine([image("vm1_BACKUP_1", 10, "broken"), image("vm1_BACKUP_2", 10)],
+                            keep_days=5, dry_run=False)
+    failed = retention.execute(retention.plan(["vm1"]))
+    assert [i.name for i, _ in failed] == ["vm1_BACKUP_1"]
+    assert [i.name for i in export.images] == ["vm1_BACKUP_1"]
+
+
+def test_backups_with_incremental_children_are_kept(tmpdir):
+    def add(name, days_ago, parent=None):
+        path = tmpdir.join("vm1", name)
+        path.ensure(dir=True)
+        manifest = {"created": int(time.time()) - days_ago * 86400, "parent": parent and str(tmpdir.join("vm1", parent)),
+                    "disks": []}
+        path.join("manifest.json").write(json.dumps(manifest))
+    add("full1", 10)
+    add("incr1", 9, "full1")
+    add("full2", 3)
+    add("incr2", 2, "full2")
+    add("incr3", 1, "incr2")
+    retention = DirectoryRetention(retention_config(keep_number=2, dry_run=False, backup_dir=str(tmpdir)))
+    deletions = retention.plan(["vm1"])
+    assert [(path.split("/")[-1], reason) for path, _, reason in deletions] == [
+        ("full1", REASON_NUMBER),
+        ("incr1", REASON_NUMBER),
+    ]
+    assert retention.execute(deletions) == []
+    assert sorted(i.basename for i in tmpdir.join("vm1").listdir()) == ["full2", "incr2", "incr3"]
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Pipeline, StorageDomainLimiter
+
+
+def test_pipeline_runs_all_stages_in_order():
+    calls = []
+    lock = threading.Lock()
+
+    def stage(name):
+        def run(job):
+            with lock:
+                calls.append((job, name))
+            return True
+        return run
+
+    stages = [(name, stage(name), 2) for name in ("snapshot", "clone", "export")]
+    finished = [job for job, error in Pipeline(stages).run(["vm1", "vm2", "vm3"])]
+    assert sorted(finished) == ["vm1", "vm2", "vm3"]
+    for job in finished:
+        assert [name for j, name in calls if j == job] == ["snapshot", "clone", "export"]
+
+
+def test_pipeline_stops_job_and_reports_errors():
+    exported = []
+
+    def snapshot(job):
+        if job == "broken":
+            raise RuntimeError("boom")
+        return job != "skipped"
+
+    stages = [
+        ("snapshot", snapshot, 1),
+        ("export", lambda job: exported.append(job) or True, 1),
+    ]
+    results = dict(Pipeline(stages).run(["vm1", "skipped", "broken"]))
+    assert exported == ["vm1"]
+    assert results["vm1"] is None
+    assert results["skipped"] is None
+    assert isinstance(results["broken"], RuntimeError)
+
+
+def test_pipeline_overlaps_stages():
+    export_started = threading.Event()
+    overlapped = []
+
+    def clone(job):
+        if job == "vm2":
+            overlapped.append(export_started.wait(5))
+        return True
+
+    def export(job):
+        if job == "vm1":
+            export_started.set()
+            time.sleep(0.1)
+        return True
+
+    stages = [("clone", clone, 1), ("export", export, 1)]
+    list(Pipeline(stages).run(["vm1", "vm2"]))
+    assert overlapped == [True]
+
+
+def test_pipeline_feeder_error():
+    def jobs():
+        yield "vm1"
+        raise RuntimeError("enumeration failed")
+
+    with pytest.raises(RuntimeError):
+        list(Pipeline([("backup", lambda job: True, 1)]).run(jobs()))
+
+
+def test_limiter_caps_operations_per_storage_domain():
+    limiter = StorageDomainLimiter(1)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def operation():
+        with limiter.hold("storage", "export"):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=operation) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 1
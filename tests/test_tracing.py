@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import metrics
+from tracing import CallTracer, TracingConnection, endpoint, percentile
+
+VM_ID = "123e4567-e89b-12d3-a456-426614174000"
+
+
+def test_endpoint_names():
+    assert endpoint("GET", "vms") == "vms_service.list"
+    assert endpoint("POST", "vms") == "vms_service.add"
+    assert endpoint("GET", "vms/%s" % VM_ID) == "vm_service.get"
+    assert endpoint("DELETE", "vms/%s" % VM_ID) == "vm_service.remove"
+    assert endpoint("GET", "vms/%s/snapshots" % VM_ID) == "snapshots_service.list"
+    assert endpoint("POST", "vms/%s/snapshots" % VM_ID) == "snapshots_service.add"
+    assert endpoint("GET", "vms/%s/snapshots/%s" % (VM_ID, VM_ID)) == "snapshot_service.get"
+    assert endpoint("POST", "vms/%s/export" % VM_ID) == "vm_service.export"
+    assert endpoint("POST", "imagetransfers/%s/finalize" % VM_ID) == "imagetransfer_service.finalize"
+    assert endpoint("GET", "") == "system_service.get"
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 90) == 7
+    assert percentile([], 50) is None
+
+
+def test_connection_times_calls_with_and_without_wait(monkeypatch):
+    tracer = CallTracer()
+    monkeypatch.setattr("ovirtsdk4.Connection.send", lambda self, request: object())
+    monkeypatch.setattr("ovirtsdk4.Connection.wait", lambda self, context, failed_auth=False:
+                        SimpleNamespace(code=200 if len(tracer.summary()) < 1 else 404))
+    connection = TracingConnection(tracer, url="https://engine/ovirt-engine/api")
+    first = connection.send(SimpleNamespace(method="GET", path="vms"))
+    second = connection.send(SimpleNamespace(method="GET", path="vms/%s" % VM_ID))
+    connection.wait(first)
+    connection.wait(second)
+    summary = tracer.summary()
+    assert summary["vms_service.list"]["calls"] == 1
+    assert summary["vms_service.list"]["errors"] == 0
+    assert summary["vm_service.get"]["errors"] == 1
+    assert set(summary["vm_service.get"]) == {"calls", "errors", "seconds", "p50", "p90", "p99"}
+
+
+def test_summary_in_prometheus_textfile():
+    tracer = CallTracer()
+    for seconds in (0.1, 0.2, 0.3):
+        tracer.record("vms_service.list", seconds)
+    report = dict(metrics.RunMetrics().report(), sdk_calls=tracer.summary())
+    text = metrics.to_textfile(report)
+    assert "# TYPE ovirt_backup_sdk_call_seconds summary" in text
+    assert 'ovirt_backup_sdk_call_seconds{endpoint="vms_service.list",quantile="0.5"} 0.2' in text
+    assert 'ovirt_backup_sdk_call_seconds_count{endpoint="vms_service.list"} 3' in text
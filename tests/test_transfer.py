@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import transfer
+from fake_imageio import FakeImageio
+
+
+@pytest.fixture
+def imageio():
+    server = FakeImageio()
+    yield server
+    server.close()
+
+
+def test_split_ranges():
+    assert list(transfer.split_ranges([(0, 10), (20, 4)], 4)) == [(0, 4), (4, 4), (8, 2), (20, 4)]
+
+
+def test_download_with_several_connections(imageio, tmpdir):
+    data = os.urandom(100 * 1024)
+    url = imageio.add_image("disk", data)
+    path = str(tmpdir.join("disk.raw"))
+    writer = transfer.RawWriter(path, len(data))
+    assert transfer.download(url, writer, len(data), chunk_size=4096, connections=4) == len(data)
+    writer.close()
+    with open(path, "rb") as f:
+        assert f.read() == data
+    # Every chunk is read once
+    assert len([r for _, r in imageio.requests if r]) == 25
+
+
+def test_chunks_are_yielded_in_order(imageio):
+    url = imageio.add_image("disk", bytes(range(256)) * 64)
+    chunks = list(transfer.split_ranges([(0, 256 * 64)], 256))
+    offsets = [offset for offset, _ in transfer.read_chunks(url, chunks, connections=8)]
+    assert offsets == [offset for offset, _ in chunks]
+
+
+def test_read_error_stops_the_download(imageio, tmpdir):
+    url = imageio.add_image("disk", b"x" * 1024)
+    writer = transfer.RawWriter(str(tmpdir.join("disk.raw")), 1024)
+    with pytest.raises(transfer.TransferError):
+        transfer.download(url.replace("disk", "missing"), writer, 1024, chunk_size=128, connections=3)
+    writer.close()
+
+
+def test_intersect_ranges():
+    assert transfer.intersect_ranges([(0, 10), (20, 10)], [(5, 20)]) == [(5, 5), (20, 5)]
+    assert transfer.intersect_ranges([(0, 10)], []) == []
+
+
+def test_only_data_extents_are_downloaded(imageio, tmpdir):
+    size = 1024 * 1024
+    data = bytearray(size)
+    data[:4096] = b"a" * 4096
+    data[-4096:] = b"b" * 4096
+    url = imageio.add_image("disk", data, {"zero": [
+        {"start": 0, "length": 4096, "zero": False},
+        {"start": 4096, "length": size - 8192, "zero": True},
+        {"start": size - 4096, "length": 4096, "zero": False},
+    ]})
+    client = transfer.ImageioClient(url)
+    ranges = transfer.data_ranges(client)
+    client.close()
+    path = str(tmpdir.join("disk.raw"))
+    writer = transfer.RawWriter(path, size)
+    assert transfer.download(url, writer, size, ranges) == 8192
+    writer.close()
+    with open(path, "rb") as f:
+        assert f.read() == data
+    # The zero extent is a hole in the file
+    assert os.stat(path).st_blocks * 512 < size
+
+
+def test_no_extents_means_whole_disk(imageio):
+    client = transfer.ImageioClient(imageio.add_image("disk", b"x" * 1024))
+    assert transfer.data_ranges(client) is None
+    client.close()
@@ -0,0 +1,98 @@
+import re
+from types import SimpleNamespace
+
+import ovirtsdk4 as sdk
+
+from fake_sdk import respond
+from vmtools import VMTools
+
+
+class FakeVmsService(object):
+    def __init__(self, names):
+        self.vms = [SimpleNamespace(id=str(i), name=name) for i, name in enumerate(names)]
+        self.searches = []
+
+    def list(self, search=None, max=None):
+        self.searches.append(search)
+        page = int(re.search(r"page (\d+)$", search).group(1))
+        return self.vms[(page - 1) * max:page * max]
+
+
+def test_iter_vms_fetches_all_pages():
+    vms_service = FakeVmsService(["vm%s" % i for i in range(7)])
+    names = [vm.name for vm in VMTools.iter_vms(vms_service, "tag=backup", page_size=3)]
+    assert names == ["vm%s" % i for i in range(7)]
+    assert vms_service.searches == [
+        "tag=backup sortby creationdate asc page 1",
+        "tag=backup sortby creationdate asc page 2",
+        "tag=backup sortby creationdate asc page 3",
+    ]
+
+
+def test_iter_vms_is_lazy():
+    vms_service = FakeVmsService(["vm%s" % i for i in range(7)])
+    vms = VMTools.iter_vms(vms_service, page_size=3)
+    assert next(vms).name == "vm0"
+    assert len(vms_service.searches) == 1
+
+
+def test_is_clone_name():
+    config = SimpleNamespace(get_vm_middle=lambda: "_BACKUP")
+    assert VMTools.is_clone_name(config, "vm1_BACKUP_20240101_101010")
+    assert VMTools.is_clone_name(config, "vm1_BACKUP_010110")
+    assert not VMTools.is_clone_name(config, "vm1")
+    assert not VMTools.is_clone_name(config, "vm1_BACKUP")
+
+
+def test_search_chunks_respect_length_and_terms():
+    terms = ["name=vm%s" % i for i in range(10)]
+    chunks = list(VMTools.search_chunks(terms, "or", max_length=40, max_terms=3))
+    assert [chunk for _, chunk in chunks] == [terms[0:3], terms[3:6], terms[6:9], terms[9:10]]
+    assert chunks[0][0] == "name=vm0 or name=vm1 or name=vm2"
+    for search, _ in VMTools.search_chunks(terms, "or", max_length=25):
+        assert len(search) <= 25
+
+
+def test_resolve_vms_with_one_request_per_chunk():
+    class Service(object):
+        searches = []
+
+        def list(self, search=None, max=None, case_sensitive=None, wait=True):
+            self.searches.append(search)
+            names = [term[len("name="):] for term in search.split(" or ")]
+            return respond([SimpleNamespace(id=name, name=name) for name in names if name != "missing"], wait)
+
+    service = Service()
+    vms = VMTools.resolve_vms(service, ["vm1", "vm2", "missing"])
+    assert sorted(vms) == ["vm1", "vm2"]
+    assert service.searches == ["name=vm1 or name=vm2 or name=missing"]
+
+
+def test_exclusion_search():
+    search, remaining = VMTools.exclusion_search(["a", "b", "c"], max_length=20)
+    assert search == "name!=a and name!=b"
+    assert remaining == ["c"]
+    assert VMTools.exclusion_search([]) == (None, [])
+
+
+def test_resolve_vms_sends_all_chunks_before_waiting():
+    class Service(object):
+        futures = []
+
+        def list(self, search=None, max=None, case_sensitive=None, wait=True):
+            assert not wait
+            future = respond([SimpleNamespace(id=name, name=name) for name in
+                              (term[len("name="):] for term in search.split(" or "))], wait)
+            self.futures.append(future)
+            return future
+
+    service = Service()
+    vms = VMTools.resolve_vms(service, ["vm%s" % i for i in range(5)], page_size=2)
+    assert len(service.futures) == 3
+    assert sorted(vms) == ["vm%s" % i for i in range(5)]
+
+
+def test_is_conflict():
+    assert VMTools.is_conflict(sdk.Error('Fault reason is "Conflict". HTTP response code is 409.', code=409))
+    assert not VMTools.is_conflict(sdk.Error('Fault reason is "Not Found". HTTP response code is 404.', code=404))
+    assert not VMTools.is_conflict(ValueError("409"))
@@ -0,0 +1,52 @@
+import pytest
+
+import waiter
+from waiter import Waiter, WaitTimeout
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    now = [0.0]
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(waiter.time, "sleep", sleep)
+    monkeypatch.setattr(waiter.time, "monotonic", lambda: now[0])
+    return slept
+
+
+def test_delays_grow_up_to_maximum():
+    delays = Waiter(1, 8).delays()
+    values = [next(delays) for _ in range(6)]
+    for value, interval in zip(values, [1, 2, 4, 8, 8, 8]):
+        assert interval / 2.0 <= value <= interval
+
+
+def test_wait_returns_result_of_check(sleeps):
+    results = iter([False, False, "done"])
+    assert Waiter(1, 4).wait(lambda: next(results)) == "done"
+    assert len(sleeps) == 3
+
+
+def test_wait_raises_after_deadline(sleeps):
+    with pytest.raises(WaitTimeout):
+        Waiter(1, 4, deadline=10).wait(lambda: False)
+    assert 10 <= sum(sleeps) < 14
+
+
+def test_learned_first_check_then_tight_polling(sleeps):
+    results = iter([False, False, "done"])
+    assert Waiter(1, 60, first=34).wait(lambda: next(results)) == "done"
+    assert sleeps[0] == 34
+    assert all(value <= 2 for value in sleeps[1:])
+
+
+def test_learned_delay():
+    assert waiter.learned_delay(None, 5) is None
+    # Operations which are about as fast as the first interval are polled
+    assert waiter.learned_delay(4, 5) is None
+    assert waiter.learned_delay(2400, 5) == 2400 * waiter.LEARNED_FRACTION
+    assert Waiter(1, 60, deadline=100, first=300).first == 100
@@ -0,0 +1,150 @@
+import logging
+import math
+import re
+import threading
+import time
+
+import ovirtsdk4 as sdk
+
+logger = logging.getLogger()
+
+# Path segments which are ids of objects, not names of collections
+ID_PATTERN = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$", re.IGNORECASE)
+# Number of endpoints which are logged at the end of the run
+TOP_ENDPOINTS = 15
+PERCENTILES = (50, 90, 99)
+
+
+def endpoint(method, path):
+    """
+    Name the service method of a REST call, e.g. GET vms/<id>/snapshots is
+    snapshots_service.list and POST vms/<id>/export is vm_service.export
+    :param method: HTTP method
+    :param path: Path of the request below the API URL
+    :return: Name of the endpoint
+    """
+    segments = [i for i in path.split("?")[0].strip("/").split("/") if i]
+    if not segments:
+        return "system_service.%s" % ("get" if method == "GET" else method.lower())
+    last = segments[-1]
+    parent_is_id = len(segments) < 2 or ID_PATTERN.match(segments[-2])
+    if ID_PATTERN.match(last):
+        collection = segments[-2] if len(segments) > 1 else "object"
+        name = collection[:-1] if collection.endswith("s") else collection
+        verb = {"GET": "get", "PUT": "update", "DELETE": "remove"}.get(method, method.lower())
+        return "%s_service.%s" % (name, verb)
+    if method == "POST" and not (last.endswith("s") and parent_is_id):
+        # Actions of an object are verbs, collections are plural nouns
+        owner = segments[-2] if len(segments) > 1 and not ID_PATTERN.match(segments[-2]) else (
+            segments[-3] if len(segments) > 2 else "system")
+        owner = owner[:-1] if owner.endswith("s") else owner
+        return "%s_service.%s" % (owner, last)
+    verb = {"GET": "list", "POST": "add"}.get(method, method.lower())
+    return "%s_service.%s" % (last, verb)
+
+
+def percentile(values, percent):
+    """
+    :param values: Sorted list of numbers
+    :param percent: 0 to 100
+    :return: The value below which percent of the values are, nearest rank
+    """
+    if not values:
+        return None
+    rank = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class CallTracer(object):
+    """
+    Class which collects the number and latency of the REST calls of all
+    connections by endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._errors = {}
+
+    def record(self, name, seconds, failed=False):
+        """
+        :param name: Endpoint, see endpoint()
+        :param seconds: Time from sending the request till the response was
+        read
+        :param failed: True if the engine answered with an error
+        """
+        with self._lock:
+            self._latencies.setdefault(name, []).append(seconds)
+            if failed:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def summary(self):
+        """
+        :return: Dict of the endpoints with their calls, errors, total
+        seconds and latency percentiles
+        """
+        with self._lock:
+            latencies = dict((name, sorted(values)) for name, values in self._latencies.items())
+            errors = dict(self._errors)
+        result = {}
+        for name, values in latencies.items():
+            entry = {
+                "calls": len(values),
+                "errors": errors.get(name, 0),
+                "seconds": round(sum(values), 3),
+            }
+            for percent in PERCENTILES:
+                entry["p%s" % percent] = round(percentile(values, percent), 4)
+            result[name] = entry
+        return result
+
+    def log_summary(self):
+        """
+        Log the endpoints with the most time and with the most calls
+        """
+        summary = self.summary()
+        if not summary:
+            return
+        calls = sum(i["calls"] for i in summary.values())
+        seconds = sum(i["seconds"] for i in summary.values())
+        reads = sum(i["calls"] for name, i in summary.items() if name.endswith((".get", ".list")))
+        logger.info("SDK calls: %s in %s seconds, %s%% of them reads", calls, int(seconds),
+                    reads * 100 // calls)
+        for title, key in (("total time", "seconds"), ("call count", "calls")):
+            logger.info("Top SDK endpoints by %s:", title)
+            for name, entry in sorted(summary.items(), key=lambda i: -i[1][key])[:TOP_ENDPOINTS]:
+                logger.info("  %-45s calls %6s  errors %4s  total %8.2fs  p50 %.3fs  p90 %.3fs  p99 %.3fs", name,
+                            entry["calls"], entry["errors"], entry["seconds"], entry["p50"], entry["p90"],
+                            entry["p99"])
+
+
+class TracingConnection(sdk.Connection):
+    """
+    sdk.Connection which times every REST call for the CallTracer
+    """
+
+    def __init__(self, tracer, **kwargs):
+        """
+        :param tracer: CallTracer
+        :param kwargs: Arguments of sdk.Connection
+        """
+        super(TracingConnection, self).__init__(**kwargs)
+        self._tracer = tracer
+        self._sent = {}
+
+    def send(self, request):
+        started = time.monotonic()
+        context = super(TracingConnection, self).send(request)
+        # Requests sent with wait=False are waited for by other calls
+        self._sent[id(context)] = (endpoint(request.method, request.path), started)
+        return context
+
+    def wait(self, context, failed_auth=False):
+        name, started = self._sent.pop(id(context), ("unknown", time.monotonic()))
+        try:
+            response = super(TracingConnection, self).wait(context, failed_auth)
+        except Exception:
+            self._tracer.record(name, time.monotonic() - started, failed=True)
+            raise
+        self._tracer.record(name, time.monotonic() - started, failed=response.code >= 400)
+        return response
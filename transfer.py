@@ -0,0 +1,262 @@
+import http.client
+import json
+import logging
+import os
+import ssl
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger()
+
+# Bytes read with one request from the image server
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class TransferError(Exception):
+    """
+    Raised if the image server rejects a request
+    """
+
+
+class ImageioClient(object):
+    """
+    Class which reads a disk from the image server of one image transfer
+    """
+
+    def __init__(self, url, timeout=60):
+        """
+        :param url: transfer_url of the image transfer
+        :param timeout: Seconds to wait for the image server
+        """
+        parsed = urlparse(url)
+        if parsed.scheme == "https":
+            # Like the engine connection the certificate isn't verified
+            self._con = http.client.HTTPSConnection(
+                parsed.netloc, timeout=timeout, context=ssl._create_unverified_context()
+            )
+        else:
+            self._con = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+        self._path = parsed.path
+
+    def _request(self, path, headers=None):
+        self._con.request("GET", path, headers=headers or {})
+        response = self._con.getresponse()
+        body = response.read()
+        if response.status >= 300:
+            raise TransferError("GET %s failed with status %s: %s" % (path, response.status, body[:200]))
+        return body
+
+    def extents(self, context="zero"):
+        """
+        :param context: "zero" for the allocation of the disk, "dirty" for
+        the blocks changed since the checkpoint of an incremental backup
+        :return: List of dicts with start, length and zero or dirty
+        """
+        return json.loads(self._request("%s/extents?context=%s" % (self._path, context)))
+
+    def read(self, offset, length):
+        """
+        :param offset: First byte
+        :param length: Number of bytes
+        :return: The bytes
+        """
+        data = self._request(self._path, {"Range": "bytes=%d-%d" % (offset, offset + length - 1)})
+        if len(data) != length:
+            raise TransferError("Got %s bytes at offset %s instead of %s" % (len(data), offset, length))
+        return data
+
+    def close(self):
+        self._con.close()
+
+
+def data_ranges(client):
+    """
+    :param client: ImageioClient
+    :return: List of tuples (offset, length) of the extents which contain
+    data, None if the image server has no extents
+    """
+    try:
+        extents = client.extents("zero")
+    except TransferError as e:
+        logger.debug("No extents, the whole disk is downloaded: %s", e)
+        return None
+    return [(i["start"], i["length"]) for i in extents if not i["zero"]]
+
+
+def intersect_ranges(ranges, other):
+    """
+    :param ranges: Sorted list of tuples (offset, length)
+    :param other: Sorted list of tuples (offset, length)
+    :return: List of tuples (offset, length) which are in both lists
+    """
+    result = []
+    i = j = 0
+    while i < len(ranges) and j < len(other):
+        start = max(ranges[i][0], other[j][0])
+        end_i = ranges[i][0] + ranges[i][1]
+        end_j = other[j][0] + other[j][1]
+        end = min(end_i, end_j)
+        if start < end:
+            result.append((start, end - start))
+        if end_i <= end_j:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def split_ranges(ranges, chunk_size=CHUNK_SIZE):
+    """
+    Split byte ranges into chunks of at most chunk_size
+    :param ranges: Iterable of tuples (offset, length)
+    :return: Generator of tuples (offset, length)
+    """
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            yield offset, min(chunk_size, end - offset)
+            offset += chunk_size
+
+
+class RawWriter(object):
+    """
+    Class which writes a disk into a sparse raw file
+    """
+
+    def __init__(self, path, size, resume=False):
+        """
+        :param path: Target file
+        :param size: Size of the disk in bytes
+        :param resume: Keep the data of an interrupted download
+        """
+        self.path = path
+        self._file = open(path, "r+b" if resume else "wb")
+        # Unwritten parts of the file are holes which read as zeros
+        self._file.truncate(size)
+
+    def write(self, offset, data):
+        if self._file.tell() != offset:
+            self._file.seek(offset)
+        self._file.write(data)
+
+    def sync(self):
+        """
+        Write everything to the disk, afterwards the download can be resumed
+        behind the written data
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def describe(self):
+        """
+        :return: Entries of the disk in the manifest
+        """
+        return {"file": os.path.basename(self.path)}
+
+
+def read_chunks(url, chunks, connections=1):
+    """
+    Read chunks of a disk with several connections to the image server
+    :param url: transfer_url of the image transfer
+    :param chunks: List of tuples (offset, length)
+    :param connections: Number of connections reading at the same time
+    :return: Generator of tuples (offset, data) in the order of chunks, at
+    most two chunks per connection are held in memory
+    """
+    window = threading.Semaphore(2 * connections)
+    cond = threading.Condition()
+    stopped = threading.Event()
+    results = {}
+    errors = []
+    position = [0]
+
+    def worker():
+        client = None
+        try:
+            client = ImageioClient(url)
+            while True:
+                window.acquire()
+                with cond:
+                    if stopped.is_set() or position[0] >= len(chunks):
+                        return
+                    index = position[0]
+                    position[0] += 1
+                data = client.read(*chunks[index])
+                with cond:
+                    results[index] = data
+                    cond.notify_all()
+        except Exception as e:
+            with cond:
+                errors.append(e)
+                cond.notify_all()
+        finally:
+            if client:
+                client.close()
+
+    threads = [
+        threading.Thread(target=worker, name="%s-read-%s" % (threading.current_thread().name, i), daemon=True)
+        for i in range(min(connections, len(chunks)))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for index, (offset, _) in enumerate(chunks):
+            with cond:
+                cond.wait_for(lambda: index in results or errors)
+                if index not in results:
+                    raise errors[0]
+                data = results.pop(index)
+            window.release()
+            yield offset, data
+    finally:
+        stopped.set()
+        for _ in threads:
+            window.release()
+        for thread in threads:
+            thread.join()
+
+
+def clip_ranges(ranges, offset):
+    """
+    :param ranges: Sorted list of tuples (offset, length)
+    :param offset: First byte to keep
+    :return: List of tuples (offset, length) without the bytes before offset
+    """
+    result = []
+    for start, length in ranges:
+        end = start + length
+        if end > offset:
+            start = max(start, offset)
+            result.append((start, end - start))
+    return result
+
+
+def download(url, writer, size, ranges=None, chunk_size=CHUNK_SIZE, connections=1, progress=None):
+    """
+    Download a disk, the chunks are written one after the other and the rest
+    of the disk isn't written
+    :param url: transfer_url of the image transfer
+    :param writer: RawWriter or CompressedWriter, isn't closed
+    :param size: Size of the disk in bytes
+    :param ranges: List of tuples (offset, length) to download, e.g. only
+    the extents with data, None means the whole disk
+    :param chunk_size: Bytes read with one request
+    :param connections: Number of connections to the image server
+    :param progress: Callable which gets the end of every written chunk
+    :return: Number of bytes downloaded
+    """
+    if ranges is None:
+        ranges = [(0, size)]
+    chunks = list(split_ranges(sorted(ranges), chunk_size))
+    transferred = 0
+    for offset, data in read_chunks(url, chunks, connections):
+        writer.write(offset, data)
+        transferred += len(data)
+        if progress:
+            progress(offset + len(data))
+    logger.debug("Downloaded %s bytes of %s into %s with %s connections", transferred, size, writer.path,
+                 connections)
+    return transferred
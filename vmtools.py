@@ -1,12 +1,18 @@
 import logging
-import time
 import sys
-import datetime
 import re
 import ovirtsdk4.types as types
+from batch import wait_all
+from events import tracked
+from metrics import timed
+from waiter import wait_for
 
 logger = logging.getLogger()
 
+# Maximum length of one search expression, keeps the request URL well
+# below the limits of the engine and proxies in front of it
+MAX_SEARCH_LENGTH = 2000
+
 
 class VMTools:
     """
@@ -14,40 +20,223 @@ class VMTools:
     """
 
     @staticmethod
-    def wait_for_snapshot_operation(api, vm, config, comment):
+    def iter_vms(vms_service, search=None, page_size=100):
+        """
+        Enumerate VMs page by page, without the limit of a single request
+        :param vms_service: ovirtsdk vms service
+        :param search: Search query to restrict the VMs, it has to exclude
+        the clones, see clone_pattern
+        :param page_size: Number of VMs fetched with one request
+        :return: Generator of VM objects, oldest first
+        """
+        # The clones which the backups create and delete meanwhile are not
+        # part of the search, so they don't shift the pages which are not
+        # fetched yet
+        seen = set()
+        page = 1
+        while True:
+            query = "%s sortby creationdate asc page %s" % (search or "", page)
+            vms = vms_service.list(search=query.strip(), max=page_size)
+            logger.debug("Fetched page %s with %s VMs", page, len(vms))
+            for vm in vms:
+                if vm.id not in seen:
+                    seen.add(vm.id)
+                    yield vm
+            if len(vms) < page_size:
+                return
+            page += 1
+
+    @staticmethod
+    def clone_pattern(config):
+        """
+        :param config: Configuration
+        :return: Search pattern of the names of the cloned VMs, e.g.
+        "*_BACKUP_*"
+        """
+        return "*%s_*" % config.get_vm_middle()
+
+    @staticmethod
+    def search_chunks(terms, operator, max_length=MAX_SEARCH_LENGTH, max_terms=None):
+        """
+        Join search terms into as few search expressions as possible
+        :param terms: List of search terms, e.g. "name=vm1"
+        :param operator: "or" or "and"
+        :param max_length: Maximum length of one search expression
+        :param max_terms: Maximum number of terms in one search expression
+        :return: Generator of tuples (search expression, terms in it)
+        """
+        chunk = []
+        length = 0
+        for term in terms:
+            added = len(term) + (len(operator) + 2 if chunk else 0)
+            if chunk and (length + added > max_length or len(chunk) == max_terms):
+                yield (" %s " % operator).join(chunk), chunk
+                chunk = []
+                added = len(term)
+                length = 0
+            chunk.append(term)
+            length += added
+        if chunk:
+            yield (" %s " % operator).join(chunk), chunk
+
+    @staticmethod
+    def resolve_vms(vms_service, vm_names, page_size=100):
+        """
+        Resolve VM names with a few "name=a or name=b" search requests
+        which are sent at the same time
+        :param vms_service: ovirtsdk vms service
+        :param vm_names: List of VM names
+        :param page_size: Maximum of names resolved with one request
+        :return: Dict of VM objects by name, missing VMs are not included
+        """
+        vms = {}
+        terms = ["name=%s" % vm_name for vm_name in vm_names]
+        futures = [
+            vms_service.list(search=search, max=len(chunk), case_sensitive=True, wait=False)
+            for search, chunk in VMTools.search_chunks(terms, "or", max_terms=page_size)
+        ]
+        for result in wait_all(futures):
+            for vm in result:
+                vms[vm.name] = vm
+        logger.debug("Resolved %s of %s VM names", len(vms), len(vm_names))
+        return vms
+
+    @staticmethod
+    def exclusion_search(vm_names, max_length=MAX_SEARCH_LENGTH):
+        """
+        Build a "name!=a and name!=b" search expression to exclude VMs on
+        the engine
+        :param vm_names: List of VM names to exclude
+        :param max_length: Maximum length of the search expression
+        :return: Tuple (search expression or None, names which didn't fit
+        and have to be excluded by the caller)
+        """
+        terms = ["name!=%s" % vm_name for vm_name in vm_names]
+        for search, chunk in VMTools.search_chunks(terms, "and", max_length):
+            return search, vm_names[len(chunk):]
+        return None, []
+
+    @staticmethod
+    def is_clone_name(config, vm_name):
+        """
+        Check if a VM name is the name of a cloned VM created during backup
+        :param config: Configuration
+        :param vm_name: Name of the VM
+        :return: True if the name ends with vm_middle and a suffix
+        """
+        return re.search(re.escape(config.get_vm_middle()) + r"_\d+(_\d+)?$", vm_name) is not None
+
+    @staticmethod
+    def wait_for_snapshot_operation(api, vm, config, comment, snapshot_id=None, monitor=None, expected=None):
         """
         Wait for a snapshot operation to be finished
         :param api: ovirtsdk api
         :param vm: Virtual machine object
         :param config: Configuration
         :param comment: This comment will be used for debugging output
+        :param snapshot_id: Wait only for this snapshot, it has to exist and
+        reach the status 'ok'. Without it all backup snapshots are waited
+        for till they are 'ok' or gone.
+        :param monitor: StatusMonitor to share the status polling with other
+        operations, None polls the snapshot directly
+        :param expected: Seconds the operation took at least in the past
+        backups of the VM, the first check is made shortly before, None
+        polls from the start
         """
         vm_service = api.system_service().vms_service().vm_service(vm.id)
         snaps_service = vm_service.snapshots_service()
-        snapshots = snaps_service.list()
-        for i in snapshots:
-            if i.description == config.get_snapshot_description():
-                snap_service = snaps_service.snapshot_service(i.id)
-                while True:
-                    try:
-                        snap = snap_service.get()
-                    except:
-                        break
+        if snapshot_id:
+            snapshot_ids = [snapshot_id]
+        else:
+            snapshot_ids = [i.id for i in snaps_service.list()
+                            if i.description == config.get_snapshot_description()]
+        for i in snapshot_ids:
+            if monitor:
+                def finished(snap):
+                    if snap is None:
+                        if snapshot_id:
+                            raise Exception("Snapshot %s doesn't exist anymore" % snapshot_id)
+                        return True
+                    return snap.snapshot_status == types.SnapshotStatus.OK
+
+                monitor.wait_snapshot(vm.id, i, finished, "Snapshot operation(%s)" % comment, expected)
+                continue
+
+            snap_service = snaps_service.snapshot_service(i)
 
-                    if snap.snapshot_status == types.SnapshotStatus.OK:
-                        break
-                    logger.debug("Snapshot operation(%s) in progress ...", comment)
-                    logger.debug("Snapshot id=%s status=%s", snap.id, snap.snapshot_status)
-                    time.sleep(config.get_timeout())
+            def finished():
+                try:
+                    snap = snap_service.get()
+                except Exception:
+                    if snapshot_id:
+                        raise
+                    return True
+                logger.debug("Snapshot id=%s status=%s", snap.id, snap.snapshot_status)
+                return snap.snapshot_status == types.SnapshotStatus.OK
+
+            wait_for(config, "snapshot", finished, "Snapshot operation(%s)" % comment, expected)
+
+    @staticmethod
+    def is_removed(service):
+        """
+        Check if the object of a service is gone
+        :param service: ovirtsdk service with a get method
+        :return: True if the object doesn't exist anymore
+        """
+        try:
+            service.get()
+        except Exception:
+            return True
+        return False
+
+    @staticmethod
+    def is_down(vm_service):
+        """
+        Check if a VM is down, e.g. after clone and export operations
+        :param vm_service: ovirtsdk vm service
+        :return: True if the status of the VM is 'down'
+        """
+        return vm_service.get().status == types.VmStatus.DOWN
 
     @staticmethod
-    def delete_snapshots(api, vm, config, vm_name):
+    def wait_for_vm_down(api, config, vm_id, operation, description, monitor=None, expected=None):
+        """
+        Wait till a VM is down, e.g. after clone and export operations
+        :param api: ovirtsdk api
+        :param config: Configuration
+        :param vm_id: Id of the VM
+        :param operation: Kind of operation, used for the poll interval
+        :param description: This comment will be used for debugging output
+        :param monitor: StatusMonitor to share the status polling with other
+        operations, None polls the VM directly
+        :param expected: Seconds the operation took at least in the past,
+        see wait_for_snapshot_operation
+        """
+        if monitor:
+            def finished(vm):
+                if vm is None:
+                    raise Exception("VM %s doesn't exist anymore" % vm_id)
+                return vm.status == types.VmStatus.DOWN
+
+            monitor.wait_vm(vm_id, finished, description, expected)
+            return
+        vm_service = api.system_service().vms_service().vm_service(vm_id)
+        wait_for(config, operation, lambda: VMTools.is_down(vm_service), description, expected)
+
+    @staticmethod
+    @timed("snapshot_deletion")
+    def delete_snapshots(api, vm, config, vm_name, monitor=None, tracker=None, expected=None):
         """
         Deletes a backup snapshot
         :param api: ovirtsdk api
         :param vm: Virtual machine object
         :param config: Configuration
         :param vm_name: Virtual machine object
+        :param monitor: StatusMonitor, see wait_for_snapshot_operation
+        :param tracker: EventTracker to wait for the engine jobs instead of
+        polling the snapshot
+        :param expected: Seconds the deletion took at least in the past, see
+        wait_for_snapshot_operation
         """
         logger.debug("Search backup snapshots matching Description=\"%s\"", config.get_snapshot_description())
         vm_service = api.system_service().vms_service().vm_service(vm.id)
@@ -59,24 +248,30 @@ class VMTools:
                 if i.description == config.get_snapshot_description():
                     logger.debug("Found backup snapshot to delete. Description: %s, Created on: %s", i.description,
                                  i.date)
+                    def remove():
+                        try:
+                            snaps_service.snapshot_service(i.id).remove(query=operation and operation.query)
+                            return True
+                        except Exception as e:
+                            if VMTools.is_conflict(e):
+                                logger.debug("Got 409 wait for operation to be finished, DEBUG: %s", e)
+                                return False
+                            logger.info("  !!! Found another exception for VM: %s", vm_name)
+                            logger.info("  DEBUG: %s", e)
+                            sys.exit(1)
+
                     try:
-                        while True:
-                            try:
-                                if not config.get_dry_run():
-                                    snaps_service.snapshot_service(i.id).remove()
-                                    logger.info("Snapshot deletion started ...")
-                                    VMTools.wait_for_snapshot_operation(api, vm, config, "deletion")
-                                    done = True
-                                    break
-                            except Exception as e:
-                                if "status: 409" in str(e):
-                                    logger.debug("Got 409 wait for operation to be finished, DEBUG: %s", e)
-                                    time.sleep(config.get_timeout())
-                                    continue
+                        if not config.get_dry_run():
+                            with tracked(tracker, "Snapshot deletion") as operation:
+                                if not remove():
+                                    wait_for(config, "conflict", remove, "Snapshot deletion")
+                                logger.info("Snapshot deletion started ...")
+                                if operation:
+                                    operation.wait()
                                 else:
-                                    logger.info("  !!! Found another exception for VM: %s", vm_name)
-                                    logger.info("  DEBUG: %s", e)
-                                    sys.exit(1)
+                                    VMTools.wait_for_snapshot_operation(api, vm, config, "deletion", monitor=monitor,
+                                                                        expected=expected)
+                            done = True
                     except Exception as e:
                         logger.info("  !!! Can't delete snapshot for VM: %s", vm_name)
                         logger.info("  Description: %s, Created on: %s", i.get_description(), i.get_date())
@@ -86,52 +281,77 @@ class VMTools:
                 logger.info("Snapshots deleted")
 
     @staticmethod
-    def delete_vm(api, config, vm_name):
+    @timed("vm_deletion")
+    def delete_vm(api, config, vm_name, monitor=None, tracker=None, expected=None):
         """
         Delets a vm which was created during backup
         :param api: ovirtsdk api
         :param config: Configuration
         :param vm_name: Virtual machine object
+        :param monitor: StatusMonitor to share the status polling with other
+        operations, None polls the VM directly
+        :param tracker: EventTracker to wait for the engine jobs instead of
+        polling the VM
+        :param expected: Seconds the deletion took at least in the past, see
+        wait_for_snapshot_operation
         """
-        global global_vm
+        # Local to the call, VMs are deleted by several threads at the same
+        # time
+        clone = None
         done = False
         try:
             vms_service = api.system_service().vms_service()
             vm_search_regexp = ("name=%s%s_*" % (vm_name, config.get_vm_middle()))
-            for global_vm in vms_service.list(search=vm_search_regexp):
-                logger.info("Delete cloned VM (%s) started ..." % global_vm.name)
+            for clone in vms_service.list(search=vm_search_regexp):
+                logger.info("Delete cloned VM (%s) started ..." % clone.name)
                 if not config.get_dry_run():
-                    vm_service = vms_service.vm_service(global_vm.id)
+                    vm_service = vms_service.vm_service(clone.id)
                     if vm_service is None:
                         logger.warning(
                             "The VM (%s) doesn't exist anymore, "
-                            "skipping deletion ...", global_vm.name
+                            "skipping deletion ...", clone.name
                         )
                         done = True
                         continue
-                    global_vm.delete_protected = False
-                    vm_service.update(global_vm)
-                    while True:
+                    clone.delete_protected = False
+                    vm_service.update(clone)
+
+                    def remove():
                         try:
-                            vm_service.remove()
-                            break
-                        except:
+                            vm_service.remove(query=operation and operation.query)
+                            return True
+                        except Exception:
                             logger.debug("Wait for previous clone operation to complete (VM %s status is %s)...",
-                                         global_vm.name, global_vm.status)
-                            time.sleep(config.get_timeout())
-                    while True:
-                        try:
-                            vm_service.get()
-                        except:
-                            break
-                        logger.debug("Deletion of cloned VM (%s) in progress ..." % global_vm.name)
-                        time.sleep(config.get_timeout())
+                                         clone.name, clone.status)
+                            return False
+
+                    with tracked(tracker, "Deletion of cloned VM (%s)" % clone.name) as operation:
+                        if not remove():
+                            wait_for(config, "conflict", remove, "Removal of cloned VM (%s)" % clone.name)
+                        if operation:
+                            operation.wait()
+                        elif monitor:
+                            monitor.wait_vm(clone.id, lambda vm: vm is None,
+                                            "Deletion of cloned VM (%s)" % clone.name, expected)
+                        else:
+                            wait_for(config, "vm_deletion", lambda: VMTools.is_removed(vm_service),
+                                     "Deletion of cloned VM (%s)" % clone.name, expected)
                     done = True
         except Exception as e:
-            logger.info("!!! Can't delete cloned VM (%s)", global_vm.name)
+            logger.info("!!! Can't delete cloned VM (%s)", clone.name if clone else vm_name)
             raise e
         if done:
-            logger.info("Cloned VM (%s) deleted", global_vm.name)
+            logger.info("Cloned VM (%s) deleted", clone.name)
+
+    @staticmethod
+    def is_conflict(error):
+        """
+        Check if the engine refused an operation because the object is
+        locked by another operation
+        :param error: Exception of the ovirtsdk
+        :return: True if the operation can be retried later
+        """
+        return getattr(error, "code", None) == 409 or "status: 409" in str(error)
 
     @staticmethod
     def wait_for_vm_operation(api, config, comment, vm_name):
@@ -146,145 +366,39 @@ class VMTools:
         composed_vm_name = "%s%s%s" % (
             vm_name, config.get_vm_middle(), config.get_vm_suffix()
         )
-        while True:
+
+        def finished():
             vm = api.system_service().vms_service().list(search='name=%s' % composed_vm_name)
             if len(vm) == 0:
                 logger.warning(
                     "The VM (%s) doesn't exist anymore, "
                     "leaving waiting loop ...", composed_vm_name
                 )
-                break
-
-            vm = vm[0]
-            if vm.status == types.VmStatus.DOWN:
-                break
-            logger.debug(
-                "%s in progress (VM %s status is '%s') ...",
-                comment, composed_vm_name, vm.status,
-            )
-            time.sleep(config.get_timeout())
+                return True
+            logger.debug("VM %s status is '%s'", composed_vm_name, vm[0].status)
+            return vm[0].status == types.VmStatus.DOWN
 
-    @staticmethod
-    def delete_old_backups(api, config, vm_name):
-        """
-        Delete old backups from the export domain
-        :param api: ovirtsdk api
-        :param config: Configuration
-        :param vm_name: Virtual machine object
-        """
-        vm_search_regexp = r'^' + vm_name + config.get_vm_middle() + '*'
-        logger.debug("Looking for old backup to delete matching %s and older than %s days...", vm_search_regexp,
-                     config.get_backup_keep_count())
-        sds_service = api.system_service().storage_domains_service()
-        export_sd = sds_service.list(search='name=%s' % config.get_export_domain())[0]
-        vms_service = sds_service.storage_domain_service(export_sd.id).vms_service()
-        # missing list(search'name=... on storage_domain_service().vms_service().list()
-        exported_vms = vms_service.list()
-        exported_vms = [i for i in exported_vms if re.match(vm_search_regexp, i.name)]
-        # not really needed to sort
-        logger.info("Found %s old backup images in export_domain.", len(exported_vms))
-        exported_vms.sort(key=lambda x: x.creation_time)
-        for i in exported_vms:
-            datetimeStart = datetime.datetime.combine(
-                (datetime.date.today() - datetime.timedelta(config.get_backup_keep_count())),
-                datetime.datetime.min.time())
-            timestampStart = time.mktime(datetimeStart.timetuple())
-            datetime_creation = i.creation_time
-            datetime_creation = datetime_creation.replace(hour=0, minute=0, second=0)
-            timestamp_creation = time.mktime(datetime_creation.timetuple())
-            if timestamp_creation < timestampStart:
-                logger.info("Backup deletion (by date) started for backup: %s", i.name)
-                if not config.get_dry_run():
-                    vms_service.vm_service(id=i.id).remove()
-                    while True:
-                        try:
-                            vms_service.vm_service(id=i.id).get()
-                            logger.debug("Delete old backup (%s) in progress ...", i.name)
-                            time.sleep(config.get_timeout())
-                        except:
-                            logger.info("Backup deletion complete for backup: %s", i.name)
-                            break
-
-    @staticmethod
-    def delete_old_backups_by_number(api, config, vm_name):
-        """
-        Delete old backups from the export domain by number of requested
-        :param api: ovirtsdk api
-        :param config: Configuration
-        :param vm_name: Virtual machine object
-      """
-        vm_search_regexp = r'^' + vm_name + config.get_vm_middle() + '*'
-        logger.debug("Looking for old backup to delete matching %s, keeping max %s images...", vm_search_regexp,
-                     config.get_backup_keep_count_by_number())
-        sds_service = api.system_service().storage_domains_service()
-        export_sd = sds_service.list(search='name=%s' % config.get_export_domain())[0]
-        vms_service = sds_service.storage_domain_service(export_sd.id).vms_service()
-        # missing list(search'name=... on storage_domain_service().vms_service().list()
-        exported_vms = vms_service.list()
-        exported_vms = [i for i in exported_vms if re.match(vm_search_regexp, i.name)]
-        exported_vms.sort(key=lambda x: x.creation_time)
-        logger.info("Found %s old backup images in export_domain.", len(exported_vms))
-        while len(exported_vms) > config.get_backup_keep_count_by_number():
-            i = exported_vms.pop(0)
-            logger.info("Backup deletion (by number) started for backup: %s", i.name)
-            if not config.get_dry_run():
-                vms_service.vm_service(id=i.id).remove()
-                while True:
-                    try:
-                        vms_service.vm_service(id=i.id).get()
-                        logger.debug("Delete old backup (%s) in progress ...", i.name)
-                        time.sleep(config.get_timeout())
-                    except:
-                        logger.info("Backup deletion complete for backup: %s", i.name)
-                        break
-
-    @staticmethod
-    def check_free_space(api, config, vm):
-        """
-        Check if the summarized size of all VM disks is available on the storagedomain
-        :param api: ovirtsdk api
-        :param config: Configuration
-        to avoid running out of space
-        :param  vm: object
-        """
-        sd = api.system_service().storage_domains_service().list(search='name=%s' % config.get_storage_domain())[0]
-        vm_service = api.system_service().vms_service().vm_service(vm.id)
-        disk_attachments = vm_service.disk_attachments_service().list()
-        vm_size = 0
-        for disk_attachment in disk_attachments:
-            disk_id = disk_attachment.disk.id
-            if disk_id in config.get_disks_id_exclude():
-                logger.info('excluded disk: ', disk_id)
-                continue
-            disk = api.system_service().disks_service().disk_service(disk_id).get()
-            # For safety reason "vm.actual_size" is not used
-            if disk.provisioned_size is not None:
-                vm_size += disk.provisioned_size
-        logger.info("VM SIZE: %s GiB", vm_size /1024/1024/1024)
-        storage_space_threshold = 0
-        if config.get_storage_space_threshold() > 0:
-            storage_space_threshold = config.get_storage_space_threshold()
-        vm_size *= (1 + storage_space_threshold)
-        if (sd.available - vm_size) <= 0:
-            raise Exception(
-                "!!! The is not enough free storage on the storage domain '%s' available to backup the VM '%s', need at least %s GiB" % (
-                    config.get_storage_domain(), vm.name, vm_size/1024/1024/1024))
+        wait_for(config, "clone", finished, comment)
 
     @staticmethod
-    def check_storage_domain_status(api, data_center, storage_domain):
+    def check_storage_domain_status(api, data_center, storage_domain, inventory=None):
         """
         Check the state of the export domain
         :param api: ovirt api module
         :param data_center: data center name where the storage domain attached
         :param storage_domain: storage domain name
+        :param inventory: Inventory to look up the storage domain
         :return: True if 'active'
         :raises: Exception if storage domain is not 'active'
         """
-        dcs_service = api.system_service().data_centers_service()
-        dc = dcs_service.list(search='name=%s' % data_center)[0]
-        dc_service = dcs_service.data_center_service(dc.id)
-        sds_service = dc_service.storage_domains_service()
-        sd = sds_service.list(search='name=%s' % storage_domain)[0]
+        if inventory:
+            sd = inventory.attached_storage_domain(data_center, storage_domain)
+        else:
+            dcs_service = api.system_service().data_centers_service()
+            dc = dcs_service.list(search='name=%s' % data_center)[0]
+            dc_service = dcs_service.data_center_service(dc.id)
+            sds_service = dc_service.storage_domains_service()
+            sd = sds_service.list(search='name=%s' % storage_domain)[0]
 
         info_msg = (
             "The storage domain {0} is in state {1}".format(
@@ -0,0 +1,138 @@
+import logging
+import random
+import time
+
+from metrics import waiting
+
+logger = logging.getLogger()
+
+# Poll interval in seconds (initial, maximum) for every kind of operation,
+# the interval doubles after every check until it reaches the maximum.
+DEFAULT_POLL_INTERVALS = {
+    "snapshot": (1, 10),
+    "clone": (2, 30),
+    "export": (5, 60),
+    "vm_deletion": (1, 15),
+    "backup_deletion": (1, 15),
+    # Tick of the status monitor which polls all running operations at once
+    "monitor": (1, 10),
+    # Reading of new engine events when the event tracker is used
+    "events": (1, 5),
+    # Phases of engine backups and image transfers
+    "backup": (1, 10),
+    "transfer": (1, 5),
+    # Recheck of the free space while other backups hold reservations
+    "capacity": (5, 60),
+}
+
+# Part of the shortest past duration of an operation which passes before
+# the first check, e.g. an export which took 40 minutes is first checked
+# after 34 minutes and polled tightly from then on
+LEARNED_FRACTION = 0.85
+
+
+class WaitTimeout(Exception):
+    """
+    Raised if an operation isn't finished before its deadline
+    """
+
+
+class Waiter(object):
+    """
+    Class which polls a check with exponential backoff and jitter
+    """
+
+    def __init__(self, initial, maximum, deadline=None, factor=2, first=None):
+        """
+        :param initial: First poll interval in seconds
+        :param maximum: Ceiling for the poll interval in seconds
+        :param deadline: Seconds after which the wait is given up, None or 0
+        means wait forever
+        :param factor: Growth of the interval after every check
+        :param first: Seconds before the first check, the intervals start
+        with initial after it, None starts with initial right away
+        """
+        self.initial = initial
+        self.maximum = max(maximum, initial)
+        self.deadline = deadline or None
+        self.factor = factor
+        self.first = first
+        if self.first and self.deadline:
+            self.first = min(self.first, self.deadline)
+
+    def delays(self):
+        """
+        Generator of the sleep times between two checks
+        """
+        if self.first:
+            yield self.first
+        interval = self.initial
+        while True:
+            # Jitter spreads the checks of operations started at the same time
+            yield random.uniform(interval / 2.0, interval)
+            interval = min(interval * self.factor, self.maximum)
+
+    def wait(self, check, description="operation"):
+        """
+        Call check until it returns a true value
+        :param check: Callable without arguments
+        :param description: Used for debugging output
+        :return: The true value returned by check
+        :raises: WaitTimeout if the deadline is reached
+        """
+        started = time.monotonic()
+        for delay in self.delays():
+            with waiting():
+                time.sleep(delay)
+            result = check()
+            if result:
+                return result
+            elapsed = time.monotonic() - started
+            if self.deadline and elapsed >= self.deadline:
+                raise WaitTimeout("%s not finished after %d seconds" % (description, elapsed))
+            logger.debug("%s in progress ...", description)
+
+
+def learned_delay(expected, initial):
+    """
+    :param expected: Seconds the operation took at least in the past, None
+    without history
+    :param initial: First poll interval in seconds
+    :return: Seconds before the first check, None if the operation is polled
+    from the start
+    """
+    if not expected:
+        return None
+    first = expected * LEARNED_FRACTION
+    return first if first > initial else None
+
+
+def create_waiter(config, operation, expected=None):
+    """
+    Create a waiter with the poll intervals and deadline of the configuration
+    :param config: Configuration
+    :param operation: Key of DEFAULT_POLL_INTERVALS, "conflict" is used to
+    retry operations which are rejected because another one is running
+    :param expected: Seconds the operation took at least in the past, the
+    first check is made shortly before, None polls from the start
+    """
+    if operation == "conflict":
+        initial, maximum = 1, config.get_timeout()
+    else:
+        initial, maximum = config.get_poll_intervals().get(operation, DEFAULT_POLL_INTERVALS[operation])
+    return Waiter(initial, maximum, config.get_operation_deadline(), first=learned_delay(expected, initial))
+
+
+def wait_for(config, operation, check, description=None, expected=None):
+    """
+    Wait for an operation with the poll intervals of the configuration
+    :param config: Configuration
+    :param operation: Key of DEFAULT_POLL_INTERVALS or "conflict"
+    :param check: Callable without arguments, returns a true value when the
+    operation is finished
+    :param description: Used for debugging output
+    :param expected: Seconds the operation took at least in the past, see
+    create_waiter
+    :return: The true value returned by check
+    """
+    return create_waiter(config, operation, expected).wait(check, description or operation)